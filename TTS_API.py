@@ -4,6 +4,16 @@
 import requests
 import os
 import json
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import NamedTuple, Optional
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import audio_ingest
+import result_cache
+from config_manager import config
 from logger import logger  # Import the logger
 from dotenv import load_dotenv
 
@@ -11,17 +21,81 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # Define constants for the script
-CHUNK_SIZE = 1024  # Size of chunks to read/write at a time
+CHUNK_SIZE = int(config.get("TTS", "chunk_size", fallback=str(64 * 1024)))  # Size of chunks to read/write at a time
 XI_API_KEY = os.getenv("ELEVENLABS_API_KEY")
 VOICE_ID = "EXAVITQu4vr4xnSDxMaL"  # ID of the voice model to use
 TEXT_TO_SPEAK = "Hello world. This is an appel. FOO BAR!"  # Text you want to convert to speech
 OUTPUT_PATH = "output.mp3"  # Path to save the output audio file
+WAV_OUTPUT_PATH = "output.wav"  # Path to save the render-ready WAV (synthesize_to_wav)
 
+API_BASE_URL = config.get("TTS", "base_url", fallback="https://api.elevenlabs.io").rstrip("/")
+MODEL_ID = config.get("TTS", "model_id", fallback="eleven_multilingual_v2")
+MAX_PARALLEL = int(config.get("TTS", "max_parallel", fallback="4"))  # Concurrent synthesis requests
+CONNECT_TIMEOUT = config.getfloat("TTS", "connect_timeout", fallback=10.0)
+READ_TIMEOUT = config.getfloat("TTS", "read_timeout", fallback=60.0)
+MAX_RETRIES = int(config.get("TTS", "max_retries", fallback="5"))
+BACKOFF_FACTOR = config.getfloat("TTS", "backoff_factor", fallback=0.5)  # Retry waits 0.5s, 1s, 2s, ...
+STREAM_FORMAT = config.get("TTS", "stream_format", fallback="pcm_16000")  # Audio format for synthesize_to_wav
+TTS_CACHE_ENABLED = config.getboolean("TTS", "cache_enabled", fallback=True)
+TTS_CACHE_DIR = config.get("TTS", "cache_dir", fallback=".cache/tts")
+TTS_CACHE_MAX_BYTES = int(config.getfloat("TTS", "cache_max_size_gb", fallback=2.0) * 1024 ** 3)
+
+DEFAULT_VOICE_SETTINGS = {
+    "stability": 0.5,
+    "similarity_boost": 0.8,
+    "style": 0.0,
+    "use_speaker_boost": True
+}
+
+# Synthesized audio, keyed on text + voice + model + settings
+tts_cache = result_cache.ResultCache(TTS_CACHE_DIR, TTS_CACHE_MAX_BYTES)
+
+_session = None
+_session_lock = threading.Lock()
+_in_flight = {}  # cache key -> Future of the request producing it
+_in_flight_lock = threading.Lock()
+
+
+class TTSItem(NamedTuple):
+    text: str
+    voice_id: str = VOICE_ID
+    settings: Optional[dict] = None
+    output_path: Optional[str] = None
+
+
+def get_session():
+    """
+    Returns the shared keep-alive session. Its connection pool is sized for MAX_PARALLEL
+    requests, and 429/5xx responses are retried with exponential backoff (honouring Retry-After).
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=MAX_RETRIES,
+                backoff_factor=BACKOFF_FACTOR,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset(["GET", "POST"]),
+                respect_retry_after_header=True,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_PARALLEL, max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update({"xi-api-key": XI_API_KEY or ""})
+            _session = session
+        return _session
+
+
+def tts_cache_key(text, voice_id, model_id=MODEL_ID, settings=None):
+    payload = {"text": text, "voice_id": voice_id, "model_id": model_id, "settings": settings or DEFAULT_VOICE_SETTINGS}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
 
 
 def get_voices_list():
     # This is the URL for the API endpoint we'll be making a GET request to.
-    url = "https://api.elevenlabs.io/v1/voices"
+    url = f"{API_BASE_URL}/v1/voices"
 
     # Here, headers for the HTTP request are being set up. 
     # Headers provide metadata about the request. In this case, we're specifying the content type and including our API key for authentication.
@@ -32,7 +106,7 @@ def get_voices_list():
     }
 
     # A GET request is sent to the API endpoint. The URL and the headers are passed into the request.
-    response = requests.get(url, headers=headers)
+    response = get_session().get(url, headers=headers, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
 
     # The JSON response from the API is parsed using the built-in .json() method from the 'requests' library. 
     # This transforms the JSON data into a Python dictionary for further processing.
@@ -45,43 +119,164 @@ def get_voices_list():
       # These keys in the voice dictionary contain values that provide information about the specific voice.
       print(f"{voice['name']}; {voice['voice_id']}")
 
-def text_to_speech(text_to_speak=TEXT_TO_SPEAK, voice_id=VOICE_ID, output_path=OUTPUT_PATH):
+def _open_speech_stream(text, voice_id, model_id, settings, output_format=None):
     # Construct the URL for the Text-to-Speech API request
-    tts_url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}/stream"
-
-    # Set up headers for the API request, including the API key for authentication
-    headers = {
-        "Accept": "application/json",
-        "xi-api-key": XI_API_KEY
-    }
+    tts_url = f"{API_BASE_URL}/v1/text-to-speech/{voice_id}/stream"
 
     # Set up the data payload for the API request, including the text and voice settings
     data = {
-        "text": text_to_speak,
-        "model_id": "eleven_multilingual_v2",
-        "voice_settings": {
-            "stability": 0.5,
-            "similarity_boost": 0.8,
-            "style": 0.0,
-            "use_speaker_boost": True
-        }
+        "text": text,
+        "model_id": model_id,
+        "voice_settings": settings or DEFAULT_VOICE_SETTINGS
     }
+    params = {"output_format": output_format} if output_format else None
+
+    response = get_session().post(tts_url, headers={"Accept": "audio/mpeg"}, params=params, json=data, stream=True,
+                                  timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    if not response.ok:
+        response.close()
+        raise RuntimeError(f"TTS request failed ({response.status_code}): {response.text[:500]}")
+    return response
+
+
+def _download_speech(text, voice_id, model_id, settings, output_path):
+    # Stream the response to a temporary file next to the output, so a failed download never leaves a partial mp3
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    with _open_speech_stream(text, voice_id, model_id, settings) as response:
+        fd, tmp_path = tempfile.mkstemp(suffix=".part", dir=os.path.dirname(output_path) or ".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+            os.replace(tmp_path, output_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    return output_path
+
+
+def synthesize(text, voice_id=VOICE_ID, output_path=OUTPUT_PATH, settings=None, model_id=MODEL_ID):
+    """
+    Synthesize one line to output_path, reusing a cached result when the same text, voice,
+    model and settings were synthesized before. Concurrent calls for the same line share
+    a single request.
+
+    Returns:
+    str: output_path
+    """
+    key = tts_cache_key(text, voice_id, model_id, settings)
+    if TTS_CACHE_ENABLED and tts_cache.get(key, output_path):
+        return output_path
 
-    # Make the POST request to the TTS API with headers and data, enabling streaming response
-    response = requests.post(tts_url, headers=headers, json=data, stream=True)
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        owner = future is None
+        if owner:
+            future = _in_flight[key] = Future()
+    if not owner:
+        # Another thread is already synthesizing this line: wait for it and copy its result
+        source_path = future.result()
+        if TTS_CACHE_ENABLED and tts_cache.get(key, output_path):
+            return output_path
+        if os.path.abspath(source_path) != os.path.abspath(output_path):
+            result_cache.ResultCache._link_or_copy(source_path, output_path)
+        return output_path
 
-    # Check if the request was successful
-    if response.ok:
-        # Open the output file in write-binary mode
-        with open(output_path, "wb") as f:
-            # Read the response in chunks and write to the file
-            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
-                f.write(chunk)
+    try:
+        _download_speech(text, voice_id, model_id, settings, output_path)
+        if TTS_CACHE_ENABLED:
+            tts_cache.put(key, output_path)
+        future.set_result(output_path)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _in_flight_lock:
+            _in_flight.pop(key, None)
+    logger.info(f"Synthesized {len(text)} characters to {output_path}")
+    return output_path
+
+
+def synthesize_to_wav(text, voice_id=VOICE_ID, wav_path=WAV_OUTPUT_PATH, settings=None, model_id=MODEL_ID):
+    """
+    Synthesize one line straight to a SadTalker-ready WAV (SILENCE_TIME of leading silence,
+    SAMPLE_RATE, CHANNELS), decoding the response while it streams in. No MP3 is written,
+    so the WAV is ready to render as soon as the last byte arrives.
+
+    With [TTS] stream_format = pcm_<rate>, the API sends raw PCM that is written directly;
+    any other format (e.g. mp3_44100_128) is decoded by ffmpeg from a pipe.
+
+    Returns:
+    str: wav_path
+    """
+    wav_params = {"format": STREAM_FORMAT, "sample_rate": audio_ingest.SAMPLE_RATE,
+                  "channels": audio_ingest.CHANNELS, "silence_ms": audio_ingest.SILENCE_TIME}
+    key = hashlib.sha256((tts_cache_key(text, voice_id, model_id, settings) + json.dumps(wav_params, sort_keys=True)).encode("utf-8")).hexdigest()
+    if TTS_CACHE_ENABLED and tts_cache.get(key, wav_path):
+        return wav_path
+
+    os.makedirs(os.path.dirname(wav_path) or ".", exist_ok=True)
+    with _open_speech_stream(text, voice_id, model_id, settings, STREAM_FORMAT) as response:
+        chunks = response.iter_content(chunk_size=CHUNK_SIZE)
+        if STREAM_FORMAT.startswith("pcm_"):
+            pcm_rate = int(STREAM_FORMAT.split("_")[1])
+            if pcm_rate == audio_ingest.SAMPLE_RATE and audio_ingest.CHANNELS == 1:
+                _, elapsed, error = audio_ingest.write_pcm_wav(chunks, wav_path, pcm_rate)
+            else:
+                _, elapsed, error = audio_ingest.stream_to_wav(chunks, wav_path, ["-f", "s16le", "-ar", str(pcm_rate), "-ac", "1"])
+        else:
+            _, elapsed, error = audio_ingest.stream_to_wav(chunks, wav_path)
+    if error:
+        raise RuntimeError(f"Could not write {wav_path}: {error}")
+
+    if TTS_CACHE_ENABLED:
+        tts_cache.put(key, wav_path)
+    logger.info(f"Synthesized {len(text)} characters to {wav_path} in {elapsed:.2f}s")
+    return wav_path
+
+
+def text_to_speech_batch(items, output_dir, max_parallel=MAX_PARALLEL, model_id=MODEL_ID):
+    """
+    Synthesize many lines concurrently over the pooled session.
+
+    Args:
+    items (list): (text, voice_id, settings) tuples or TTSItem objects. Items without an
+        output_path are written to {output_dir}/{cache key}.mp3.
+    output_dir (str): Directory for the mp3 files.
+    max_parallel (int): Maximum number of requests in flight.
+
+    Returns:
+    list: (output_path, error or None) for every item, in input order.
+    """
+    items = [TTSItem(*item) for item in items]
+    os.makedirs(output_dir, exist_ok=True)
+
+    def run(item):
+        key = tts_cache_key(item.text, item.voice_id, model_id, item.settings)
+        output_path = item.output_path or os.path.join(output_dir, f"{key[:16]}.mp3")
+        try:
+            return synthesize(item.text, item.voice_id, output_path, item.settings, model_id), None
+        except Exception as e:
+            logger.error(f"TTS failed for {item.text[:40]!r}: {e}")
+            return output_path, str(e)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_parallel, len(items) or 1))) as executor:
+        results = list(executor.map(run, items))
+
+    failed = sum(1 for _, error in results if error)
+    logger.info(f"TTS batch: {len(items) - failed} of {len(items)} lines synthesized")
+    return results
+
+
+def text_to_speech(text_to_speak=TEXT_TO_SPEAK, voice_id=VOICE_ID, output_path=OUTPUT_PATH):
+    try:
+        synthesize(text_to_speak, voice_id, output_path)
         # Inform the user of success
         print("Audio stream saved successfully.")
-    else:
+    except (requests.RequestException, RuntimeError) as e:
         # Print the error message if the request was not successful
-        print(response.text)
+        print(e)
 
 def main():
     text = TEXT_TO_SPEAK
@@ -89,11 +284,11 @@ def main():
     output_path = OUTPUT_PATH
 
     script_dir = os.path.dirname(os.path.abspath(__file__))
-    output_path = os.path.join(script_dir, "input_audio_mp3", "tts.mp3")
+    output_path = os.path.join(script_dir, "input", "tts.wav")
 
     try:
-        # Call the text_to_speech function with the configured parameters
-        text_to_speech(text, voice_id, output_path)
+        # Write the SadTalker-ready WAV straight into the pipeline's input directory
+        synthesize_to_wav(text, voice_id, output_path)
         logger.info(f"Text-to-speech conversion completed. Audio saved to: {output_path}")
     except Exception as e:
         logger.error(f"An error occurred during text-to-speech conversion: {str(e)}")
@@ -0,0 +1,353 @@
+import asyncio
+import os
+import re
+import shutil
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+import audio_ingest
+import catalog
+import helpers
+import output_index
+import pipeline
+import preflight
+import worker_client
+from config_manager import config
+from metrics import metrics
+from logger import logger  # Import the logger
+
+# CONSTANTS
+API_HOST = config.get("API", "host", fallback="127.0.0.1")
+API_PORT = int(config.get("API", "port", fallback="8080"))
+UPLOAD_DIR = config.get("API", "upload_dir", fallback="uploads")
+OUTPUT_DIR = config.get("API", "output_dir", fallback="output")
+SADTALKER_CONCURRENCY = int(config.get("API", "sadtalker_concurrency", fallback="1"))
+LIVEPORTRAIT_CONCURRENCY = int(config.get("API", "liveportrait_concurrency", fallback="1"))
+MAX_PENDING_JOBS = int(config.get("API", "max_pending_jobs", fallback="32"))  # Further submissions get 429
+MAX_FINISHED_JOBS = int(config.get("API", "max_finished_jobs", fallback="1000"))  # Finished jobs kept in memory
+MAX_UPLOAD_MB = config.getfloat("API", "max_upload_mb", fallback=200.0)
+ALLOW_SERVER_PATHS = config.getboolean("API", "allow_server_paths", fallback=False)
+SERVER_PATH_ROOT = config.get("API", "server_path_root", fallback="")  # Empty = any readable file
+
+AUDIO_EXTENSIONS = (".wav", ".mp3")
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+UPLOAD_CHUNK_SIZE = 256 * 1024
+_SAFE_NAME = re.compile(r"[^A-Za-z0-9._-]+")
+
+
+class JobService:
+    """
+    Runs jobs through the SadTalker and LivePortrait stages from the event loop.
+
+    Each stage has its own semaphore, so at most SADTALKER_CONCURRENCY and
+    LIVEPORTRAIT_CONCURRENCY renders run at once, while uploads, conversions and
+    downloads for other jobs continue. The blocking stage functions run on a thread pool.
+    """
+
+    def __init__(self, sadTalker_dir, livePortrait_dir, inter_dir, output_dir,
+                 sadtalker_concurrency=SADTALKER_CONCURRENCY, liveportrait_concurrency=LIVEPORTRAIT_CONCURRENCY,
+                 sadtalker_worker=None, liveportrait_worker=None):
+        self.sadTalker_dir = sadTalker_dir
+        self.livePortrait_dir = livePortrait_dir
+        self.inter_dir = inter_dir
+        self.output_dir = output_dir
+        self.sadtalker_worker = sadtalker_worker
+        self.liveportrait_worker = liveportrait_worker
+        self.sadtalker_slots = asyncio.Semaphore(sadtalker_concurrency)
+        self.liveportrait_slots = asyncio.Semaphore(liveportrait_concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=sadtalker_concurrency + liveportrait_concurrency + 2,
+                                           thread_name_prefix="api-stage")
+        self.jobs = OrderedDict()
+        self._tasks = set()
+
+    def pending_count(self):
+        return sum(1 for job in self.jobs.values() if job.status not in ("done", "failed"))
+
+    def submit(self, job, upload_dir=None):
+        self.jobs[job.job_id] = job
+        job.status = "queued"
+        job.submitted_at = time.perf_counter()
+        task = asyncio.get_running_loop().create_task(self._run(job, upload_dir))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    def _progress_callback(self, job):
+        def report(event):
+            job.progress[event.stage] = event.percent
+        return report
+
+    async def _run(self, job, upload_dir=None):
+        loop = asyncio.get_running_loop()
+        try:
+            async with self.sadtalker_slots:
+                job.status = "sadtalker"
+                await loop.run_in_executor(self.executor, pipeline.condition_group_audio, [job], self.inter_dir)
+                await loop.run_in_executor(self.executor, lambda: pipeline.run_sadtalker_stage(
+                    job, self.sadTalker_dir, self.inter_dir, worker=self.sadtalker_worker,
+                    on_progress=self._progress_callback(job)))
+            job.status = "waiting"
+            async with self.liveportrait_slots:
+                job.status = "liveportrait"
+                await loop.run_in_executor(self.executor, lambda: pipeline.run_liveportrait_stage(
+                    job, self.livePortrait_dir, self.output_dir, worker=self.liveportrait_worker,
+                    on_progress=self._progress_callback(job)))
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+            logger.error(f"Job {job.job_id} failed: {e}")
+        else:
+            job.status = "done"
+            logger.info(f"Job {job.job_id} complete: {job.output_path}")
+            pipeline.log_completed_job(job)
+        metrics.record("job", time.perf_counter() - job.submitted_at, job_id=job.job_id,
+                       audio_duration=job.audio_duration, status="ok" if job.status == "done" else "error")
+        await loop.run_in_executor(self.executor, self._cleanup, job, upload_dir)
+        self._forget_finished()
+
+    def _cleanup(self, job, upload_dir):
+        # Intermediates go to the size-capped archive, as in batch runs. The request's
+        # upload directory only holds private copies of its inputs and is removed.
+        try:
+            pipeline.archive_job_intermediates(job, self.inter_dir)
+        except OSError as e:
+            logger.warning(f"Could not archive the intermediates of job {job.job_id}: {e}")
+        if upload_dir:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+
+    def _forget_finished(self):
+        # Oldest finished jobs are dropped first; their outputs stay findable through the output index
+        finished = [job_id for job_id, job in self.jobs.items() if job.status in ("done", "failed")]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job_id]
+
+    async def close(self):
+        if self._tasks:
+            logger.info(f"Waiting for {len(self._tasks)} running jobs")
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self.executor.shutdown(wait=True)
+
+
+def job_status(job):
+    return {
+        "job_id": job.job_id,
+        "status": job.status,
+        "progress": job.progress,
+        "audio": os.path.basename(job.audio_path),
+        "image": os.path.basename(job.image_path),
+        "audio_duration": job.audio_duration,
+        "tier": job.tier,
+        "output": os.path.basename(job.output_path) if job.output_path else None,
+        "error": job.error,
+    }
+
+
+def _safe_filename(filename, fallback):
+    name = _SAFE_NAME.sub("_", os.path.basename(filename or "")).lstrip(".")
+    return name or fallback
+
+
+async def _save_upload(field, dest_dir, extensions, limit):
+    filename = _safe_filename(field.filename, field.name)
+    if not filename.lower().endswith(extensions):
+        raise web.HTTPBadRequest(text=f"{field.name} must be one of {', '.join(extensions)}")
+    dest_path = os.path.join(dest_dir, filename)
+    size = 0
+    # Streamed in chunks and written under a temporary name, so large uploads never sit in memory
+    try:
+        with open(dest_path + ".part", "wb") as f:
+            while True:
+                chunk = await field.read_chunk(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > limit:
+                    raise web.HTTPRequestEntityTooLarge(max_size=limit, actual_size=size)
+                f.write(chunk)
+    except BaseException:
+        if os.path.exists(dest_path + ".part"):
+            os.remove(dest_path + ".part")
+        raise
+    os.replace(dest_path + ".part", dest_path)
+    return dest_path
+
+
+async def _read_multipart(request, upload_dir):
+    reader = await request.multipart()
+    paths = {}
+    limit = int(MAX_UPLOAD_MB * 1024 * 1024)
+    while True:
+        field = await reader.next()
+        if field is None:
+            break
+        if field.name == "audio":
+            paths["audio"] = await _save_upload(field, upload_dir, AUDIO_EXTENSIONS, limit)
+        elif field.name == "image":
+            paths["image"] = await _save_upload(field, upload_dir, IMAGE_EXTENSIONS, limit)
+        elif field.name == "tier":
+            paths["tier"] = (await field.text()).strip()
+    return paths
+
+
+async def _read_server_paths(request):
+    if not ALLOW_SERVER_PATHS:
+        raise web.HTTPForbidden(text="Server-side paths are disabled, upload the files instead")
+    try:
+        body = await request.json()
+        paths = {"audio": os.path.abspath(body["audio_path"]), "image": os.path.abspath(body["image_path"])}
+    except (ValueError, KeyError, TypeError):
+        raise web.HTTPBadRequest(text='Expected JSON: {"audio_path": ..., "image_path": ..., "tier": optional}')
+    root = os.path.realpath(SERVER_PATH_ROOT) if SERVER_PATH_ROOT else None
+    for kind, path in list(paths.items()):
+        if root and not os.path.realpath(path).startswith(root + os.sep):
+            raise web.HTTPForbidden(text=f"{kind} path is outside the allowed root")
+        if not os.path.isfile(path):
+            raise web.HTTPBadRequest(text=f"{kind} file not found: {path}")
+    if body.get("tier"):
+        paths["tier"] = str(body["tier"])
+    return paths
+
+
+async def create_job(request):
+    service = request.app["service"]
+    if service.pending_count() >= MAX_PENDING_JOBS:
+        raise web.HTTPTooManyRequests(text="Too many pending jobs, try again later")
+
+    # Every request gets its own directory for uploads and converted audio
+    upload_dir = os.path.join(request.app["upload_dir"], pipeline.new_job_id("upload"))
+    os.makedirs(upload_dir, exist_ok=True)
+    try:
+        if request.content_type.startswith("multipart/"):
+            paths = await _read_multipart(request, upload_dir)
+        else:
+            paths = await _read_server_paths(request)
+        if "audio" not in paths or "image" not in paths:
+            raise web.HTTPBadRequest(text="Both audio and image are required")
+
+        audio_path = paths["audio"]
+        if audio_path.lower().endswith(".mp3"):
+            wav_path = os.path.join(upload_dir, os.path.splitext(os.path.basename(audio_path))[0] + ".wav")
+            loop = asyncio.get_running_loop()
+            _, wav_path, elapsed, error = await loop.run_in_executor(None, audio_ingest.convert_to_wav, audio_path, wav_path)
+            if error:
+                raise web.HTTPBadRequest(text=f"Could not convert audio: {error}")
+            audio_path = wav_path
+
+        try:
+            job = pipeline.Job(audio_path, paths["image"], tier=paths.get("tier", ""))
+        except ValueError as e:
+            # Unknown quality tier
+            raise web.HTTPBadRequest(text=str(e))
+        try:
+            # Cheap CPU checks: bad inputs are refused here instead of failing after GPU time
+            await asyncio.get_running_loop().run_in_executor(None, preflight.preflight.check_job, job)
+        except preflight.PreflightError as e:
+            raise web.HTTPUnprocessableEntity(text=str(e))
+    except BaseException:
+        # Nothing of a rejected upload is kept
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        raise
+    job = service.submit(job, upload_dir)
+    logger.info(f"API job {job.job_id} submitted")
+    return web.json_response({"job_id": job.job_id, "status": job.status,
+                              "status_url": f"/jobs/{job.job_id}", "result_url": f"/jobs/{job.job_id}/result"},
+                             status=202)
+
+
+async def list_jobs(request):
+    service = request.app["service"]
+    return web.json_response({"jobs": [job_status(job) for job in service.jobs.values()]})
+
+
+async def get_job(request):
+    job_id = request.match_info["job_id"]
+    job = request.app["service"].jobs.get(job_id)
+    if job is not None:
+        return web.json_response(job_status(job))
+    output_path = output_index.index.lookup(job_id, "liveportrait")
+    if output_path:
+        return web.json_response({"job_id": job_id, "status": "done", "output": os.path.basename(output_path)})
+    raise web.HTTPNotFound(text=f"Unknown job: {job_id}")
+
+
+async def get_result(request):
+    job_id = request.match_info["job_id"]
+    job = request.app["service"].jobs.get(job_id)
+    if job is not None and job.status != "done":
+        raise web.HTTPConflict(text=f"Job {job_id} is {job.status}")
+    output_path = job.output_path if job is not None else output_index.index.lookup(job_id, "liveportrait")
+    if not output_path or not os.path.exists(output_path):
+        raise web.HTTPNotFound(text=f"No result for job: {job_id}")
+    return web.FileResponse(output_path, headers={"Content-Disposition": f'attachment; filename="{os.path.basename(output_path)}"'})
+
+
+async def list_renders(request):
+    """
+    Query the render catalog: /renders?audio=&image=&batch=&tier=&since=&until=&limit=
+    """
+    query = request.query
+    try:
+        limit = int(query.get("limit", "100"))
+        rows = await asyncio.get_running_loop().run_in_executor(None, lambda: catalog.catalog.query(
+            query.get("audio"), query.get("image"), query.get("batch"), query.get("since"), query.get("until"), limit,
+            query.get("tier")))
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    return web.json_response({"renders": rows})
+
+
+async def health(request):
+    service = request.app["service"]
+    return web.json_response({"status": "ok", "pending": service.pending_count()})
+
+
+def create_app(sadTalker_dir, livePortrait_dir, inter_dir, output_dir, upload_dir=UPLOAD_DIR):
+    app = web.Application(client_max_size=int(MAX_UPLOAD_MB * 1024 * 1024) * 2)
+    app["upload_dir"] = os.path.abspath(upload_dir)
+    os.makedirs(app["upload_dir"], exist_ok=True)
+
+    async def start_service(app):
+        # Keep one resident process per engine so models are loaded only once
+        sadtalker_worker = liveportrait_worker = None
+        if worker_client.WORKERS_ENABLED:
+            loop = asyncio.get_running_loop()
+            sadtalker_worker, liveportrait_worker = await loop.run_in_executor(
+                None, worker_client.start_workers, sadTalker_dir, livePortrait_dir)
+        app["workers"] = [worker for worker in (sadtalker_worker, liveportrait_worker) if worker is not None]
+        app["service"] = JobService(sadTalker_dir, livePortrait_dir, inter_dir, output_dir,
+                                    sadtalker_worker=sadtalker_worker, liveportrait_worker=liveportrait_worker)
+
+    async def stop_service(app):
+        await app["service"].close()
+        for worker in app["workers"]:
+            worker.stop()
+        metrics.export_prometheus()
+
+    app.on_startup.append(start_service)
+    app.on_cleanup.append(stop_service)
+    app.add_routes([
+        web.post("/jobs", create_job),
+        web.get("/jobs", list_jobs),
+        web.get("/jobs/{job_id}", get_job),
+        web.get("/jobs/{job_id}/result", get_result),
+        web.get("/renders", list_renders),
+        web.get("/health", health),
+    ])
+    return app
+
+
+def main():
+    output_dir = os.path.join(os.getcwd(), OUTPUT_DIR)
+    inter_dir = os.path.join(os.getcwd(), "intermediate_videos")
+    for directory in [output_dir, inter_dir]:
+        os.makedirs(directory, exist_ok=True)
+    parent_dir, pipeline_dir, sadTalker_dir, livePortrait_dir = helpers.get_directories()
+
+    app = create_app(sadTalker_dir, livePortrait_dir, inter_dir, output_dir)
+    logger.info(f"Starting API server on http://{API_HOST}:{API_PORT}")
+    web.run_app(app, host=API_HOST, port=API_PORT, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+import helpers
+import job_journal
+from config_manager import config
+from logger import logger  # Import the logger
+
+# CONSTANTS
+ARCHIVE_ENABLED = config.getboolean("Archive", "enabled", fallback=True)
+INDEX_PATH = config.get("Archive", "index_path", fallback="archive.sqlite3")
+MAX_SIZE_BYTES = int(config.getfloat("Archive", "max_size_gb", fallback=50.0) * 1024 ** 3)
+MAX_AGE_DAYS = config.getfloat("Archive", "max_age_days", fallback=30.0)  # 0 = keep forever
+ENFORCE_INTERVAL = config.getfloat("Archive", "enforce_interval", fallback=60.0)  # Seconds between retention passes
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    root TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    content_hash TEXT,
+    archived_at REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_last_access ON files (last_access);
+CREATE INDEX IF NOT EXISTS files_archived_at ON files (archived_at);
+CREATE INDEX IF NOT EXISTS files_name ON files (name);
+CREATE INDEX IF NOT EXISTS files_hash ON files (content_hash);
+"""
+
+
+class ArchiveManager:
+    """
+    Sharded, size- and age-capped archive for completed inputs and intermediates.
+
+    Files are stored as {completed_dir}/{YYYY-MM-DD}/{hash[:2]}/{name}, so no directory
+    grows past one day's files for one hash prefix. Every archived file is recorded in a
+    SQLite index with its size, content hash and last access time. The running total and
+    the retention passes work from the index alone, never by walking the archive trees.
+
+    A file counts as accessed when it is looked up (find) and when the same content is
+    archived again, i.e. an input was rendered again. Retention removes files older than
+    max_age_days, then evicts the least recently used files until the archive fits in
+    max_bytes. Files are kept if they are still referenced:
+    hard-linked into the result cache (more than one link), or the content of an input or
+    artifact of a job the journal lists as unfinished.
+    """
+
+    def __init__(self, index_path=INDEX_PATH, max_bytes=MAX_SIZE_BYTES, max_age_days=MAX_AGE_DAYS,
+                 enforce_interval=ENFORCE_INTERVAL):
+        self.index_path = index_path
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.enforce_interval = enforce_interval
+        self._connection = None
+        self._total_bytes = None
+        self._last_enforced = 0.0
+        self._lock = threading.RLock()
+
+    def _db(self):
+        if self._connection is None:
+            directory = os.path.dirname(self.index_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._connection = sqlite3.connect(self.index_path, timeout=30, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.executescript(SCHEMA)
+            self._total_bytes = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM files").fetchone()[0]
+        return self._connection
+
+    @staticmethod
+    def shard_dir(completed_dir, content_hash, when=None):
+        day = (when or datetime.now()).strftime("%Y-%m-%d")
+        return os.path.join(completed_dir, day, (content_hash or "00")[:2])
+
+    def store(self, source_path, completed_dir=None):
+        """
+        Move a file into its archive shard and index it.
+
+        Args:
+        source_path (str): File to archive.
+        completed_dir (str, optional): Archive root; defaults to a 'completed' directory next to the file.
+
+        Returns:
+        str: The destination path.
+        """
+        if completed_dir is None:
+            completed_dir = os.path.join(os.path.dirname(source_path), "completed")
+        completed_dir = os.path.abspath(completed_dir)
+        size = os.path.getsize(source_path)
+        content_hash = helpers.hash_file(source_path)
+        shard_dir = self.shard_dir(completed_dir, content_hash)
+        os.makedirs(shard_dir, exist_ok=True)
+
+        file = os.path.basename(source_path)
+        dest_path = os.path.join(shard_dir, file)
+        if os.path.exists(dest_path):
+            base_name, ext = os.path.splitext(file)
+            dest_path = os.path.join(shard_dir, f"{base_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}{ext}")
+        shutil.move(source_path, dest_path)
+
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            with db:
+                # Earlier copies of the same content were just used again
+                db.execute("UPDATE files SET last_access = ? WHERE content_hash = ?", (now, content_hash))
+                db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           (dest_path, completed_dir, os.path.basename(dest_path), size, content_hash, now, now))
+            self._total_bytes += size
+        logger.info(f"Moved {file} to {dest_path}")
+        self.enforce()
+        return dest_path
+
+    def find(self, name=None, content_hash=None):
+        """
+        Look up archived files by name or content hash, most recent first.
+        Found files count as accessed for LRU eviction.
+
+        Returns:
+        list: Paths of matching files that still exist.
+        """
+        if name is None and content_hash is None:
+            raise ValueError("Pass a name or a content hash")
+        column, value = ("name", name) if name is not None else ("content_hash", content_hash)
+        with self._lock:
+            db = self._db()
+            rows = db.execute(f"SELECT path FROM files WHERE {column} = ? ORDER BY archived_at DESC", (value,)).fetchall()
+            paths = [path for (path,) in rows if os.path.exists(path)]
+            with db:
+                db.executemany("UPDATE files SET last_access = ? WHERE path = ?", [(time.time(), path) for path in paths])
+        return paths
+
+    def _protected_hashes(self):
+        return job_journal.journal.referenced_hashes()
+
+    def _remove(self, path, size, root):
+        """
+        Delete one archived file. Returns False if it is hard-linked elsewhere (e.g. the result cache) and was kept.
+        """
+        try:
+            if os.stat(path).st_nlink > 1:
+                return False
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        db = self._db()
+        with db:
+            db.execute("DELETE FROM files WHERE path = ?", (path,))
+        self._total_bytes -= size
+        # Drop empty shard directories, but never the archive root
+        directory = os.path.dirname(path)
+        while directory.startswith(root + os.sep):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+        return True
+
+    def enforce(self, force=False):
+        """
+        Apply the age and size limits. Runs at most once per enforce_interval unless forced.
+
+        Returns:
+        int: Number of files removed.
+        """
+        with self._lock:
+            now = time.time()
+            if not force and now - self._last_enforced < self.enforce_interval:
+                return 0
+            self._last_enforced = now
+            db = self._db()
+            if not self.max_age_days and self._total_bytes <= self.max_bytes:
+                return 0
+
+            protected = self._protected_hashes()
+            removed = 0
+            if self.max_age_days:
+                cutoff = now - self.max_age_days * 86400
+                for path, size, content_hash, root in db.execute(
+                        "SELECT path, size, content_hash, root FROM files WHERE archived_at < ?", (cutoff,)).fetchall():
+                    if content_hash not in protected and self._remove(path, size, root):
+                        removed += 1
+
+            if self._total_bytes > self.max_bytes:
+                cursor = db.execute("SELECT path, size, content_hash, root FROM files ORDER BY last_access")
+                for path, size, content_hash, root in cursor.fetchall():
+                    if self._total_bytes <= self.max_bytes:
+                        break
+                    if content_hash not in protected and self._remove(path, size, root):
+                        removed += 1
+                if self._total_bytes > self.max_bytes:
+                    logger.warning(f"Archive is over its size cap ({self._total_bytes / 1024 ** 3:.1f} GB) "
+                                   f"but the remaining files are still referenced")
+
+            if removed:
+                logger.info(f"Archive retention removed {removed} files ({self._total_bytes / 1024 ** 3:.2f} GB kept)")
+            return removed
+
+    def adopt(self, completed_dir):
+        """
+        One-time migration: move the files of a flat 'completed' directory into shards.
+
+        Returns:
+        int: Number of files adopted.
+        """
+        adopted = 0
+        for name in os.listdir(completed_dir):
+            path = os.path.join(completed_dir, name)
+            if os.path.isfile(path):
+                self.store(path, completed_dir)
+                adopted += 1
+        return adopted
+
+    def stats(self):
+        with self._lock:
+            db = self._db()
+            rows = db.execute("SELECT root, COUNT(*), SUM(size) FROM files GROUP BY root").fetchall()
+        return {root: {"files": count, "bytes": size} for root, count, size in rows}
+
+
+archive = ArchiveManager()
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in ("stats", "enforce", "adopt"):
+        print("Usage: python archive.py stats | enforce | adopt <completed_dir> [completed_dir ...]")
+        sys.exit(1)
+
+    if sys.argv[1] == "adopt":
+        for completed_dir in sys.argv[2:]:
+            logger.info(f"Adopted {archive.adopt(completed_dir)} files from {completed_dir}")
+    elif sys.argv[1] == "enforce":
+        archive.enforce(force=True)
+    for root, values in archive.stats().items():
+        print(f"{root}: {values['files']} files, {values['bytes'] / 1024 ** 3:.2f} GB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+import json
+import os
+import sys
+import wave
+import numpy as np
+from config_manager import config
+from metrics import metrics
+from logger import logger  # Import the logger
+
+# CONSTANTS
+CONDITIONING_ENABLED = config.getboolean("Conditioning", "enabled", fallback=False)
+SILENCE_THRESHOLD_DB = config.getfloat("Conditioning", "silence_threshold_db", fallback=-40.0)  # Relative to full scale
+MAX_SILENCE_MS = config.getfloat("Conditioning", "max_silence_ms", fallback=400.0)  # Longer pauses are shortened to this
+NORMALIZE = config.getboolean("Conditioning", "normalize", fallback=True)
+TARGET_DBFS = config.getfloat("Conditioning", "target_dbfs", fallback=-20.0)  # RMS level of the speech
+PEAK_DBFS = config.getfloat("Conditioning", "peak_dbfs", fallback=-1.0)  # The gain never pushes peaks above this
+TIMING_MAP_DIR = config.get("Conditioning", "timing_map_dir", fallback="timing_maps")
+SAMPLE_RATE = int(config.get("Audio", "sample_rate", fallback="16000"))  # SadTalker loads audio at 16 kHz
+SILENCE_TIME = int(config.get("Values", "SILENCE_TIME"))
+VIDEO_FPS = 25  # SadTalker renders at 25 fps; removed stretches are whole video frames
+FRAME_MS = 10  # Energy analysis window
+RESAMPLE_TAPS = 64  # Low-pass filter length per side when downsampling
+
+
+def read_wav(wav_path):
+    """
+    Returns:
+    tuple: (samples as a float32 array of shape (frames, channels) in [-1, 1], sample rate)
+    """
+    with wave.open(wav_path, "rb") as wav_file:
+        channels = wav_file.getnchannels()
+        sample_rate = wav_file.getframerate()
+        sample_width = wav_file.getsampwidth()
+        data = wav_file.readframes(wav_file.getnframes())
+    if sample_width != 2:
+        raise ValueError(f"Expected 16-bit PCM, got {8 * sample_width}-bit: {wav_path}")
+    return np.frombuffer(data, dtype=np.int16).reshape(-1, channels).astype(np.float32) / 32768.0, sample_rate
+
+
+def resample(mono, source_rate, target_rate=SAMPLE_RATE):
+    """
+    Resample a mono track by windowed-sinc interpolation (low-passed when downsampling).
+    """
+    if source_rate == target_rate or len(mono) == 0:
+        return mono
+    ratio = target_rate / source_rate
+    cutoff = min(1.0, ratio)  # Fraction of the source Nyquist frequency that is kept
+    positions = np.arange(int(len(mono) * ratio)) / ratio
+    output = np.empty(len(positions), dtype=np.float32)
+    padded = np.pad(mono, RESAMPLE_TAPS)
+    offsets = np.arange(-RESAMPLE_TAPS + 1, RESAMPLE_TAPS + 1)
+    # Blocks bound the (samples x taps) working set
+    for start in range(0, len(positions), 65536):
+        block = positions[start:start + 65536]
+        base = np.floor(block).astype(np.int64)
+        taps = base[:, None] + offsets[None, :]
+        distance = block[:, None] - taps
+        weights = cutoff * np.sinc(cutoff * distance) * np.hanning(2 * RESAMPLE_TAPS + 2)[1:-1][None, :]
+        output[start:start + len(block)] = np.sum(padded[taps + RESAMPLE_TAPS] * weights, axis=1)
+    return output
+
+
+def silence_mask(mono, sample_rate, threshold_db=SILENCE_THRESHOLD_DB, frame_ms=FRAME_MS):
+    """
+    Returns:
+    tuple: (per-frame silent flags, frame length in samples, per-frame RMS level in dBFS)
+    """
+    frame_length = max(1, int(sample_rate * frame_ms / 1000))
+    frame_count = len(mono) // frame_length
+    rms = np.sqrt(np.mean(mono[:frame_count * frame_length].reshape(frame_count, frame_length) ** 2, axis=1))
+    level_db = 20 * np.log10(np.maximum(rms, 1e-10))
+    return level_db < threshold_db, frame_length, level_db
+
+
+def keep_mask(silent, frame_length, total, sample_rate, max_silence_ms=MAX_SILENCE_MS, lead_ms=SILENCE_TIME):
+    """
+    Mark the samples to keep: every silent run longer than max_silence_ms is shortened to it
+    by cutting its middle, so speech keeps its natural onset and decay. The leading silence is
+    kept up to at least lead_ms (the deliberate prefix added on ingest). Cuts are whole video frames.
+    """
+    padded = np.concatenate(([False], silent, [False]))
+    edges = np.flatnonzero(np.diff(padded.astype(np.int8)))
+    starts, ends = edges[0::2] * frame_length, edges[1::2] * frame_length
+    ends = np.where(ends >= len(silent) * frame_length, total, ends)  # A trailing run includes the partial frame
+
+    samples_per_video_frame = sample_rate // VIDEO_FPS
+    allowed = np.full(len(starts), int(sample_rate * max_silence_ms / 1000))
+    if len(starts) and starts[0] == 0:
+        allowed[0] = max(allowed[0], int(sample_rate * lead_ms / 1000))
+    excess = (ends - starts - allowed) // samples_per_video_frame * samples_per_video_frame
+    cut = excess > 0
+    cut_starts = starts[cut] + (ends[cut] - starts[cut] - excess[cut]) // 2
+    cut_ends = cut_starts + excess[cut]
+
+    # +1 where a cut starts, -1 where it ends; a positive running sum is inside a cut
+    delta = np.zeros(total + 1, dtype=np.int32)
+    np.add.at(delta, cut_starts, 1)
+    np.add.at(delta, cut_ends, -1)
+    return np.cumsum(delta[:-1]) <= 0
+
+
+def timing_segments(keep, sample_rate):
+    """
+    Returns:
+    list: [original_start, original_end, conditioned_start] in seconds for every kept stretch.
+    """
+    padded = np.concatenate(([False], keep, [False]))
+    edges = np.flatnonzero(np.diff(padded.astype(np.int8)))
+    starts, ends = edges[0::2], edges[1::2]
+    conditioned_starts = np.concatenate(([0], np.cumsum(ends - starts)[:-1]))
+    return [[round(float(start) / sample_rate, 4), round(float(end) / sample_rate, 4), round(float(new) / sample_rate, 4)]
+            for start, end, new in zip(starts, ends, conditioned_starts)]
+
+
+def to_conditioned(timing_map, seconds):
+    """
+    Map times of the original audio (e.g. caption cues) to the conditioned audio and the rendered video.
+    Times inside a removed pause land on the cut.
+    """
+    segments = np.asarray(timing_map["segments"], dtype=np.float64).reshape(-1, 3)
+    seconds = np.asarray(seconds, dtype=np.float64)
+    index = np.clip(np.searchsorted(segments[:, 0], seconds, side="right") - 1, 0, len(segments) - 1)
+    offset = np.clip(seconds - segments[index, 0], 0, segments[index, 1] - segments[index, 0])
+    return segments[index, 2] + offset
+
+
+def to_original(timing_map, seconds):
+    """
+    Map times of the conditioned audio (or rendered video) back to the original audio.
+    """
+    segments = np.asarray(timing_map["segments"], dtype=np.float64).reshape(-1, 3)
+    seconds = np.asarray(seconds, dtype=np.float64)
+    index = np.clip(np.searchsorted(segments[:, 2], seconds, side="right") - 1, 0, len(segments) - 1)
+    return segments[index, 0] + (seconds - segments[index, 2])
+
+
+def condition_audio(wav_path, output_path, map_path=None, max_silence_ms=MAX_SILENCE_MS,
+                    threshold_db=SILENCE_THRESHOLD_DB, normalize=NORMALIZE, sample_rate=SAMPLE_RATE):
+    """
+    Write a render-ready copy of a WAV: mono at SadTalker's sample rate, long pauses shortened
+    to max_silence_ms, speech normalized to TARGET_DBFS (peaks limited to PEAK_DBFS).
+
+    Args:
+    wav_path (str): Source WAV (16-bit PCM, any rate and channel count).
+    output_path (str): Conditioned WAV to write.
+    map_path (str, optional): Where to write the timing map (JSON) relating both time lines.
+
+    Returns:
+    dict: The timing map.
+    """
+    samples, source_rate = read_wav(wav_path)
+    mono = resample(samples.mean(axis=1), source_rate, sample_rate)
+
+    silent, frame_length, level_db = silence_mask(mono, sample_rate, threshold_db)
+    keep = keep_mask(silent, frame_length, len(mono), sample_rate, max_silence_ms)
+    conditioned = mono[keep]
+
+    gain_db = 0.0
+    if normalize and not silent.all():
+        speech_rms = np.sqrt(np.mean(10 ** (level_db[~silent] / 10)))
+        peak = float(np.max(np.abs(conditioned))) or 1.0
+        gain_db = min(TARGET_DBFS - 20 * np.log10(speech_rms), PEAK_DBFS - 20 * np.log10(peak))
+        conditioned = conditioned * np.float32(10 ** (gain_db / 20))
+
+    pcm = np.clip(np.round(conditioned * 32767), -32768, 32767).astype(np.int16)
+    tmp_path = output_path + ".part"
+    with wave.open(tmp_path, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(pcm.tobytes())
+    os.replace(tmp_path, output_path)
+
+    timing_map = {
+        "source": os.path.abspath(wav_path),
+        "conditioned": os.path.abspath(output_path),
+        "sample_rate": sample_rate,
+        "original_seconds": round(len(samples) / source_rate, 4),
+        "conditioned_seconds": round(len(pcm) / sample_rate, 4),
+        "gain_db": round(float(gain_db), 2),
+        "segments": timing_segments(keep, sample_rate),
+    }
+    if map_path:
+        directory = os.path.dirname(map_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(map_path + ".tmp", "w") as f:
+            json.dump(timing_map, f, indent=2)
+        os.replace(map_path + ".tmp", map_path)
+    return timing_map
+
+
+def condition_job(job, inter_dir, timing_map_dir=TIMING_MAP_DIR):
+    """
+    Condition a job's audio before SadTalker, if enabled. The engines then render
+    {inter_dir}/{job_id}_conditioned.wav (job.conditioned_audio_path) and the timing map is
+    written to {timing_map_dir}/{job_id}.json. On failure the original audio is rendered.
+
+    Returns:
+    bool: True if the job renders conditioned audio.
+    """
+    if not CONDITIONING_ENABLED or job.conditioned_audio_path:
+        return bool(job.conditioned_audio_path)
+    output_path = os.path.join(inter_dir, f"{job.job_id}_conditioned.wav")
+    map_path = os.path.join(timing_map_dir, f"{job.job_id}.json")
+    try:
+        with metrics.bind(job.job_id, job.audio_duration), metrics.span("audio_conditioning"):
+            timing_map = condition_audio(job.audio_path, output_path, map_path)
+    except (OSError, ValueError, wave.Error) as e:
+        logger.warning(f"Audio conditioning failed for job {job.job_id}, rendering the original audio: {e}")
+        return False
+
+    original, conditioned = timing_map["original_seconds"], timing_map["conditioned_seconds"]
+    logger.info(f"Conditioned audio of job {job.job_id}: {original:.2f}s -> {conditioned:.2f}s "
+                f"({100 * (1 - conditioned / original) if original else 0:.0f}% shorter, gain {timing_map['gain_db']:+.1f} dB)")
+    job.conditioned_audio_path = output_path
+    # The rendered length drives segmentation and the real-time-factor metrics
+    job.audio_duration = conditioned
+    job.params["audio_conditioning"] = {"original_seconds": original, "conditioned_seconds": conditioned,
+                                        "gain_db": timing_map["gain_db"], "timing_map": os.path.abspath(map_path)}
+    return True
+
+
+def main():
+    if len(sys.argv) < 3:
+        print("Usage: python audio_conditioning.py <input.wav> <output.wav> [timing_map.json]")
+        sys.exit(1)
+    timing_map = condition_audio(sys.argv[1], sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
+    print(f"{timing_map['original_seconds']:.2f}s -> {timing_map['conditioned_seconds']:.2f}s, "
+          f"{len(timing_map['segments'])} kept stretches, gain {timing_map['gain_db']:+.1f} dB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import os
+import subprocess
+import threading
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from config_manager import config
+from metrics import metrics
+from logger import logger  # Import the logger
+
+# CONSTANTS
+FFMPEG = config.get("Audio", "ffmpeg", fallback="ffmpeg")
+SAMPLE_RATE = int(config.get("Audio", "sample_rate", fallback="16000"))  # SadTalker loads audio at 16 kHz
+CHANNELS = int(config.get("Audio", "channels", fallback="1"))
+INGEST_WORKERS = int(config.get("Audio", "ingest_workers", fallback="0")) or os.cpu_count() or 1
+SILENCE_TIME = int(config.get("Values", "SILENCE_TIME"))
+
+
+def ffmpeg_wav_args(silence_ms=SILENCE_TIME, sample_rate=SAMPLE_RATE, channels=CHANNELS):
+    """
+    Returns the ffmpeg output options that prepend silence and write SadTalker-ready PCM WAV.
+
+    The silence is added by the adelay filter while streaming, so the track is
+    never held in memory as a whole.
+    """
+    args = []
+    if silence_ms > 0:
+        args += ["-af", f"adelay=delays={silence_ms}:all=1"]
+    return args + ["-ar", str(sample_rate), "-ac", str(channels), "-c:a", "pcm_s16le", "-f", "wav"]
+
+
+def convert_to_wav(src_path, wav_path, silence_ms=SILENCE_TIME):
+    """
+    Convert one audio file to WAV with ffmpeg. The WAV is written under a temporary name
+    and renamed when complete, so readers never see a partial file.
+
+    Returns:
+    tuple: (src_path, wav_path, elapsed_seconds, error or None)
+    """
+    start = time.perf_counter()
+    tmp_path = wav_path + ".part"
+    command = [FFMPEG, "-hide_banner", "-loglevel", "error", "-nostdin", "-y", "-i", src_path] \
+        + ffmpeg_wav_args(silence_ms) + [tmp_path]
+    try:
+        process = subprocess.run(command, capture_output=True, text=True)
+    except OSError as e:
+        return src_path, wav_path, time.perf_counter() - start, str(e)
+
+    if process.returncode != 0:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return src_path, wav_path, time.perf_counter() - start, process.stderr.strip()
+
+    os.replace(tmp_path, wav_path)
+    return src_path, wav_path, time.perf_counter() - start, None
+
+
+def mux_audio(video_path, audio_path):
+    """
+    Replace the audio track of a video with audio_path, copying the video stream (no re-encode).
+    The video is rewritten in place.
+
+    Returns:
+    str: An error message, or None on success.
+    """
+    tmp_path = os.path.splitext(video_path)[0] + ".mux.mp4"
+    command = [FFMPEG, "-hide_banner", "-loglevel", "error", "-nostdin", "-y", "-i", video_path, "-i", audio_path,
+               "-map", "0:v:0", "-map", "1:a:0", "-c:v", "copy", "-c:a", "aac", "-shortest",
+               "-movflags", "+faststart", tmp_path]
+    try:
+        process = subprocess.run(command, capture_output=True, text=True)
+    except OSError as e:
+        return str(e)
+    if process.returncode != 0:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return process.stderr.strip()
+    os.replace(tmp_path, video_path)
+    return None
+
+
+def write_pcm_wav(chunks, wav_path, pcm_rate=SAMPLE_RATE, silence_ms=SILENCE_TIME):
+    """
+    Write a stream of raw 16-bit mono PCM chunks to a WAV file, prefixed with silence.
+    No decoding is needed, so the WAV is complete as soon as the last chunk arrives.
+
+    Returns:
+    tuple: (wav_path, elapsed_seconds, error or None)
+    """
+    start = time.perf_counter()
+    tmp_path = wav_path + ".part"
+    try:
+        with wave.open(tmp_path, "wb") as wav_file:
+            wav_file.setnchannels(1)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(pcm_rate)
+            wav_file.writeframes(b"\0\0" * (pcm_rate * silence_ms // 1000))
+            carry = b""
+            for chunk in chunks:
+                # Chunks can split a sample; keep the odd byte for the next chunk
+                data = carry + chunk
+                cut = len(data) - len(data) % 2
+                wav_file.writeframes(data[:cut])
+                carry = data[cut:]
+    except Exception as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return wav_path, time.perf_counter() - start, str(e)
+    os.replace(tmp_path, wav_path)
+    return wav_path, time.perf_counter() - start, None
+
+
+def stream_to_wav(chunks, wav_path, input_args=(), silence_ms=SILENCE_TIME):
+    """
+    Decode an audio stream (e.g. MP3 chunks from an HTTP response) with ffmpeg while it
+    arrives, and write the SadTalker-ready WAV. Nothing is written to disk but the WAV.
+
+    Args:
+    chunks (iterable): Encoded audio bytes.
+    input_args (sequence): ffmpeg input options for formats it cannot probe, e.g. raw PCM.
+
+    Returns:
+    tuple: (wav_path, elapsed_seconds, error or None)
+    """
+    start = time.perf_counter()
+    tmp_path = wav_path + ".part"
+    command = [FFMPEG, "-hide_banner", "-loglevel", "error", "-y"] + list(input_args) + ["-i", "pipe:0"] \
+        + ffmpeg_wav_args(silence_ms) + [tmp_path]
+    try:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except OSError as e:
+        return wav_path, time.perf_counter() - start, str(e)
+
+    # Drain stderr on a thread, so a chatty ffmpeg can never block on a full pipe
+    stderr = []
+    reader = threading.Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)
+    reader.start()
+    error = None
+    try:
+        for chunk in chunks:
+            process.stdin.write(chunk)
+    except BrokenPipeError:
+        pass  # ffmpeg exited early; its stderr says why
+    except Exception as e:
+        error = str(e)
+        process.kill()
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+    returncode = process.wait()
+    reader.join()
+
+    if error is None and returncode != 0:
+        error = b"".join(stderr).decode("utf-8", errors="replace").strip() or f"ffmpeg exited with {returncode}"
+    if error:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return wav_path, time.perf_counter() - start, error
+    os.replace(tmp_path, wav_path)
+    return wav_path, time.perf_counter() - start, None
+
+
+def convert_files(pairs, workers=INGEST_WORKERS, silence_ms=SILENCE_TIME):
+    """
+    Convert (src_path, wav_path) pairs in parallel on a process pool.
+
+    Yields:
+    tuple: (src_path, wav_path, elapsed_seconds, error or None) as each conversion finishes.
+    """
+    if not pairs:
+        return
+    workers = max(1, min(workers, len(pairs)))
+    logger.info(f"Converting {len(pairs)} audio files with {workers} workers")
+
+    start = time.perf_counter()
+    total_audio_time = 0.0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(convert_to_wav, src_path, wav_path, silence_ms) for src_path, wav_path in pairs]
+        for future in as_completed(futures):
+            src_path, wav_path, elapsed, error = future.result()
+            total_audio_time += elapsed
+            metrics.record("audio_convert", elapsed, status="error" if error else "ok", file=os.path.basename(src_path))
+            if error:
+                logger.error(f"Failed to convert {os.path.basename(src_path)} ({elapsed:.2f}s): {error}")
+            else:
+                logger.info(f"Converted {os.path.basename(src_path)} to {os.path.basename(wav_path)} in {elapsed:.2f}s")
+            yield src_path, wav_path, elapsed, error
+
+    wall_time = time.perf_counter() - start
+    logger.info(f"Audio ingestion: {len(pairs)} files in {wall_time:.2f}s wall, {total_audio_time:.2f}s total conversion time")
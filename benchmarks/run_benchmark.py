@@ -0,0 +1,263 @@
+"""
+Benchmark the orchestration layer against stub SadTalker/LivePortrait engines.
+
+The stubs in benchmarks/stubs accept the real command lines, sleep for a synthetic
+render time and write correctly named videos, so everything around the engines
+(interpreter startup, conda env resolution, file discovery, moves, cleanup) runs
+for real on a CPU-only machine. Per-stage timings come from the metrics trace.
+
+Usage:
+    python benchmarks/run_benchmark.py [--sadtalker-delay 1.0] [--liveportrait-delay 1.0]
+                                       [--repeat 3] [--input-sizes 0,100,1000]
+                                       [--batch-sizes 1,4,8] [--json results.json]
+"""
+import argparse
+import configparser
+import csv
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+STUBS_DIR = os.path.join(BENCH_DIR, "stubs")
+TEMPLATE_SOURCE_DIR = os.path.join(REPO_DIR, "SadTalker_default_source")
+
+# Spans reported per run (recorded by metrics.py)
+REPORTED_SPANS = [
+    "process_audio", "discover_inputs",
+    "sadtalker", "sadtalker.conda_env", "sadtalker.exec", "sadtalker.collect",
+    "liveportrait", "liveportrait.conda_env", "liveportrait.exec", "liveportrait.collect",
+    "cleanup",
+]
+TOP_LEVEL_SPANS = ["process_audio", "discover_inputs", "sadtalker", "liveportrait", "cleanup"]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+
+def write_wav(path, seconds, sample_rate=16000):
+    with wave.open(path, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(b"\0\0" * int(seconds * sample_rate))
+
+
+def template_image():
+    images = sorted(f for f in os.listdir(TEMPLATE_SOURCE_DIR) if f.lower().endswith((".png", ".jpg", ".jpeg")))
+    return os.path.join(TEMPLATE_SOURCE_DIR, images[0])
+
+
+class Workspace:
+    """
+    A throwaway pipeline directory with stub engines, its own config.ini and metrics trace.
+    """
+
+    def __init__(self, root, sadtalker_delay, liveportrait_delay, use_conda=False, use_cache=False):
+        self.root = root
+        self.home_dir = os.path.join(root, "home")
+        self.work_dir = os.path.join(root, "pipeline")
+        self.trace_path = os.path.join(self.work_dir, "metrics", "trace.jsonl")
+        self.log_path = os.path.join(root, "runs.log")
+
+        for engine, delay in (("SadTalker", sadtalker_delay), ("LivePortrait", liveportrait_delay)):
+            engine_dir = os.path.join(self.home_dir, engine)
+            shutil.copytree(os.path.join(STUBS_DIR, engine), engine_dir)
+            with open(os.path.join(engine_dir, "bench_stub.json"), "w") as f:
+                json.dump({"delay": delay}, f)
+
+        os.makedirs(self.work_dir)
+        shutil.copytree(TEMPLATE_SOURCE_DIR, os.path.join(self.work_dir, "SadTalker_default_source"))
+        self._write_config(use_conda, use_cache)
+
+    def _write_config(self, use_conda, use_cache):
+        config = configparser.ConfigParser()
+        config.read(os.path.join(REPO_DIR, "config.ini"))
+        overrides = {
+            "Paths": {"home_dir": self.home_dir},
+            "SadTalker": {"output_path": os.path.join(self.home_dir, "SadTalker", "results")},
+            "Conda": {"enabled": str(use_conda).lower()},
+            "Cache": {"enabled": str(use_cache).lower()},
+            "Workers": {"enabled": "false"},
+            "Metrics": {"enabled": "true", "trace_path": self.trace_path, "export_interval": "3600"},
+        }
+        for section, values in overrides.items():
+            if not config.has_section(section):
+                config.add_section(section)
+            for key, value in values.items():
+                config.set(section, key, value)
+        with open(os.path.join(self.work_dir, "config.ini"), "w") as f:
+            config.write(f)
+
+    def reset(self):
+        for name in ("input", "output", "intermediate_videos", "metrics"):
+            shutil.rmtree(os.path.join(self.work_dir, name), ignore_errors=True)
+        input_dir = os.path.join(self.work_dir, "input")
+        os.makedirs(input_dir)
+        os.makedirs(os.path.join(self.work_dir, "output"))
+        return input_dir
+
+    def add_filler_inputs(self, input_dir, count):
+        """
+        Add older audio/image pairs, so discovery and cleanup see a larger input directory.
+        """
+        old = time.time() - 3600
+        image = template_image()
+        for i in range(count):
+            for path in (os.path.join(input_dir, f"filler_{i:05d}.wav"), os.path.join(input_dir, f"filler_{i:05d}.png")):
+                if path.endswith(".wav"):
+                    write_wav(path, 0.01)
+                else:
+                    shutil.copy(image, path)
+                os.utime(path, (old, old))
+
+    def run(self, args):
+        start = time.perf_counter()
+        with open(self.log_path, "a") as log:
+            process = subprocess.run([sys.executable] + args, cwd=self.work_dir, stdout=log, stderr=subprocess.STDOUT)
+        wall = time.perf_counter() - start
+        if process.returncode != 0:
+            raise RuntimeError(f"{' '.join(args)} exited with {process.returncode}, see {self.log_path}")
+        return wall, self.read_spans()
+
+    def read_spans(self):
+        spans = []
+        if os.path.exists(self.trace_path):
+            with open(self.trace_path, "r") as f:
+                spans = [json.loads(line) for line in f if line.strip()]
+        return spans
+
+
+def span_totals(spans):
+    totals = {}
+    for span in spans:
+        totals[span["stage"]] = totals.get(span["stage"], 0.0) + span["duration"]
+    return totals
+
+
+def bench_single(workspace, input_size, audio_seconds, repeat):
+    """
+    Time main.py end to end for one audio/image pair, with input_size older pairs in the input directory.
+    """
+    runs = []
+    for _ in range(repeat):
+        input_dir = workspace.reset()
+        workspace.add_filler_inputs(input_dir, input_size)
+        write_wav(os.path.join(input_dir, "bench.wav"), audio_seconds)
+        shutil.copy(template_image(), os.path.join(input_dir, "bench.png"))
+
+        wall, spans = workspace.run([os.path.join(REPO_DIR, "main.py"), "input", "output"])
+        totals = span_totals(spans)
+        totals["end_to_end"] = wall
+        totals["interpreter"] = wall - sum(totals.get(stage, 0.0) for stage in TOP_LEVEL_SPANS)
+        runs.append(totals)
+    return runs
+
+
+def bench_batch(workspace, batch_size, audio_seconds, repeat):
+    """
+    Time pipeline.py for a manifest of batch_size audio/image pairs.
+    """
+    runs = []
+    for _ in range(repeat):
+        input_dir = workspace.reset()
+        shutil.copy(template_image(), os.path.join(input_dir, "bench.png"))
+        manifest_path = os.path.join(workspace.work_dir, "manifest.csv")
+        with open(manifest_path, "w", newline="") as f:
+            writer = csv.writer(f)
+            for i in range(batch_size):
+                write_wav(os.path.join(input_dir, f"bench_{i:04d}.wav"), audio_seconds)
+                writer.writerow([f"bench_{i:04d}.wav", "bench.png"])
+
+        wall, spans = workspace.run([os.path.join(REPO_DIR, "pipeline.py"), manifest_path, "input", "output"])
+        jobs = [span for span in spans if span["stage"] == "job"]
+        if len(jobs) != batch_size or any(span["status"] != "ok" for span in jobs):
+            raise RuntimeError(f"Batch of {batch_size} did not complete, see {workspace.log_path}")
+        runs.append({"end_to_end": wall, "job_p50": percentile([span["duration"] for span in jobs], 0.5),
+                     "job_p95": percentile([span["duration"] for span in jobs], 0.95)})
+    return runs
+
+
+def summarize(runs, key):
+    values = [run[key] for run in runs if run.get(key) is not None]
+    return percentile(values, 0.5) if values else None
+
+
+def format_seconds(value):
+    return "-" if value is None else f"{value:8.3f}"
+
+
+def input_sizes(value):
+    return [int(size) for size in value.split(",") if size.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pipeline orchestration with stub engines")
+    parser.add_argument("--sadtalker-delay", type=float, default=1.0, help="Synthetic SadTalker render time (s)")
+    parser.add_argument("--liveportrait-delay", type=float, default=1.0, help="Synthetic LivePortrait render time (s)")
+    parser.add_argument("--audio-seconds", type=float, default=5.0, help="Length of the generated input audio")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per scenario (the median is reported)")
+    parser.add_argument("--input-sizes", default="0,100,1000", help="Extra audio/image pairs in the input directory")
+    parser.add_argument("--batch-sizes", default="1,4,8", help="Manifest sizes for pipeline.py (empty to skip)")
+    parser.add_argument("--conda", action="store_true", help="Resolve the engines' conda envs like a real run")
+    parser.add_argument("--cache", action="store_true", help="Keep the result cache enabled")
+    parser.add_argument("--keep", action="store_true", help="Keep the benchmark workspace")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="avatar_bench_")
+    workspace = Workspace(root, args.sadtalker_delay, args.liveportrait_delay, args.conda, args.cache)
+    engine_time = args.sadtalker_delay + args.liveportrait_delay
+    results = {"settings": vars(args), "single": {}, "batch": {}}
+
+    try:
+        print(f"Stub engines: SadTalker {args.sadtalker_delay:.2f}s, LivePortrait {args.liveportrait_delay:.2f}s "
+              f"(workspace {root})")
+
+        print("\nmain.py, one pair, by input directory size (median seconds)")
+        print(f"{'stage':<24}" + "".join(f"{size:>10}" for size in input_sizes(args.input_sizes)))
+        table = {}
+        for size in input_sizes(args.input_sizes):
+            runs = bench_single(workspace, size, args.audio_seconds, args.repeat)
+            table[size] = {key: summarize(runs, key) for key in ["end_to_end", "interpreter"] + REPORTED_SPANS}
+            table[size]["overhead"] = table[size]["end_to_end"] - engine_time
+            results["single"][size] = {"median": table[size], "runs": runs}
+        for key in ["end_to_end", "overhead", "interpreter"] + REPORTED_SPANS:
+            print(f"{key:<24}" + "".join(f"  {format_seconds(table[size].get(key))}" for size in table))
+
+        batch_sizes = input_sizes(args.batch_sizes)
+        if batch_sizes:
+            print("\npipeline.py, manifest batches (median seconds)")
+            print(f"{'batch':>6}{'wall':>10}{'ideal':>10}{'overhead':>10}{'per job':>10}{'job p95':>10}")
+            for size in batch_sizes:
+                runs = bench_batch(workspace, size, args.audio_seconds, args.repeat)
+                wall = summarize(runs, "end_to_end")
+                # Two pipelined stages: the slower one sets the pace after the first job
+                ideal = size * max(args.sadtalker_delay, args.liveportrait_delay) + min(args.sadtalker_delay, args.liveportrait_delay)
+                results["batch"][size] = {"wall": wall, "ideal": ideal, "runs": runs}
+                print(f"{size:>6}  {format_seconds(wall)}  {format_seconds(ideal)}  {format_seconds(wall - ideal)}"
+                      f"  {format_seconds(wall / size)}  {format_seconds(summarize(runs, 'job_p95'))}")
+    finally:
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2)
+            print(f"\nResults written to {args.json}")
+        if args.keep:
+            print(f"Workspace kept at {root}")
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Stand-in for LivePortrait's inference.py used by the benchmarks.
+
+Accepts the same command line as the real script, sleeps for a synthetic render time
+and writes dummy {output_dir}/{source}--{driving}.mp4 and _concat.mp4 videos and a
+{driving}.pkl motion template, like LivePortrait does. The delay is read from
+bench_stub.json next to this file:
+
+    {"delay": 1.0, "progress_steps": 20}
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+STUB_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_stub.json")
+
+
+def load_stub_config():
+    try:
+        with open(STUB_CONFIG, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def basename(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--source", required=True)
+    parser.add_argument("-d", "--driving", required=True)
+    parser.add_argument("-o", "--output_dir", default="animations/")
+    parser.add_argument("--flag_crop_driving_video", action="store_true")
+    args, _ = parser.parse_known_args()
+
+    for path in (args.source, args.driving):
+        if not os.path.exists(path):
+            sys.exit(f"No such file: {path}")
+
+    stub_config = load_stub_config()
+    delay = stub_config.get("delay", 1.0)
+    steps = max(1, int(stub_config.get("progress_steps", 20)))
+
+    # Same stderr shape as LivePortrait's rich progress bar
+    for step in range(1, steps + 1):
+        time.sleep(delay / steps)
+        sys.stderr.write(f"\rAnimating... ━━━━━━━━━━ {100 * step // steps}% 0:00:00")
+        sys.stderr.flush()
+    sys.stderr.write("\n")
+
+    # Like LivePortrait, save a motion template next to a driving video; a .pkl driving input has no concat video
+    if not args.driving.endswith(".pkl"):
+        with open(os.path.splitext(args.driving)[0] + ".pkl", "wb") as f:
+            f.write(b"stub motion template\n")
+    os.makedirs(args.output_dir, exist_ok=True)
+    name = f"{basename(args.source)}--{basename(args.driving)}"
+    for suffix in ("",) if args.driving.endswith(".pkl") else ("", "_concat"):
+        with open(os.path.join(args.output_dir, f"{name}{suffix}.mp4"), "wb") as f:
+            f.write(b"stub liveportrait video\n")
+    print(f"Animated video: {os.path.join(args.output_dir, name + '.mp4')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Stand-in for SadTalker's inference.py used by the benchmarks.
+
+Accepts the same command line as the real script, sleeps for a synthetic render time
+and writes a dummy video named the way SadTalker names it
+({result_dir}/{%Y_%m_%d_%H.%M.%S}.mp4). The delay is read from bench_stub.json next
+to this file:
+
+    {"delay": 1.0, "delay_per_audio_second": 0.0, "progress_steps": 20}
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import wave
+from time import strftime
+
+STUB_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_stub.json")
+
+
+def load_stub_config():
+    try:
+        with open(STUB_CONFIG, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def audio_duration(audio_path):
+    try:
+        with wave.open(audio_path, "rb") as wav_file:
+            return wav_file.getnframes() / float(wav_file.getframerate())
+    except (OSError, EOFError, wave.Error, ZeroDivisionError):
+        return 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--driven_audio", required=True)
+    parser.add_argument("--source_image", required=True)
+    parser.add_argument("--result_dir", default="./results")
+    parser.add_argument("--ref_eyeblink", default=None)
+    parser.add_argument("--ref_pose", default=None)
+    parser.add_argument("--still", action="store_true")
+    parser.add_argument("--preprocess", default="crop")
+    parser.add_argument("--expression_scale", type=float, default=1.0)
+    args, _ = parser.parse_known_args()
+
+    for path in (args.driven_audio, args.source_image):
+        if not os.path.exists(path):
+            sys.exit(f"No such file: {path}")
+
+    stub_config = load_stub_config()
+    delay = stub_config.get("delay", 1.0) + stub_config.get("delay_per_audio_second", 0.0) * audio_duration(args.driven_audio)
+    steps = max(1, int(stub_config.get("progress_steps", 20)))
+
+    # Same stderr shape as SadTalker's tqdm bars, so progress parsing is exercised too
+    for step in range(1, steps + 1):
+        time.sleep(delay / steps)
+        sys.stderr.write(f"\rFace Renderer:: {100 * step // steps}%|##| {step}/{steps} [00:00<00:00]")
+        sys.stderr.flush()
+    sys.stderr.write("\n")
+
+    os.makedirs(args.result_dir, exist_ok=True)
+    output_path = os.path.join(args.result_dir, strftime("%Y_%m_%d_%H.%M.%S") + ".mp4")
+    with open(output_path, "wb") as f:
+        f.write(b"stub sadtalker video\n")
+    print(f"The generated video is named: {output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Local stand-in for the ElevenLabs text-to-speech API, for exercising TTS_API without network access.
+
+Point [TTS] base_url at it (e.g. http://127.0.0.1:8089). Each synthesis request sleeps for
+--delay seconds and streams fake audio derived from the request. --fail-every N answers every
+Nth request with 429 (alternating with 503) to exercise retries.
+
+Usage:
+    python benchmarks/stubs/tts_server.py [--port 8089] [--delay 0.5] [--fail-every 0]
+"""
+import argparse
+import hashlib
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubTTSHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like the real API
+    delay = 0.5
+    fail_every = 0
+    audio_size = 256 * 1024
+    requests_seen = 0
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        sys.stderr.write(f"[stub-tts] {format % args}\n")
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/v1/voices":
+            self._send_json(200, {"voices": [{"name": "Stub", "voice_id": "stub-voice"}]})
+        else:
+            self._send_json(404, {"detail": "not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        parts = self.path.strip("/").split("/")
+        if len(parts) < 3 or parts[:2] != ["v1", "text-to-speech"]:
+            self._send_json(404, {"detail": "not found"})
+            return
+
+        cls = type(self)
+        with cls.lock:
+            cls.requests_seen += 1
+            count = cls.requests_seen
+        if cls.fail_every and count % cls.fail_every == 0:
+            status = 429 if (count // cls.fail_every) % 2 else 503
+            self._send_json(status, {"detail": "stub failure"}, {"Retry-After": "0"})
+            return
+
+        time.sleep(cls.delay)
+        seed = hashlib.sha256(body).digest()
+        audio = (seed * (cls.audio_size // len(seed) + 1))[:cls.audio_size]
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/mpeg")
+        self.send_header("Content-Length", str(len(audio)))
+        self.end_headers()
+        for offset in range(0, len(audio), 16 * 1024):
+            self.wfile.write(audio[offset:offset + 16 * 1024])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub ElevenLabs TTS server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--delay", type=float, default=0.5, help="Seconds per synthesis request")
+    parser.add_argument("--fail-every", type=int, default=0, help="Fail every Nth request with 429/503")
+    args = parser.parse_args()
+
+    StubTTSHandler.delay = args.delay
+    StubTTSHandler.fail_every = args.fail_every
+    server = ThreadingHTTPServer((args.host, args.port), StubTTSHandler)
+    print(f"Stub TTS server on http://{args.host}:{args.port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+import argparse
+import csv
+import json
+import os
+import re
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+import helpers
+from config_manager import config
+from logger import logger  # Import the logger
+
+# CONSTANTS
+CATALOG_ENABLED = config.getboolean("Catalog", "enabled", fallback=True)
+CATALOG_PATH = config.get("Catalog", "path", fallback="catalog.sqlite3")
+LEGACY_LOG_PATH = config.get("Batch", "output_log", fallback="output_list.log")
+_HASH = re.compile(r"^[0-9a-f]{64}$")
+_RELATIVE = re.compile(r"^(\d+)([hdw])$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS renders (
+    id INTEGER PRIMARY KEY,
+    job_id TEXT UNIQUE,
+    batch_id TEXT,
+    created_at TEXT NOT NULL,
+    audio_name TEXT,
+    audio_path TEXT,
+    audio_hash TEXT,
+    image_name TEXT,
+    image_path TEXT,
+    image_hash TEXT,
+    output_path TEXT NOT NULL,
+    tier TEXT,
+    audio_duration REAL,
+    sadtalker_seconds REAL,
+    liveportrait_seconds REAL,
+    total_seconds REAL,
+    params TEXT,
+    source TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS renders_audio_hash ON renders (audio_hash, created_at);
+CREATE INDEX IF NOT EXISTS renders_image_hash ON renders (image_hash, created_at);
+CREATE INDEX IF NOT EXISTS renders_audio_name ON renders (audio_name, created_at);
+CREATE INDEX IF NOT EXISTS renders_image_name ON renders (image_name, created_at);
+CREATE INDEX IF NOT EXISTS renders_batch ON renders (batch_id, created_at);
+CREATE INDEX IF NOT EXISTS renders_created ON renders (created_at);
+CREATE TABLE IF NOT EXISTS imports (
+    path TEXT PRIMARY KEY,
+    imported_at TEXT NOT NULL,
+    rows INTEGER NOT NULL
+);
+"""
+
+_COLUMNS = ("job_id", "batch_id", "created_at", "audio_name", "audio_path", "audio_hash", "image_name", "image_path",
+            "image_hash", "output_path", "tier", "audio_duration", "sadtalker_seconds", "liveportrait_seconds", "total_seconds",
+            "params", "source")
+
+
+def _hash_or_none(path):
+    try:
+        return helpers.hash_file(path) if path and os.path.isfile(path) else None
+    except OSError:
+        return None
+
+
+def parse_time(value):
+    """
+    Parse a query bound: an ISO date/time ("2026-10-01", "2026-10-01T12:00") or a
+    relative age ("12h", "7d", "2w").
+
+    Returns:
+    str: An ISO timestamp comparable with renders.created_at.
+    """
+    match = _RELATIVE.match(value)
+    if match:
+        amount, unit = int(match.group(1)), match.group(2)
+        delta = {"h": timedelta(hours=amount), "d": timedelta(days=amount), "w": timedelta(weeks=amount)}[unit]
+        return (datetime.now() - delta).isoformat(timespec="seconds")
+    return datetime.fromisoformat(value).isoformat(timespec="seconds")
+
+
+class Catalog:
+    """
+    Indexed record of every finished render, in SQLite.
+
+    One row per render with its inputs (name, path, content hash), batch, render parameters,
+    stage durations and output path. Lookups by audio, image, batch or date use an index,
+    so they stay fast however long the history grows. The legacy output log is imported
+    the first time the catalog is opened.
+    """
+
+    def __init__(self, path=CATALOG_PATH, legacy_log_path=LEGACY_LOG_PATH, enabled=CATALOG_ENABLED):
+        self.path = path
+        self.legacy_log_path = legacy_log_path
+        self.enabled = enabled
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _db(self):
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.row_factory = sqlite3.Row
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(SCHEMA)
+            # Catalogs created before quality tiers
+            if "tier" not in {row["name"] for row in self._connection.execute("PRAGMA table_info(renders)")}:
+                self._connection.execute("ALTER TABLE renders ADD COLUMN tier TEXT")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS renders_tier ON renders (tier, created_at)")
+            if self.legacy_log_path:
+                self._import_log(self.legacy_log_path)
+        return self._connection
+
+    def _insert(self, rows):
+        placeholders = ", ".join("?" * len(_COLUMNS))
+        with self._connection:
+            self._connection.executemany(
+                f"INSERT OR REPLACE INTO renders ({', '.join(_COLUMNS)}) VALUES ({placeholders})",
+                [tuple(row.get(column) for column in _COLUMNS) for row in rows])
+
+    def record(self, job):
+        """
+        Add a finished job (pipeline.Job with output_path set).
+        """
+        if not self.enabled:
+            return
+        row = {
+            "job_id": job.job_id,
+            "batch_id": job.batch_id,
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "audio_name": os.path.basename(job.audio_path),
+            "audio_path": job.audio_path,
+            "audio_hash": _hash_or_none(job.audio_path),
+            "image_name": os.path.basename(job.image_path),
+            "image_path": job.image_path,
+            "image_hash": _hash_or_none(job.image_path),
+            "output_path": job.output_path,
+            "tier": job.tier,
+            "audio_duration": job.audio_duration,
+            "sadtalker_seconds": job.timings.get("sadtalker"),
+            "liveportrait_seconds": job.timings.get("liveportrait"),
+            "total_seconds": job.timings.get("total"),
+            "params": json.dumps(job.params, sort_keys=True, default=str),
+            "source": "pipeline",
+        }
+        try:
+            with self._lock:
+                self._db()
+                self._insert([row])
+        except sqlite3.Error as e:
+            logger.error(f"Could not add job {job.job_id} to the catalog: {e}")
+
+    @staticmethod
+    def _read_log(log_path):
+        """
+        Parse a legacy output log ("datetime: audio, image, output[, batch]" lines, or the CSV variant) into rows.
+        """
+        rows = []
+        with open(log_path, "r", newline="") as f:
+            if log_path.lower().endswith(".csv"):
+                entries = ((fields[0], fields[1:]) for fields in csv.reader(f) if fields and fields[0] != "Datetime")
+            else:
+                entries = (line.rstrip("\n").split(": ", 1) for line in f if ": " in line)
+                entries = ((stamp, rest.split(", ")) for stamp, rest in entries)
+            for stamp, files in entries:
+                if len(files) < 3:
+                    continue
+                try:
+                    created_at = datetime.strptime(stamp, "%Y-%m-%d_%H-%M-%S").isoformat(timespec="seconds")
+                except ValueError:
+                    continue
+                rows.append({
+                    "created_at": created_at,
+                    "audio_name": os.path.basename(files[0]),
+                    "image_name": os.path.basename(files[1]),
+                    "output_path": files[2],
+                    "batch_id": files[3] if len(files) > 3 else None,
+                    "source": "import",
+                })
+        return rows
+
+    def _import_log(self, log_path):
+        """
+        Import a legacy output log once. A log that does not exist yet is only marked as imported:
+        whatever is written to it from now on is recorded in the catalog directly.
+        """
+        log_path = os.path.abspath(log_path)
+        if self._connection.execute("SELECT 1 FROM imports WHERE path = ?", (log_path,)).fetchone():
+            return 0
+
+        rows = self._read_log(log_path) if os.path.exists(log_path) else []
+        self._insert(rows)
+        with self._connection:
+            self._connection.execute("INSERT INTO imports VALUES (?, ?, ?)",
+                                     (log_path, datetime.now().isoformat(timespec="seconds"), len(rows)))
+        if rows:
+            logger.info(f"Imported {len(rows)} renders from {log_path} into the catalog")
+        return len(rows)
+
+    @staticmethod
+    def _input_filter(column, value):
+        # A content hash, a file on disk (matched by content and name), or a bare file name
+        if _HASH.match(value):
+            return f"{column}_hash = ?", [value]
+        content_hash = _hash_or_none(value)
+        if content_hash:
+            return f"({column}_hash = ? OR {column}_name = ?)", [content_hash, os.path.basename(value)]
+        return f"{column}_name = ?", [os.path.basename(value)]
+
+    def query(self, audio=None, image=None, batch=None, since=None, until=None, limit=100, tier=None):
+        """
+        Find renders, newest first.
+
+        Args:
+        audio (str, optional): Audio file name, path or content hash.
+        image (str, optional): Image file name, path or content hash.
+        batch (str, optional): Batch id.
+        since (str, optional): Lower time bound, see parse_time.
+        until (str, optional): Upper time bound, see parse_time.
+        limit (int): Maximum number of rows.
+        tier (str, optional): Quality tier name.
+
+        Returns:
+        list: One dict per render.
+        """
+        clauses, params = [], []
+        for column, value in (("audio", audio), ("image", image)):
+            if value:
+                clause, values = self._input_filter(column, value)
+                clauses.append(clause)
+                params += values
+        if batch:
+            clauses.append("batch_id = ?")
+            params.append(batch)
+        if tier:
+            clauses.append("tier = ?")
+            params.append(tier)
+        if since:
+            clauses.append("created_at >= ?")
+            params.append(parse_time(since))
+        if until:
+            clauses.append("created_at <= ?")
+            params.append(parse_time(until))
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock:
+            rows = self._db().execute(f"SELECT * FROM renders {where} ORDER BY created_at DESC LIMIT ?",
+                                      params + [int(limit)]).fetchall()
+        results = []
+        for row in rows:
+            result = dict(row)
+            result["params"] = json.loads(result["params"]) if result["params"] else {}
+            results.append(result)
+        return results
+
+    def import_log(self, log_path):
+        with self._lock:
+            self._db()
+            return self._import_log(log_path)
+
+
+catalog = Catalog()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the render catalog")
+    parser.add_argument("--audio", help="Audio file name, path or content hash")
+    parser.add_argument("--image", help="Image file name, path or content hash")
+    parser.add_argument("--batch", help="Batch id")
+    parser.add_argument("--tier", help="Quality tier, e.g. preview or final")
+    parser.add_argument("--since", help="ISO date/time or age such as 7d, 12h, 2w")
+    parser.add_argument("--until", help="ISO date/time or age such as 7d, 12h, 2w")
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--json", action="store_true", help="Print full rows as JSON lines")
+    parser.add_argument("--import-log", metavar="PATH", help="Import a legacy output log (each file is imported once)")
+    args = parser.parse_args()
+
+    if args.import_log:
+        catalog.import_log(args.import_log)
+        return
+
+    for row in catalog.query(args.audio, args.image, args.batch, args.since, args.until, args.limit, args.tier):
+        if args.json:
+            print(json.dumps(row))
+        else:
+            print(f"{row['created_at']}  {row['tier'] or '-'}  {row['audio_name']}  {row['image_name']}  {row['output_path']}"
+                  + (f"  [{row['batch_id']}]" if row["batch_id"] else ""))
+
+
+if __name__ == "__main__":
+    main()
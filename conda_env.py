@@ -0,0 +1,210 @@
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import threading
+from config_manager import config
+from logger import logger  # Import the logger
+
+# CONSTANTS
+CONDA_ENABLED = config.getboolean("Conda", "enabled", fallback=True)
+SNAPSHOT_DIR = config.get("Conda", "snapshot_dir", fallback=".cache/conda_env")
+DEFAULT_CUDA_VERSION = config.get("Values", "default_cuda_version")
+
+# Marker printed between the environment dumps, so activation chatter can be skipped
+_ENV_MARKER = "__AVATAR_PIPELINE_ENV__"
+# Shell bookkeeping variables are meaningless for an exec'd process
+_SHELL_VARIABLES = ("_", "SHLVL", "PWD", "OLDPWD")
+
+_snapshots = {}
+_lock = threading.Lock()
+
+
+def find_conda_base():
+    """
+    Returns the conda installation directory (the parent of conda's bin directory).
+    """
+    conda_exe = os.environ.get("CONDA_EXE") or shutil.which("conda")
+    if not conda_exe:
+        raise RuntimeError("conda executable not found on PATH")
+    return os.path.dirname(os.path.dirname(os.path.realpath(conda_exe)))
+
+
+def cuda_paths(version=DEFAULT_CUDA_VERSION):
+    """
+    Returns the CUDA toolkit bin and lib64 directories for the given version.
+    """
+    version = str(version)
+    return f"/usr/local/cuda-{version}/bin", f"/usr/local/cuda-{version}/lib64"
+
+
+def _prepend_path(env, key, path):
+    env[key] = f"{path}:{env[key]}" if env.get(key) else path
+
+
+def _snapshot_key(env_name, env_prefix, cuda_version):
+    # conda-meta is rewritten on every install/update into the env
+    meta_dir = os.path.join(env_prefix, "conda-meta")
+    stamp_path = meta_dir if os.path.isdir(meta_dir) else env_prefix
+    return {
+        "env": env_name,
+        "prefix": env_prefix,
+        "mtime": os.stat(stamp_path).st_mtime,
+        "cuda_version": str(cuda_version),
+    }
+
+
+def _snapshot_path(env_name):
+    return os.path.join(SNAPSHOT_DIR, f"{env_name}.json")
+
+
+def _load_snapshot(env_name):
+    try:
+        with open(_snapshot_path(env_name), "r") as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return snapshot if "delta" in snapshot else None  # Snapshots of whole environments are recaptured
+
+
+def _is_current(snapshot, env_name, cuda_version):
+    try:
+        return snapshot["key"] == _snapshot_key(env_name, snapshot["key"]["prefix"], cuda_version)
+    except (OSError, KeyError, TypeError):
+        # The env was removed or moved
+        return False
+
+
+def _save_snapshot(env_name, snapshot):
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    path = _snapshot_path(env_name)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    # Owner-only: activation scripts may export credentials
+    with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, path)
+
+
+def _parse_env_dump(items):
+    env = {}
+    for item in items:
+        key, separator, value = item.partition("=")
+        if separator and key not in _SHELL_VARIABLES:
+            env[key] = value
+    return env
+
+
+def activation_delta(before, after):
+    """
+    The changes an activation made to an environment: path-like variables that gained a
+    prefix are recorded as that prefix, so it can be re-applied to a different PATH.
+
+    Returns:
+    dict: {"set": {key: value}, "prepend": {key: prefix}, "unset": [key, ...]}
+    """
+    delta = {"set": {}, "prepend": {}, "unset": [key for key in before if key not in after]}
+    for key, value in after.items():
+        old = before.get(key)
+        if old == value:
+            continue
+        if not old:
+            delta["prepend" if key in ("PATH", "LD_LIBRARY_PATH") else "set"][key] = value
+        elif value.endswith(":" + old):
+            delta["prepend"][key] = value[:-len(old) - 1]
+        else:
+            delta["set"][key] = value
+    return delta
+
+
+def apply_delta(delta, base=None):
+    """
+    Returns a copy of base (default: the current environment) with an activation delta applied.
+    """
+    env = dict(os.environ if base is None else base)
+    for key in delta["unset"]:
+        env.pop(key, None)
+    env.update(delta["set"])
+    for key, prefix in delta["prepend"].items():
+        _prepend_path(env, key, prefix)
+    return env
+
+
+def capture_activation(env_name, cuda_version=DEFAULT_CUDA_VERSION):
+    """
+    Activate a conda env once in a login-free bash shell and record what the activation
+    (and the CUDA paths) changed in the environment.
+
+    Returns:
+    tuple: (activation delta, see activation_delta; the env's prefix)
+    """
+    conda_sh_path = os.path.join(find_conda_base(), "etc", "profile.d", "conda.sh")
+    cuda_bin, cuda_lib = cuda_paths(cuda_version)
+    full_commands = [
+        "env -0",
+        f"printf '%s\\0' {_ENV_MARKER}",
+        f"source {shlex.quote(conda_sh_path)}",
+        f"export PATH={shlex.quote(cuda_bin)}${{PATH:+:${{PATH}}}}",
+        f"export LD_LIBRARY_PATH={shlex.quote(cuda_lib)}${{LD_LIBRARY_PATH:+:${{LD_LIBRARY_PATH}}}}",
+        f"conda activate {shlex.quote(env_name)}",
+        f"printf '\\0%s\\0' {_ENV_MARKER}",
+        "env -0",
+    ]
+    process = subprocess.run(["/bin/bash", "-c", " && ".join(full_commands)], capture_output=True, text=True)
+    items = process.stdout.split("\0")
+    if process.returncode != 0 or items.count(_ENV_MARKER) < 2:
+        raise RuntimeError(f"Failed to activate conda env '{env_name}': {process.stderr.strip()}")
+
+    first = items.index(_ENV_MARKER)
+    last = len(items) - 1 - items[::-1].index(_ENV_MARKER)
+    before, after = _parse_env_dump(items[:first]), _parse_env_dump(items[last + 1:])
+    if not after.get("CONDA_PREFIX"):
+        raise RuntimeError(f"Activating conda env '{env_name}' did not set CONDA_PREFIX")
+    return activation_delta(before, after), after["CONDA_PREFIX"]
+
+
+def get_env(env_name, cuda_version=DEFAULT_CUDA_VERSION):
+    """
+    Returns the activated environment for a conda env: the current environment with the
+    env's activation changes applied, so later changes to e.g. HOME or CUDA_VISIBLE_DEVICES apply.
+
+    Only the activation changes are captured, once, and persisted to SNAPSHOT_DIR keyed on
+    the env's prefix, mtime and the CUDA version, so later calls cost a stat() instead of a shell.
+    With [Conda] enabled = false, the current environment plus CUDA paths is returned.
+    """
+    if not CONDA_ENABLED:
+        env = dict(os.environ)
+        cuda_bin, cuda_lib = cuda_paths(cuda_version)
+        _prepend_path(env, "PATH", cuda_bin)
+        _prepend_path(env, "LD_LIBRARY_PATH", cuda_lib)
+        return env
+
+    with _lock:
+        snapshot = _snapshots.get(env_name) or _load_snapshot(env_name)
+        if snapshot is None or not _is_current(snapshot, env_name, cuda_version):
+            if snapshot is not None:
+                logger.info(f"Conda env snapshot for {env_name} is stale, recapturing")
+            logger.info(f"Capturing conda env snapshot for {env_name} (CUDA {cuda_version})")
+            delta, prefix = capture_activation(env_name, cuda_version)
+            snapshot = {"key": _snapshot_key(env_name, prefix, cuda_version), "delta": delta}
+            _save_snapshot(env_name, snapshot)
+        _snapshots[env_name] = snapshot
+        return apply_delta(snapshot["delta"])
+
+
+def get_python(env):
+    """
+    Returns the python interpreter of an environment returned by get_env().
+    """
+    if not CONDA_ENABLED:
+        return sys.executable
+    prefix = env.get("CONDA_PREFIX")
+    if prefix:
+        python_path = os.path.join(prefix, "bin", "python")
+        if os.path.exists(python_path):
+            return python_path
+    python_path = shutil.which("python", path=env.get("PATH"))
+    if not python_path:
+        raise RuntimeError("python not found in the activated conda env")
+    return python_path
@@ -18,4 +18,10 @@ class ConfigManager:
     def getboolean(self, section, key, fallback=None):
         return self.config.getboolean(section, key, fallback=fallback)
 
+    def sections(self):
+        return self.config.sections()
+
+    def items(self, section):
+        return self.config.items(section)
+
 config = ConfigManager()
\ No newline at end of file
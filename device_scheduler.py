@@ -0,0 +1,144 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import NamedTuple, Optional
+from config_manager import config
+from metrics import metrics
+from logger import logger  # Import the logger
+
+# CONSTANTS
+# Comma separated device slots, "<CUDA device id>[:<memory GB>]", e.g. "0:24, 1:24". Empty = no pinning.
+DEVICES = config.get("Devices", "devices", fallback="")
+ENGINE_MEMORY_GB = {
+    "sadtalker": config.getfloat("Devices", "sadtalker_memory_gb", fallback=0.0),
+    "liveportrait": config.getfloat("Devices", "liveportrait_memory_gb", fallback=0.0),
+}
+
+
+class Device(NamedTuple):
+    device_id: str
+    memory_gb: Optional[float] = None  # None: one job at a time
+
+
+def parse_devices(value):
+    """
+    Parse a device list such as "0:24, 1:24" or "0, 1".
+    """
+    devices = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        device_id, _, memory = item.partition(":")
+        devices.append(Device(device_id.strip(), float(memory) if memory.strip() else None))
+    return devices
+
+
+class DeviceScheduler:
+    """
+    Hands out GPU slots to engine invocations.
+
+    A device with a memory size accepts jobs as long as the sum of their engines'
+    declared budgets fits, so a SadTalker and a LivePortrait job can share a card.
+    A device without a size, or an engine without a budget, runs one job at a time.
+    Callers block until a slot is free; the least loaded fitting device is chosen.
+    """
+
+    def __init__(self, devices, engine_memory_gb=None):
+        self.devices = list(devices)
+        self.engine_memory_gb = dict(engine_memory_gb or {})
+        self._used_gb = {device.device_id: 0.0 for device in self.devices}
+        self._jobs = {device.device_id: 0 for device in self.devices}
+        self._condition = threading.Condition()
+        for device in self.devices:
+            for engine, budget in self.engine_memory_gb.items():
+                if device.memory_gb is not None and budget > device.memory_gb:
+                    logger.warning(f"{engine} budget ({budget} GB) does not fit on device {device.device_id} ({device.memory_gb} GB)")
+
+    @property
+    def enabled(self):
+        return bool(self.devices)
+
+    def _fits(self, device, budget):
+        if self._jobs[device.device_id] == 0:
+            return True
+        if device.memory_gb is None or not budget:
+            return False
+        return self._used_gb[device.device_id] + budget <= device.memory_gb
+
+    def _pick(self, engine):
+        budget = self.engine_memory_gb.get(engine, 0.0)
+        candidates = [device for device in self.devices if self._fits(device, budget)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda device: (self._jobs[device.device_id], self._used_gb[device.device_id]))
+
+    def acquire(self, engine, timeout=None):
+        """
+        Block until a device can take a job of the given engine.
+
+        Returns:
+        str: The device id, or None if no devices are configured.
+        Raises:
+        TimeoutError: If no slot became free within timeout seconds.
+        """
+        if not self.enabled:
+            return None
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                device = self._pick(engine)
+                if device is not None:
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(f"No free device for {engine}")
+                self._condition.wait(remaining)
+            self._jobs[device.device_id] += 1
+            self._used_gb[device.device_id] += self.engine_memory_gb.get(engine, 0.0)
+        return device.device_id
+
+    def release(self, engine, device_id):
+        if device_id is None:
+            return
+        with self._condition:
+            self._jobs[device_id] -= 1
+            self._used_gb[device_id] = max(0.0, self._used_gb[device_id] - self.engine_memory_gb.get(engine, 0.0))
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self, engine):
+        """
+        Hold a device for the duration of the block. Yields the device id (None when disabled).
+
+        Usage:
+            with scheduler.slot("sadtalker") as device:
+                env["CUDA_VISIBLE_DEVICES"] = device
+        """
+        start = time.perf_counter()
+        device_id = self.acquire(engine)
+        if device_id is not None:
+            metrics.record(f"{engine}.device_wait", time.perf_counter() - start, device=device_id)
+        try:
+            yield device_id
+        finally:
+            self.release(engine, device_id)
+
+    def usage(self):
+        with self._condition:
+            return {device.device_id: {"jobs": self._jobs[device.device_id], "used_gb": self._used_gb[device.device_id],
+                                       "memory_gb": device.memory_gb} for device in self.devices}
+
+
+def pin_env(env, device_id):
+    """
+    Returns a copy of env restricted to one CUDA device (env itself if device_id is None).
+    """
+    if device_id is None:
+        return env
+    env = dict(env)
+    env["CUDA_VISIBLE_DEVICES"] = str(device_id)
+    return env
+
+
+scheduler = DeviceScheduler(parse_devices(DEVICES), ENGINE_MEMORY_GB)
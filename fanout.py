@@ -0,0 +1,130 @@
+import os
+import sys
+import helpers
+import pipeline
+import quality_tiers
+import worker_client
+from metrics import metrics
+from logger import logger  # Import the logger
+
+# CONSTANTS
+AUDIO_EXTENSIONS = (".wav", ".mp3")
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+
+def build_fanout_jobs(shared_file, files, input_dir, batch_id=None, tier=""):
+    """
+    Build the jobs of a fan-out batch. File names are resolved against input_dir.
+
+    Args:
+    shared_file (str): One audio (rendered onto every image) or one image (driven by every audio).
+    files (list): The images or audios to combine with shared_file.
+    input_dir (str): Directory the file names are relative to.
+    batch_id (str, optional): Defaults to a new batch id.
+    tier (str, optional): Quality tier of every job; defaults to the configured default tier.
+
+    Returns:
+    tuple: (batch_id, list of Job objects)
+    """
+    def resolve(name):
+        path = os.path.join(input_dir, name)
+        if path.lower().endswith(".mp3"):
+            path = os.path.splitext(path)[0] + ".wav"  # Converted by helpers.process_audio
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Input not found: {path}")
+        return path
+
+    batch_id = batch_id or pipeline.new_batch_id()
+    if shared_file.lower().endswith(AUDIO_EXTENSIONS):
+        if not all(name.lower().endswith(IMAGE_EXTENSIONS) for name in files):
+            raise ValueError("One audio fans out to images only")
+        audio_path = resolve(shared_file)
+        jobs = [pipeline.Job(audio_path, resolve(name), batch_id=batch_id, tier=tier) for name in files]
+    elif shared_file.lower().endswith(IMAGE_EXTENSIONS):
+        if not all(name.lower().endswith(AUDIO_EXTENSIONS) for name in files):
+            raise ValueError("One image fans out to audios only")
+        image_path = resolve(shared_file)
+        jobs = [pipeline.Job(resolve(name), image_path, batch_id=batch_id, tier=tier) for name in files]
+    else:
+        raise ValueError(f"Unsupported file type: {shared_file}")
+    return batch_id, jobs
+
+
+def run_fanout(shared_file, files, input_dir, output_dir, tier=""):
+    """
+    Render one audio onto many images, or one image with many audios, as one batch.
+
+    One audio, N images: SadTalker runs once and the N LivePortrait runs share its driving video.
+    One image, N audios: the LivePortrait runs go back to back, so a resident LivePortrait worker
+    ([Workers] enabled) reuses the source portrait's crop instead of redoing it for every audio.
+    Every job is logged with the batch id.
+
+    Returns:
+    tuple: (batch_id, list of Job objects)
+    """
+    inter_dir = os.path.join(os.getcwd(), "intermediate_videos")
+    os.makedirs(inter_dir, exist_ok=True)
+    parent_dir, pipeline_dir, sadTalker_dir, livePortrait_dir = helpers.get_directories()
+
+    # process mp3 to wav
+    with metrics.span("process_audio"):
+        helpers.process_audio(input_dir)
+
+    batch_id, jobs = build_fanout_jobs(shared_file, files, input_dir, tier=tier)
+    logger.info(f"Fan-out batch {batch_id}: {os.path.basename(shared_file)} x {len(jobs)}")
+
+    sadtalker_worker = liveportrait_worker = None
+    if worker_client.WORKERS_ENABLED:
+        sadtalker_worker, liveportrait_worker = worker_client.start_workers(sadTalker_dir, livePortrait_dir)
+
+    try:
+        batch = pipeline.BatchPipeline(sadTalker_dir, livePortrait_dir, inter_dir, output_dir,
+                                       sadtalker_worker=sadtalker_worker, liveportrait_worker=liveportrait_worker).start()
+        if shared_file.lower().endswith(AUDIO_EXTENSIONS):
+            batch.submit_group(jobs)
+        else:
+            for job in jobs:
+                batch.submit(job)
+        batch.close()
+    finally:
+        for worker in (sadtalker_worker, liveportrait_worker):
+            if worker is not None:
+                worker.stop()
+
+    with metrics.span("cleanup"):
+        pipeline.archive_completed_inputs(jobs, inter_dir)
+    metrics.export_prometheus()
+
+    failed = [job for job in jobs if job.status != "done"]
+    logger.info(f"Fan-out batch {batch_id} complete: {len(jobs) - len(failed)} succeeded, {len(failed)} failed")
+    return batch_id, jobs
+
+
+def main():
+    try:
+        tier = quality_tiers.pop_tier_argument(sys.argv)
+    except ValueError as e:
+        logger.error(e)
+        sys.exit(1)
+    if len(sys.argv) < 3:
+        print("Usage: python fanout.py <audio> <image> [image ...] [--tier <name>]")
+        print("       python fanout.py <image> <audio> [audio ...]")
+        print("Files are read from ./input; videos are written to ./output.")
+        sys.exit(1)
+
+    input_dir = os.path.join(os.getcwd(), "input")
+    output_dir = os.path.join(os.getcwd(), "output")
+    os.makedirs(output_dir, exist_ok=True)
+
+    try:
+        batch_id, jobs = run_fanout(sys.argv[1], sys.argv[2:], input_dir, output_dir, tier or "")
+    except (FileNotFoundError, ValueError) as e:
+        logger.error(e)
+        sys.exit(1)
+    print(f"Batch {batch_id}: {sum(job.status == 'done' for job in jobs)}/{len(jobs)} videos")
+    if any(job.status != "done" for job in jobs):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,15 @@
 import os
 import shutil
-from pydub import AudioSegment
-import subprocess
+import archive
+import audio_ingest
+import stream_runner
 from datetime import datetime
 from config_manager import config
 from logger import logger  # Import the logger
 import csv
+import hashlib
+import threading
+import wave
 from typing import Tuple, Optional
 
 
@@ -14,6 +18,39 @@ HOME_DIR = config.get("Paths", "HOME_DIR")
 SILENCE_TIME = config.get("Values", "SILENCE_TIME")
 DEFAULT_CUDA_VERSION = config.get("Values", "default_cuda_version")
 
+_hash_memo = {}
+_hash_lock = threading.Lock()
+
+def hash_file(file_path, chunk_size=1024 * 1024):
+    """
+    Return the SHA-256 hex digest of a file's content.
+    Results are memoized on (path, size, mtime), so unchanged files are hashed only once per process.
+    """
+    stat = os.stat(file_path)
+    memo_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    with _hash_lock:
+        if memo_key in _hash_memo:
+            return _hash_memo[memo_key]
+
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+
+    with _hash_lock:
+        _hash_memo[memo_key] = digest.hexdigest()
+    return digest.hexdigest()
+
+def get_audio_duration(audio_path):
+    """
+    Return the duration of a WAV file in seconds, or None if it cannot be read.
+    """
+    try:
+        with wave.open(audio_path, "rb") as wav_file:
+            return wav_file.getnframes() / float(wav_file.getframerate())
+    except (OSError, EOFError, wave.Error, ZeroDivisionError):
+        return None
+
 # Function to find a specific directory in given search paths
 def find_directory(dir_name, search_paths):
     for path in search_paths:
@@ -55,82 +92,67 @@ def get_pipeline_directories(pipeline_dir):
     return mp3_dir, wav_dir, img_dir, int_dir, output_dir
 
 # Process audio file. MP3 -> WAV(add some silence)
-def process_audio(input_dir, audio_file=None):
+def process_audio(input_dir, audio_file=None, workers=None):
     logger.info("Starting audio processing")
     # TODO: for if using list of input audio files
     if audio_file:
         pass
 
-    count = 0
-    # Process each mp3 file in the mp3 directory
+    # Collect the mp3 files that still need a wav
+    pending = []
     for filename in os.listdir(input_dir):
         if filename.endswith(".mp3"):
             wav_file_name = os.path.splitext(filename)[0] + ".wav"
             wav_file_path = os.path.join(input_dir, wav_file_name)
-            
+
             # Skip if the wav file already exists
             if os.path.exists(wav_file_path):
                 logger.info(f"Skipping {filename}, WAV file already exists.")
                 continue
+            pending.append((os.path.join(input_dir, filename), wav_file_path))
 
-            # Convert MP3 to WAV and add silence at the beginning
-            mp3_file_path = os.path.join(input_dir, filename)
-            audio = AudioSegment.from_mp3(mp3_file_path)
-            silence = AudioSegment.silent(duration=int(SILENCE_TIME))
-            audio_with_silence = silence + audio
-
-            # Export the processed audio as WAV
-            audio_with_silence.export(wav_file_path, format="wav")
-            # TODO: add metadata to the wav file
-            logger.info(f"Converted {filename} to {wav_file_name}")
-
-            # Move processed mp3 file to processed folder
-            processed_dir = os.path.join(input_dir, "audio_mp3")
-            os.makedirs(processed_dir, exist_ok=True)
-            
-            # Generate new filename with datetime if file already exists
-            dest_path = os.path.join(processed_dir, filename)
-            if os.path.exists(dest_path):
-                base_name, ext = os.path.splitext(filename)
-                current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
-                new_filename = f"{base_name}_{current_time}{ext}"
-                dest_path = os.path.join(processed_dir, new_filename)
-            
-            # Move the file
-            shutil.move(mp3_file_path, dest_path)
-            logger.info(f"Moved {filename} to {dest_path}")
-            count += 1
+    # Convert MP3 to WAV and add silence at the beginning, in parallel
+    count = 0
+    processed_dir = os.path.join(input_dir, "audio_mp3")
+    for mp3_file_path, wav_file_path, elapsed, error in audio_ingest.convert_files(pending, workers or audio_ingest.INGEST_WORKERS):
+        if error:
+            continue
+        # TODO: add metadata to the wav file
+
+        # Move processed mp3 file to processed folder
+        os.makedirs(processed_dir, exist_ok=True)
+        filename = os.path.basename(mp3_file_path)
+
+        # Generate new filename with datetime if file already exists
+        dest_path = os.path.join(processed_dir, filename)
+        if os.path.exists(dest_path):
+            base_name, ext = os.path.splitext(filename)
+            current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
+            new_filename = f"{base_name}_{current_time}{ext}"
+            dest_path = os.path.join(processed_dir, new_filename)
+
+        # Move the file
+        shutil.move(mp3_file_path, dest_path)
+        logger.info(f"Moved {filename} to {dest_path}")
+        count += 1
 
     logger.info(f"Processed {count} audio files.")
+    return count
 
-def run_commands(commands):
+def run_command(args, cwd=None, env=None, stage=None, on_progress=None):
     """
-    Run a list of shell commands sequentially in WSL or Ubuntu.
+    Run a single command directly (no shell) with an explicit working directory and environment.
+    Output is streamed with bounded memory; progress bars are reported through on_progress.
     Args:
-        commands (list): A list of shell commands to run.
-    Returns:
-        None
-    """
-    # Combine the commands into a single string using '&&' to run them sequentially
-    full_command = " && ".join(commands)
-
-    # Execute the commands in a shell
-    process = subprocess.run(full_command, shell=True, executable='/bin/bash', capture_output=True, text=True)
-
-    # Print the output
-    logger.info(process.stdout)
-
-    # Check for errors
-    if process.returncode != 0:
-        logger.error(f"Error: {process.stderr}")
-
-def get_cuda_env_path(version=DEFAULT_CUDA_VERSION):
-    """
-    Set the CUDA environment variables in the current shell.
+        args (list): The program and its arguments.
+        cwd (str): Working directory for the command.
+        env (dict): Environment for the command, e.g. from conda_env.get_env().
+        stage (str): Stage name attached to progress events and log lines.
+        on_progress (callable): Called with a stream_runner.ProgressEvent on each progress update.
+    Raises:
+        subprocess.CalledProcessError: If the command exits with a non-zero status.
     """
-    version = str(version)
-    return [f"export PATH=/usr/local/cuda-{version}/bin${{PATH:+:${{PATH}}}}",
-            f"export LD_LIBRARY_PATH=/usr/local/cuda-{version}/lib64${{LD_LIBRARY_PATH:+:${{LD_LIBRARY_PATH}}}}"]
+    return stream_runner.run_streaming(args, cwd=cwd, env=env, stage=stage, on_progress=on_progress)
 
 def rename_output_video(file_path, new_name):
     # Check if the file exists
@@ -168,7 +190,6 @@ def rename_livePortrait_video(file_path, input_audio_filename, input_image_filen
         logger.error(f"Error renaming LivePortrait video: {e}")
         return None
 
-# TODO: WIP
 def get_input_filenames(file_path):
     try:
         result = []
@@ -266,46 +287,6 @@ def validate_and_update_filenames(input_files, wav_dir, img_dir):
     logger.info(f"Found {len(validated_pairs)} valid audio-image pairs")
     return validated_pairs
 
-# For testing
-def process_single_pair(audio_file, image_file, wav_dir, img_dir, intermediate_dir, output_dir, sadTalker_dir, livePortrait_dir):
-    input_audio_path = os.path.join(wav_dir, audio_file)
-    input_image_path = os.path.join(img_dir, image_file)
-    input_audio_filename = os.path.splitext(audio_file)[0]
-    input_image_filename = os.path.splitext(image_file)[0]
-
-    # Check if input files exist
-    if not os.path.exists(input_audio_path) or not os.path.exists(input_image_path):
-        logger.error(f"Input file not found: {input_audio_path} or {input_image_path}")
-        return False
-
-    # Run SadTalker
-    sadTalker_success, sadTalker_output = runSadTalker.run_sadtalker(sadTalker_dir, input_audio_path)
-    if not sadTalker_success:
-        logger.error("SadTalker processing failed.")
-        return False
-
-    # Rename and move output video to intermediate_videos
-    try:
-        inter_file_path = helpers.rename_output_video(sadTalker_output, input_audio_filename)
-        inter_file_path = shutil.move(inter_file_path, intermediate_dir)
-    except FileNotFoundError as e:
-        logger.error(f"Error: {e}")
-        return False
-
-    # Run LivePortrait
-    livePortrait_success, livePortrait_output = runLivePortrait.run_liveportrait(livePortrait_dir, input_image_path, inter_file_path)
-    if not livePortrait_success:
-        logger.error("LivePortrait processing failed.")
-        return False
-
-    # Rename and move output video to output directory
-    final_output_path = helpers.rename_livePortrait_video(livePortrait_output, input_audio_filename, input_image_filename)
-    final_output_path = shutil.move(final_output_path, output_dir)
-    logger.info(f"Final output: {final_output_path}")
-
-    return True
-
-
 def get_input_audio_path(input_dir):
     # Get a list of all .wav files in the input directory
     wav_files = [f for f in os.listdir(input_dir) if f.endswith('.wav')]
@@ -389,6 +370,38 @@ def get_file_paths(input_dir: str) -> Tuple[str, str]:
 
     return input_audio_path, input_image_path
 
+def move_to_completed(source_path, completed_dir=None):
+    """
+    Move a single file into a 'completed' directory (next to the file by default).
+    A datetime postfix is added if a file with the same name was already completed.
+    With [Archive] enabled, the file goes into the sharded, size-capped archive instead.
+
+    Returns:
+    str: The destination path.
+    """
+    if archive.ARCHIVE_ENABLED:
+        return archive.archive.store(source_path, completed_dir)
+
+    if completed_dir is None:
+        completed_dir = os.path.join(os.path.dirname(source_path), "completed")
+    os.makedirs(completed_dir, exist_ok=True)
+
+    file = os.path.basename(source_path)
+    dest_path = os.path.join(completed_dir, file)
+
+    # If the file already exists in the completed directory
+    if os.path.exists(dest_path):
+        # Generate a new filename with datetime postfix
+        base_name, ext = os.path.splitext(file)
+        current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
+        new_filename = f"{base_name}_{current_time}{ext}"
+        dest_path = os.path.join(completed_dir, new_filename)
+
+    # Move the file
+    shutil.move(source_path, dest_path)
+    logger.info(f"Moved {file} to {dest_path}")
+    return dest_path
+
 def cleanup_completed_files(source_dir):
     # Create a 'completed' subdirectory in the source directory
     completed_dir = os.path.join(source_dir, "completed")
@@ -398,19 +411,7 @@ def cleanup_completed_files(source_dir):
     for file in os.listdir(source_dir):
         source_path = os.path.join(source_dir, file)
         if os.path.isfile(source_path):
-            dest_path = os.path.join(completed_dir, file)
-            
-            # If the file already exists in the completed directory
-            if os.path.exists(dest_path):
-                # Generate a new filename with datetime postfix
-                base_name, ext = os.path.splitext(file)
-                current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
-                new_filename = f"{base_name}_{current_time}{ext}"
-                dest_path = os.path.join(completed_dir, new_filename)
-            
-            # Move the file
-            shutil.move(source_path, dest_path)
-            logger.info(f"Moved {file} to {dest_path}")
+            move_to_completed(source_path, completed_dir)
 
     # Log the cleanup operation
     logger.info(f"Completed moving files from {source_dir} to {completed_dir}")
@@ -426,34 +427,16 @@ def save_to_output_file(file_paths, output_file):
     """
     current_datetime = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
     try:
+        is_new = not os.path.exists(output_file) or os.path.getsize(output_file) == 0
         with open(output_file, 'a') as file:
             if output_file.lower().endswith('.csv'):
                 writer = csv.writer(file)
-                writer.writerow(['Datetime'] + [f'File {i+1}' for i in range(len(file_paths))])
+                # Header once, not on every append
+                if is_new:
+                    writer.writerow(['Datetime'] + [f'File {i+1}' for i in range(len(file_paths))])
                 writer.writerow([current_datetime] + file_paths)
             else:
                 file.write(f"{current_datetime}: {', '.join(file_paths)}\n")
         logger.info(f"File paths saved to: {output_file}")
     except IOError as e:
         logger.error(f"Error saving file paths: {e}")
-
-def get_conda_source_command():
-    """
-    Returns the command to source the conda.sh script dynamically.
-
-    :return: A string containing the command to source conda.sh.
-    """
-    try:
-        # Run the command to find the path to conda.sh
-        result = subprocess.run(
-            "realpath $(dirname $(which conda))/../etc/profile.d/conda.sh",
-            shell=True, check=True, capture_output=True, text=True
-        )
-
-        # Get the absolute path to conda.sh
-        conda_sh_path = result.stdout.strip()
-
-        # Return the full source command
-        return f"source {conda_sh_path}"
-    except subprocess.CalledProcessError as e:
-        raise RuntimeError(f"Failed to find the conda.sh path: {e}")
\ No newline at end of file
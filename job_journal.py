@@ -0,0 +1,305 @@
+import atexit
+import os
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime
+import helpers
+import quality_tiers
+from config_manager import config
+from logger import logger  # Import the logger
+
+# CONSTANTS
+JOURNAL_ENABLED = config.getboolean("Journal", "enabled", fallback=True)
+JOURNAL_PATH = config.get("Journal", "path", fallback="journal.sqlite3")
+FLUSH_INTERVAL = config.getfloat("Journal", "flush_interval", fallback=0.5)  # Seconds a write may wait for its batch
+BATCH_SIZE = int(config.get("Journal", "batch_size", fallback="200"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    audio_path TEXT NOT NULL,
+    image_path TEXT NOT NULL,
+    audio_hash TEXT,
+    image_hash TEXT,
+    batch_id TEXT,
+    tier TEXT,
+    parent_job_id TEXT,
+    status TEXT NOT NULL,
+    error TEXT,
+    output_path TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+CREATE INDEX IF NOT EXISTS jobs_inputs ON jobs (audio_hash, image_hash);
+CREATE TABLE IF NOT EXISTS stages (
+    job_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    path TEXT,
+    content_hash TEXT,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (job_id, stage)
+);
+"""
+
+_UPSERT_JOB = """
+INSERT INTO jobs (job_id, audio_path, image_path, audio_hash, image_hash, batch_id, tier, parent_job_id, status, error, output_path, created_at, updated_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (job_id) DO UPDATE SET
+    status = excluded.status,
+    error = excluded.error,
+    output_path = COALESCE(excluded.output_path, jobs.output_path),
+    batch_id = COALESCE(excluded.batch_id, jobs.batch_id),
+    audio_hash = COALESCE(excluded.audio_hash, jobs.audio_hash),
+    image_hash = COALESCE(excluded.image_hash, jobs.image_hash),
+    updated_at = excluded.updated_at
+"""
+
+_UPSERT_STAGE = """
+INSERT INTO stages (job_id, stage, status, path, content_hash, updated_at) VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (job_id, stage) DO UPDATE SET
+    status = excluded.status, path = excluded.path, content_hash = excluded.content_hash, updated_at = excluded.updated_at
+"""
+
+
+def _hash_or_none(path):
+    try:
+        return helpers.hash_file(path) if path else None
+    except OSError:
+        return None
+
+
+class JobJournal:
+    """
+    Durable record of every job's inputs, stage results and artifacts, in SQLite.
+
+    Writes are queued and committed by one writer thread in batched transactions
+    (at most flush_interval seconds or batch_size statements each), so recording
+    never blocks a stage on disk I/O. The database runs in WAL mode: a crash can
+    lose the last unflushed batch, but never corrupts the journal.
+
+    A job whose SadTalker stage is journaled as done, with its driving video still
+    present and unchanged, can be resumed at LivePortrait (see resume).
+    """
+
+    def __init__(self, path=JOURNAL_PATH, flush_interval=FLUSH_INTERVAL, batch_size=BATCH_SIZE, enabled=JOURNAL_ENABLED):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.enabled = enabled
+        self._queue = queue.Queue()
+        self._writer_thread = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._writer_thread is not None:
+                return
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with self._connect() as connection:
+                connection.executescript(SCHEMA)
+                # Journals created before quality tiers (their jobs ran the default tier) and segment tracking
+                columns = {row[1] for row in connection.execute("PRAGMA table_info(jobs)")}
+                for column in ("tier", "parent_job_id"):
+                    if column not in columns:
+                        connection.execute(f"ALTER TABLE jobs ADD COLUMN {column} TEXT")
+                connection.execute("CREATE INDEX IF NOT EXISTS jobs_parent ON jobs (parent_job_id)")
+            self._writer_thread = threading.Thread(target=self._writer, name="job-journal", daemon=True)
+            self._writer_thread.start()
+            atexit.register(self.flush)
+
+    def _writer(self):
+        connection = self._connect()
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                with connection:
+                    for statement, params in batch:
+                        connection.execute(statement, params)
+            except sqlite3.Error as e:
+                logger.error(f"Job journal write failed ({len(batch)} statements dropped): {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, statement, params):
+        if not self.enabled:
+            return
+        self._ensure_started()
+        self._queue.put((statement, params))
+
+    def flush(self):
+        """Block until every queued write is committed."""
+        if self._writer_thread is not None:
+            self._queue.join()
+
+    def record_job(self, job, status=None, hash_inputs=False):
+        """
+        Insert or update a job. Input hashes are computed when hash_inputs is set (memoized per file).
+        """
+        now = datetime.now().isoformat(timespec="milliseconds")
+        audio_hash = _hash_or_none(job.audio_path) if hash_inputs else None
+        image_hash = _hash_or_none(job.image_path) if hash_inputs else None
+        self._write(_UPSERT_JOB, (job.job_id, job.audio_path, job.image_path, audio_hash, image_hash, job.batch_id,
+                                  job.tier, job.parent_job_id, status or job.status, job.error, job.output_path, now, now))
+
+    def record_stage(self, job, stage, status, path=None):
+        """
+        Record a stage result and its artifact's content hash.
+        """
+        if not self.enabled:
+            return
+        now = datetime.now().isoformat(timespec="milliseconds")
+        content_hash = _hash_or_none(path) if status == "done" else None
+        self._write(_UPSERT_STAGE, (job.job_id, stage, status, path, content_hash, now))
+
+    def _query(self, statement, params=()):
+        if not self.enabled or not os.path.exists(self.path):
+            return []
+        self._ensure_started()  # Schema migrations run before the first read too
+        self.flush()
+        connection = self._connect()
+        try:
+            connection.row_factory = sqlite3.Row
+            return connection.execute(statement, params).fetchall()
+        finally:
+            connection.close()
+
+    def stages(self, job_id):
+        """
+        Returns:
+        dict: {stage: row} for a job.
+        """
+        return {row["stage"]: row for row in self._query("SELECT * FROM stages WHERE job_id = ?", (job_id,))}
+
+    def unfinished(self):
+        """
+        Returns:
+        list: Rows of the latest attempt per input pair and tier, for those that did not finish, oldest first.
+        Segments of a long job are part of their parent job and never listed.
+        """
+        rows = self._query("SELECT *, MAX(updated_at) FROM jobs "
+                           "WHERE parent_job_id IS NULL AND audio_hash IS NOT NULL AND image_hash IS NOT NULL "
+                           "GROUP BY audio_hash, image_hash, COALESCE(tier, ?) ORDER BY created_at",
+                           (quality_tiers.DEFAULT_TIER,))
+        # Only the latest attempt per input pair and tier counts
+        return [row for row in rows if row["status"] != "done"]
+
+    def referenced_hashes(self):
+        """
+        Returns:
+        set: Content hashes of the inputs and stage artifacts of unfinished jobs and their segments
+        (files that must be kept).
+        """
+        rows = self.unfinished()
+        hashes = {row[column] for row in rows for column in ("audio_hash", "image_hash")}
+        job_ids = [row["job_id"] for row in rows]
+        for start in range(0, len(job_ids), 500):
+            chunk = job_ids[start:start + 500]
+            placeholders = ", ".join("?" * len(chunk))
+            stage_rows = self._query(
+                f"SELECT stages.content_hash FROM stages JOIN jobs ON jobs.job_id = stages.job_id "
+                f"WHERE jobs.job_id IN ({placeholders}) OR jobs.parent_job_id IN ({placeholders})", chunk + chunk)
+            hashes.update(row["content_hash"] for row in stage_rows)
+        hashes.discard(None)
+        return hashes
+
+    def resume(self, job):
+        """
+        Adopt the most recent unfinished journal entry for the same input contents and quality tier.
+
+        If that job's SadTalker stage is done and its driving video is still present with
+        the journaled content hash, job takes over its job id and sadtalker_output, so the
+        caller can go straight to LivePortrait.
+
+        Returns:
+        bool: True if the job was resumed.
+        """
+        if not self.enabled:
+            return False
+        audio_hash, image_hash = _hash_or_none(job.audio_path), _hash_or_none(job.image_path)
+        rows = self._query(
+            "SELECT jobs.job_id, stages.path, stages.content_hash FROM jobs JOIN stages ON stages.job_id = jobs.job_id "
+            "WHERE jobs.status != 'done' AND jobs.parent_job_id IS NULL AND jobs.audio_hash = ? AND jobs.image_hash = ? AND COALESCE(jobs.tier, ?) = ? "
+            "AND stages.stage = 'sadtalker' AND stages.status = 'done' ORDER BY jobs.updated_at DESC",
+            (audio_hash, image_hash, quality_tiers.DEFAULT_TIER, job.tier))
+        for row in rows:
+            path = row["path"]
+            if path and os.path.exists(path) and _hash_or_none(path) == row["content_hash"]:
+                logger.info(f"Resuming job {row['job_id']} after SadTalker: {path}")
+                job.job_id = row["job_id"]
+                job.sadtalker_output = path
+                return True
+        return False
+
+    def previous_segmented_attempt(self, job):
+        """
+        Returns:
+        str: Job id of the latest unfinished segmented attempt for the same input contents and
+        quality tier (possibly job itself, when rebuilt from the journal), or None.
+        """
+        if not self.enabled:
+            return None
+        rows = self._query(
+            "SELECT job_id FROM jobs AS parents WHERE status != 'done' AND parent_job_id IS NULL "
+            "AND audio_hash = ? AND image_hash = ? AND COALESCE(tier, ?) = ? "
+            "AND EXISTS (SELECT 1 FROM jobs WHERE jobs.parent_job_id = parents.job_id) ORDER BY updated_at DESC LIMIT 1",
+            (_hash_or_none(job.audio_path), _hash_or_none(job.image_path), quality_tiers.DEFAULT_TIER, job.tier))
+        return rows[0]["job_id"] if rows else None
+
+    def resume_segment(self, segment_job, previous_job_id):
+        """
+        Reuse the matching segment of an earlier attempt of the parent job. The earlier segment
+        must have rendered the same segment audio, and its artifact must be present and unchanged.
+        Sets segment_job.output_path (LivePortrait done) or segment_job.sadtalker_output (SadTalker done).
+
+        Returns:
+        str: The last stage that is reused ("liveportrait" or "sadtalker"), or None.
+        """
+        if not self.enabled or not previous_job_id:
+            return None
+        previous_id = previous_job_id + segment_job.job_id[len(segment_job.parent_job_id):]
+        rows = self._query("SELECT audio_hash FROM jobs WHERE job_id = ?", (previous_id,))
+        if not rows or rows[0]["audio_hash"] != _hash_or_none(segment_job.audio_path):
+            return None
+        stages = self.stages(previous_id)
+        for stage in ("liveportrait", "sadtalker"):
+            row = stages.get(stage)
+            if row is None or row["status"] != "done":
+                continue
+            path = row["path"]
+            if not (path and os.path.exists(path) and _hash_or_none(path) == row["content_hash"]):
+                continue
+            logger.info(f"Reusing segment {previous_id} after {stage}: {path}")
+            if stage == "liveportrait":
+                segment_job.output_path = path
+            else:
+                segment_job.sadtalker_output = path
+            # Journaled under the new segment too, so a further attempt can reuse it again
+            self.record_job(segment_job, "done" if stage == "liveportrait" else stage, hash_inputs=True)
+            self.record_stage(segment_job, stage, "done", path)
+            return stage
+        return None
+
+
+journal = JobJournal()
@@ -1,9 +1,13 @@
 import os
 import sys
-import shutil
+import time
 import helpers
-import runSadTalker
-import runLivePortrait
+import job_journal
+import pipeline
+import preflight
+import quality_tiers
+import segmenter
+from metrics import metrics
 from config_manager import config
 from logger import logger  # Import the logger
 
@@ -29,6 +33,12 @@ def init_in_out_directories():
     return input_dir, output_dir
 
 def main():
+    # Optional "--tier <name>" anywhere on the command line, e.g. --tier preview
+    try:
+        tier = quality_tiers.pop_tier_argument(sys.argv)
+    except ValueError as e:
+        logger.error(e)
+        sys.exit(1)
     input_dir, output_dir = init_in_out_directories()
     inter_dir = os.path.join(os.getcwd(), "intermediate_videos")
     if not os.path.exists(inter_dir):
@@ -41,59 +51,74 @@ def main():
     # mp3_dir, wav_dir, img_dir, intermediate_dir, output_dir = helpers.get_pipeline_directories(pipeline_dir)
 
     # process mp3 to wav
-    helpers.process_audio(input_dir)
-
-    input_audio_path, input_image_path = helpers.get_file_paths(input_dir)
-
+    with metrics.span("process_audio"):
+        helpers.process_audio(input_dir)
 
-    # Run SadTalker
-    sadTalker_success, sadTalker_output = runSadTalker.run_sadtalker(sadTalker_dir, input_audio_path, output_path=inter_dir)
-    if sadTalker_success:
-        print("SadTalker processing complete.")
-        print(sadTalker_output)
-    else:
-        print("SadTalker processing failed.")
-        sys.exit(1)
+    with metrics.span("discover_inputs"):
+        input_audio_path, input_image_path = helpers.get_file_paths(input_dir)
 
-    # Rename SadTalker output: {audio_filename}_{sadTalker_output(date_time)}
-    new_path = os.path.join(
-        os.path.dirname(sadTalker_output),
-        f"{os.path.splitext(os.path.basename(input_audio_path))[0]}_{os.path.basename(sadTalker_output)}"
-    )
-    os.rename(sadTalker_output, new_path)
-    logger.info(f"Renamed SadTalker output: {new_path}")
 
-    # Update sadTalker_output variable with the new path
-    sadTalker_output = new_path
+    job = pipeline.Job(input_audio_path, input_image_path, tier=tier or "")
+    job.submitted_at = time.perf_counter()
 
-    # Run LivePortrait
-    livePortrait_success, livePortrait_output = runLivePortrait.run_liveportrait(livePortrait_dir, input_image_path, sadTalker_output, output_dir=output_dir)
+    # Reject unusable inputs before any GPU time is spent
+    try:
+        preflight.preflight.check_job(job)
+    except preflight.PreflightError as e:
+        logger.error(e)
+        sys.exit(1)
 
-    if livePortrait_success:
-        logger.info("LivePortrait processing complete.")
-        logger.info(f"LivePortrait output: {livePortrait_output}")
-        
-        # Check if the output is in the correct directory
-        if os.path.dirname(livePortrait_output) == output_dir:
-            logger.info("LivePortrait output is in the correct directory.")
-        else:
-            logger.warning("LivePortrait output is not in the expected output directory.")
-            # Optionally, move the file to the correct directory
-            new_path = os.path.join(output_dir, os.path.basename(livePortrait_output))
-            shutil.move(livePortrait_output, new_path)
-            logger.info(f"Moved LivePortrait output to: {new_path}")
-            livePortrait_output = new_path
+    # A previous run of the same inputs that died after SadTalker continues at LivePortrait
+    resumed = job_journal.journal.resume(job)
+
+    # Optional: shorten long pauses and normalize the audio before anything is rendered
+    pipeline.condition_group_audio([job], inter_dir)
+
+    if segmenter.should_segment(job) and not resumed:
+        # Long audio: render segments through both stages in parallel and stitch them
+        try:
+            livePortrait_output = segmenter.run_segmented_job(job, sadTalker_dir, livePortrait_dir, inter_dir, output_dir)
+        except pipeline.StageError as e:
+            logger.error(e)
+            sys.exit(1)
+    elif segmenter.should_stream(job) and not resumed:
+        # Single clip: LivePortrait starts on the first chunk while SadTalker renders the rest
+        try:
+            livePortrait_output = segmenter.run_streamed_job(job, sadTalker_dir, livePortrait_dir, inter_dir, output_dir)
+        except pipeline.StageError as e:
+            logger.error(e)
+            sys.exit(1)
     else:
-        logger.error("LivePortrait processing failed.")
-        sys.exit(1)
+        # Run SadTalker (already done for a resumed job)
+        if not resumed:
+            try:
+                sadTalker_output = pipeline.run_sadtalker_stage(job, sadTalker_dir, inter_dir)
+            except pipeline.StageError as e:
+                print(e)
+                sys.exit(1)
+            print("SadTalker processing complete.")
+            print(sadTalker_output)
+
+        # Run LivePortrait
+        try:
+            livePortrait_output = pipeline.run_liveportrait_stage(job, livePortrait_dir, output_dir)
+        except pipeline.StageError as e:
+            logger.error(e)
+            sys.exit(1)
+        logger.info("LivePortrait processing complete.")
+
+    # Record the render while its inputs are still in place (their content hashes go into the catalog)
+    pipeline.log_completed_job(job, OUTPUT_LOG_PATH)
 
     # clean up input & intermediate files
-    helpers.cleanup_completed_files(input_dir)
-    helpers.cleanup_completed_files(inter_dir)
+    with metrics.span("cleanup", job_id=job.job_id):
+        helpers.cleanup_completed_files(input_dir)
+        helpers.cleanup_completed_files(inter_dir)
+    metrics.export_prometheus()
+    metrics.log_summary()
 
     input_audio_file = os.path.basename(input_audio_path)
     input_image_file = os.path.basename(input_image_path)
-    helpers.save_to_output_file([input_audio_file, input_image_file, livePortrait_output], "output_list.log")
     print(f"""Process complete.
           input audio: {input_audio_file}
           input image: {input_image_file}
@@ -101,43 +126,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-
-
-
-
-
-
-
-
-
-
-
-    # #####################################################
-
-    # TESTING CODE (preserved but not executed)
-    # input_files_list = "input_files_list.txt"
-    # input_files = helpers.get_input_filenames(input_files_list)
-    # logger.info(f"input_files: {input_files}")
-    # validated_files = helpers.validate_and_update_filenames(input_files, wav_dir, img_dir)
-    # logger.info(f"validated_files: {validated_files}")
-    
-    # for audio_file, image_file in validated_files:
-    #     success = process_single_pair(audio_file, image_file, wav_dir, img_dir, intermediate_dir, output_dir, sadTalker_dir, livePortrait_dir)
-    #     if not success:
-    #         logger.error(f"Processing failed for {audio_file} and {image_file}")
-    # #####################################################
-
-
-    # test audio input file
-    # input_audio_path = os.path.join(wav_dir, "AWS_Sample1-10s.wav")
-    # input_image_path = os.path.join(img_dir, "sample_1.jpg")
-    # input_audio_filename = os.path.splitext(os.path.basename(input_audio_path))[0]
-    # input_image_filename = os.path.splitext(os.path.basename(input_image_path))[0]
-
-    # # Check if input files exist
-    # if not os.path.exists(input_audio_path):
-    #     logger.error(f"Input audio file not found: {input_audio_path}")
-    #     sys.exit(1)
-    # if not os.path.exists(input_image_path):
-    #     logger.error(f"Input image file not found: {input_image_path}")
-    #     sys.exit(1)
\ No newline at end of file
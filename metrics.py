@@ -0,0 +1,192 @@
+import json
+import math
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from datetime import datetime
+from config_manager import config
+from logger import logger  # Import the logger
+
+# CONSTANTS
+METRICS_ENABLED = config.getboolean("Metrics", "enabled", fallback=True)
+TRACE_PATH = config.get("Metrics", "trace_path", fallback="metrics/trace.jsonl")
+PROMETHEUS_PATH = config.get("Metrics", "prometheus_path", fallback="metrics/avatar_pipeline.prom")
+WINDOW = int(config.get("Metrics", "window", fallback="500"))  # Spans per stage kept for quantiles
+EXPORT_INTERVAL = config.getfloat("Metrics", "export_interval", fallback=10.0)  # Seconds between textfile exports
+QUANTILES = (0.5, 0.95)
+
+
+def quantile(values, q):
+    """
+    Nearest-rank quantile of a list of numbers.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+
+class Metrics:
+    """
+    Records a span for every pipeline stage and subprocess phase.
+
+    Each span is appended to a JSONL trace file. Rolling per-stage windows feed
+    p50/p95 durations and real-time factor (render seconds per audio second),
+    which are exported to a Prometheus node-exporter textfile.
+    """
+
+    def __init__(self, trace_path=TRACE_PATH, prometheus_path=PROMETHEUS_PATH, window=WINDOW,
+                 enabled=METRICS_ENABLED, export_interval=EXPORT_INTERVAL):
+        self.trace_path = trace_path
+        self.prometheus_path = prometheus_path
+        self.enabled = enabled
+        self.export_interval = export_interval
+        self._durations = defaultdict(lambda: deque(maxlen=window))
+        self._rtf = defaultdict(lambda: deque(maxlen=window))
+        self._count = defaultdict(int)
+        self._sum = defaultdict(float)
+        self._errors = defaultdict(int)
+        self._last_export = 0.0
+        self._lock = threading.Lock()
+        self._context = threading.local()
+
+    @contextmanager
+    def bind(self, job_id=None, audio_duration=None):
+        """
+        Tag every span recorded by this thread inside the block with a job id and input duration.
+        """
+        previous = getattr(self._context, "tags", {})
+        self._context.tags = {"job_id": job_id, "audio_duration": audio_duration}
+        try:
+            yield
+        finally:
+            self._context.tags = previous
+
+    @contextmanager
+    def span(self, stage, job_id=None, audio_duration=None, **tags):
+        """
+        Time a block of work. Exceptions are recorded as status "error" and re-raised.
+
+        Usage:
+            with metrics.span("sadtalker", job_id=job.job_id, audio_duration=12.0):
+                ...
+        """
+        start_time = time.time()
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            yield
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            self.record(stage, time.perf_counter() - start, job_id=job_id, audio_duration=audio_duration,
+                        status=status, start_time=start_time, **tags)
+
+    def record(self, stage, duration, job_id=None, audio_duration=None, status="ok", start_time=None, **tags):
+        if not self.enabled:
+            return
+        bound = getattr(self._context, "tags", {})
+        job_id = job_id or bound.get("job_id")
+        audio_duration = audio_duration or bound.get("audio_duration")
+        span = {
+            "stage": stage,
+            "job_id": job_id,
+            "start": datetime.fromtimestamp(start_time or time.time() - duration).isoformat(timespec="milliseconds"),
+            "duration": round(duration, 6),
+            "audio_duration": audio_duration,
+            "status": status,
+        }
+        span.update(tags)
+
+        with self._lock:
+            self._count[stage] += 1
+            self._sum[stage] += duration
+            self._durations[stage].append(duration)
+            if status != "ok":
+                self._errors[stage] += 1
+            if audio_duration:
+                self._rtf[stage].append(duration / audio_duration)
+            try:
+                os.makedirs(os.path.dirname(self.trace_path) or ".", exist_ok=True)
+                with open(self.trace_path, "a") as f:
+                    f.write(json.dumps(span) + "\n")
+            except OSError as e:
+                logger.warning(f"Could not write metrics trace: {e}")
+            export_due = time.monotonic() - self._last_export >= self.export_interval
+
+        if export_due:
+            self.export_prometheus()
+
+    def summary(self):
+        """
+        Returns the rolling aggregates per stage.
+        """
+        with self._lock:
+            stages = {}
+            for stage in sorted(self._count):
+                durations = list(self._durations[stage])
+                rtf = list(self._rtf[stage])
+                stages[stage] = {
+                    "count": self._count[stage],
+                    "errors": self._errors[stage],
+                    "total_seconds": self._sum[stage],
+                    "p50": quantile(durations, 0.5),
+                    "p95": quantile(durations, 0.95),
+                    "rtf_p50": quantile(rtf, 0.5),
+                    "rtf_p95": quantile(rtf, 0.95),
+                }
+        return stages
+
+    def export_prometheus(self):
+        """
+        Write all aggregates to the Prometheus textfile (atomically, via rename).
+        """
+        if not self.enabled:
+            return
+        stages = self.summary()
+        lines = [
+            "# HELP avatar_pipeline_stage_seconds Stage duration over the rolling window.",
+            "# TYPE avatar_pipeline_stage_seconds summary",
+        ]
+        for stage, values in stages.items():
+            for q, key in zip(QUANTILES, ("p50", "p95")):
+                lines.append(f'avatar_pipeline_stage_seconds{{stage="{stage}",quantile="{q}"}} {values[key]:.6f}')
+            lines.append(f'avatar_pipeline_stage_seconds_sum{{stage="{stage}"}} {values["total_seconds"]:.6f}')
+            lines.append(f'avatar_pipeline_stage_seconds_count{{stage="{stage}"}} {values["count"]}')
+
+        lines += [
+            "# HELP avatar_pipeline_stage_errors_total Stage spans that ended with an error.",
+            "# TYPE avatar_pipeline_stage_errors_total counter",
+        ]
+        lines += [f'avatar_pipeline_stage_errors_total{{stage="{stage}"}} {values["errors"]}' for stage, values in stages.items()]
+
+        lines += [
+            "# HELP avatar_pipeline_real_time_factor Render seconds per second of input audio.",
+            "# TYPE avatar_pipeline_real_time_factor gauge",
+        ]
+        for stage, values in stages.items():
+            for q, key in zip(QUANTILES, ("rtf_p50", "rtf_p95")):
+                if values[key] is not None:
+                    lines.append(f'avatar_pipeline_real_time_factor{{stage="{stage}",quantile="{q}"}} {values[key]:.6f}')
+
+        try:
+            os.makedirs(os.path.dirname(self.prometheus_path) or ".", exist_ok=True)
+            tmp_path = f"{self.prometheus_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(tmp_path, self.prometheus_path)
+        except OSError as e:
+            logger.warning(f"Could not export Prometheus metrics: {e}")
+        with self._lock:
+            self._last_export = time.monotonic()
+
+    def log_summary(self):
+        for stage, values in self.summary().items():
+            rtf = f", RTF p50 {values['rtf_p50']:.2f}" if values["rtf_p50"] is not None else ""
+            logger.info(f"[metrics] {stage}: n={values['count']} p50 {values['p50']:.2f}s p95 {values['p95']:.2f}s{rtf}")
+
+
+metrics = Metrics()
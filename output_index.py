@@ -0,0 +1,92 @@
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+import catalog
+from config_manager import config
+from logger import logger  # Import the logger
+
+# CONSTANTS
+LEGACY_INDEX_PATH = config.get("Pipeline", "output_index", fallback="output_index.jsonl")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stage_outputs (
+    job_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    path TEXT NOT NULL,
+    time TEXT NOT NULL,
+    metadata TEXT,
+    PRIMARY KEY (job_id, stage)
+);
+"""
+
+
+class OutputIndex:
+    """
+    Record of stage results, one row per (job_id, stage) in the catalog database.
+
+    Recording replaces the earlier result of the same stage, and a lookup is a single primary
+    key query, so nothing is loaded up front and the record never needs compacting. The
+    JSON-lines index of earlier versions is imported on first use and renamed to <name>.imported.
+    """
+
+    def __init__(self, path=catalog.CATALOG_PATH, legacy_path=LEGACY_INDEX_PATH):
+        self.path = path
+        self.legacy_path = legacy_path
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _db(self):
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(SCHEMA)
+            if self.legacy_path and os.path.exists(self.legacy_path):
+                self._import_legacy(self.legacy_path)
+        return self._connection
+
+    def _import_legacy(self, legacy_path):
+        rows = []
+        with open(legacy_path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    job_id, stage, path = entry.pop("job_id"), entry.pop("stage"), entry.pop("path")
+                except (ValueError, KeyError):
+                    logger.warning(f"Skipping corrupt line in {legacy_path}")
+                    continue
+                rows.append((job_id, stage, path, entry.pop("time", ""), json.dumps(entry)))
+        # Later lines replace earlier ones for the same stage, as they did in the JSON-lines index
+        with self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO stage_outputs VALUES (?, ?, ?, ?, ?)", rows)
+        os.replace(legacy_path, f"{legacy_path}.imported")
+        logger.info(f"Imported {len(rows)} stage results from {legacy_path} into {self.path}")
+
+    def record(self, job_id, stage, path, **metadata):
+        entry = {"job_id": job_id, "stage": stage, "path": path, "time": datetime.now().isoformat(timespec="seconds")}
+        entry.update(metadata)
+        try:
+            with self._lock:
+                db = self._db()
+                with db:
+                    db.execute("INSERT OR REPLACE INTO stage_outputs VALUES (?, ?, ?, ?, ?)",
+                               (job_id, stage, path, entry["time"], json.dumps(metadata, default=str)))
+        except sqlite3.Error as e:
+            logger.error(f"Could not record the {stage} output of job {job_id}: {e}")
+        return entry
+
+    def lookup(self, job_id, stage):
+        """
+        Returns the recorded path for a job's stage, or None.
+        """
+        with self._lock:
+            row = self._db().execute("SELECT path FROM stage_outputs WHERE job_id = ? AND stage = ?",
+                                     (job_id, stage)).fetchone()
+        return row[0] if row else None
+
+
+index = OutputIndex()
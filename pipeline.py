@@ -0,0 +1,556 @@
+import os
+import sys
+import queue
+import shutil
+import threading
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+import audio_conditioning
+import catalog
+import helpers
+import time
+import job_journal
+import output_index
+import preflight
+import quality_tiers
+import runSadTalker
+import runLivePortrait
+import segmenter
+import worker_client
+from metrics import metrics
+from config_manager import config
+from logger import logger  # Import the logger
+
+# CONSTANTS
+QUEUE_SIZE = int(config.get("Batch", "queue_size", fallback="2"))
+OUTPUT_LOG_PATH = config.get("Batch", "output_log", fallback="output_list.log")
+WRITE_OUTPUT_LOG = config.getboolean("Catalog", "write_output_log", fallback=True)  # Legacy text log next to the catalog
+
+# Sentinel pushed through the stage queues to signal shutdown
+_STOP = object()
+
+
+def new_job_id(audio_path):
+    """
+    Build a unique, human readable job id: {audio_filename}_{date_time}_{short uuid}
+    Stage outputs are named after the job id, so concurrent jobs never share a path.
+    """
+    audio_filename = os.path.splitext(os.path.basename(audio_path))[0]
+    date_time = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return f"{audio_filename}_{date_time}_{uuid.uuid4().hex[:8]}"
+
+
+def new_batch_id():
+    """
+    Build a unique id for a group of jobs submitted together: batch_{date_time}_{short uuid}
+    """
+    return f"batch_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+
+
+@dataclass
+class Job:
+    audio_path: str
+    image_path: str
+    job_id: str = ""
+    status: str = "pending"
+    sadtalker_output: Optional[str] = None
+    output_path: Optional[str] = None
+    error: Optional[str] = None
+    progress: Dict[str, float] = field(default_factory=dict)
+    audio_duration: Optional[float] = None
+    submitted_at: Optional[float] = None
+    batch_id: Optional[str] = None
+    params: Dict[str, object] = field(default_factory=dict)  # Render parameters, recorded in the catalog
+    timings: Dict[str, float] = field(default_factory=dict)  # Seconds per stage, and "total"
+    conditioned_audio_path: Optional[str] = None  # Render-ready copy of the audio (see audio_conditioning)
+    prepared_image_path: Optional[str] = None  # Cropped/downscaled copy of an oversized image (see preflight)
+    tier: str = ""  # Quality tier name (see quality_tiers); empty = the default tier
+    parent_job_id: Optional[str] = None  # Set on the segments of a long job (see segmenter)
+
+    def __post_init__(self):
+        if not self.job_id:
+            self.job_id = new_job_id(self.audio_path)
+        if self.audio_duration is None:
+            self.audio_duration = helpers.get_audio_duration(self.audio_path)
+        # Raises ValueError for an unknown tier, before the job is queued
+        self.tier = quality_tiers.get_tier(self.tier).name
+        self.params["tier"] = self.tier
+
+    @property
+    def render_audio_path(self):
+        """The audio the engines render: the conditioned copy if there is one, else the input."""
+        return self.conditioned_audio_path or self.audio_path
+
+    @property
+    def render_image_path(self):
+        """The image LivePortrait animates: the preflight-normalized copy if there is one, else the input."""
+        return self.prepared_image_path or self.image_path
+
+
+class StageError(RuntimeError):
+    """Raised when a pipeline stage fails for a single job."""
+
+
+def run_sadtalker_stage(job, sadTalker_dir, inter_dir, worker=None, on_progress=None):
+    """
+    Run SadTalker for a job. The driving video is written to {inter_dir}/{job_id}.mp4.
+
+    Args:
+    job (Job): The job to process. job.sadtalker_output is set on success.
+    sadTalker_dir (str): SadTalker repository directory.
+    inter_dir (str): Directory for intermediate (driving) videos.
+    worker (EngineWorker, optional): Resident SadTalker worker to render on.
+    on_progress (callable, optional): Receives stream_runner.ProgressEvent updates.
+    """
+    job_journal.journal.record_job(job, "sadtalker", hash_inputs=True)
+    job.params["expression_scale"] = quality_tiers.get_tier(job.tier).sadtalker.get("expression_scale", runSadTalker.EXPRESSION_SCALE)
+    start = time.perf_counter()
+    with metrics.bind(job.job_id, job.audio_duration), metrics.span("sadtalker"):
+        sadTalker_success, sadTalker_output = runSadTalker.run_sadtalker(sadTalker_dir, job.render_audio_path, output_path=inter_dir, worker=worker, job_id=job.job_id, on_progress=on_progress, tier=job.tier)
+    job.timings["sadtalker"] = time.perf_counter() - start
+    if not sadTalker_success:
+        job_journal.journal.record_stage(job, "sadtalker", "failed")
+        job_journal.journal.record_job(job, "failed")
+        raise StageError("SadTalker processing failed.")
+
+    output_index.index.record(job.job_id, "sadtalker", sadTalker_output, audio=job.render_audio_path)
+    job.sadtalker_output = sadTalker_output
+    job_journal.journal.record_stage(job, "sadtalker", "done", sadTalker_output)
+    return sadTalker_output
+
+
+def run_liveportrait_stage(job, livePortrait_dir, output_dir, worker=None, on_progress=None, encode=True):
+    """
+    Run LivePortrait for a job, driving job.image_path with job.sadtalker_output, and encode
+    the result with the job's quality tier settings.
+
+    Args:
+    job (Job): The job to process. job.output_path is set on success.
+    livePortrait_dir (str): LivePortrait repository directory.
+    output_dir (str): Directory for final videos.
+    worker (EngineWorker, optional): Resident LivePortrait worker to render on.
+    on_progress (callable, optional): Receives stream_runner.ProgressEvent updates.
+    encode (bool): Apply the tier's output encoding (segments are encoded once, after stitching).
+    """
+    job_journal.journal.record_job(job, "liveportrait", hash_inputs=True)
+    start = time.perf_counter()
+    with metrics.bind(job.job_id, job.audio_duration), metrics.span("liveportrait"):
+        livePortrait_success, livePortrait_output = runLivePortrait.run_liveportrait(livePortrait_dir, job.render_image_path, job.sadtalker_output, output_dir=output_dir, worker=worker, job_id=job.job_id, on_progress=on_progress, audio_path=job.render_audio_path, tier=job.tier)
+    job.timings["liveportrait"] = time.perf_counter() - start
+    if not livePortrait_success or not livePortrait_output:
+        job_journal.journal.record_stage(job, "liveportrait", "failed")
+        job_journal.journal.record_job(job, "failed")
+        raise StageError("LivePortrait processing failed.")
+
+    logger.info(f"LivePortrait output: {livePortrait_output}")
+
+    # Check if the output is in the correct directory
+    if os.path.dirname(livePortrait_output) != output_dir:
+        logger.warning("LivePortrait output is not in the expected output directory.")
+        new_path = os.path.join(output_dir, os.path.basename(livePortrait_output))
+        shutil.move(livePortrait_output, new_path)
+        logger.info(f"Moved LivePortrait output to: {new_path}")
+        livePortrait_output = new_path
+
+    if encode:
+        encode_job_output(job, livePortrait_output)
+
+    batch = {"batch_id": job.batch_id} if job.batch_id else {}
+    output_index.index.record(job.job_id, "liveportrait", livePortrait_output, audio=job.audio_path, image=job.image_path, **batch)
+    job.output_path = livePortrait_output
+    job_journal.journal.record_stage(job, "liveportrait", "done", livePortrait_output)
+    job_journal.journal.record_job(job, "done")
+    return livePortrait_output
+
+
+def encode_job_output(job, video_path):
+    """
+    Re-encode a job's final video to its tier's resolution, frame rate and encoder settings (if any).
+    """
+    tier = quality_tiers.get_tier(job.tier)
+    if not tier.reencodes:
+        return
+    with metrics.bind(job.job_id, job.audio_duration), metrics.span("encode", tier=tier.name):
+        error = quality_tiers.encode_output(video_path, tier)
+    if error:
+        job_journal.journal.record_stage(job, "liveportrait", "failed")
+        job_journal.journal.record_job(job, "failed")
+        raise StageError(f"Encoding the {tier.name} output failed: {error}")
+
+
+def log_completed_job(job, output_log=OUTPUT_LOG_PATH):
+    """
+    Record a finished job in the catalog (and the legacy output log, if enabled).
+    """
+    if job.submitted_at is not None:
+        job.timings["total"] = time.perf_counter() - job.submitted_at
+    catalog.catalog.record(job)
+    if WRITE_OUTPUT_LOG:
+        entry = [os.path.basename(job.audio_path), os.path.basename(job.image_path), job.output_path]
+        helpers.save_to_output_file(entry + [job.batch_id] if job.batch_id else entry, output_log)
+
+
+def condition_group_audio(jobs, inter_dir):
+    """
+    Condition the audio shared by a job or fan-out group once, before SadTalker (see audio_conditioning).
+    """
+    lead = jobs[0]
+    if audio_conditioning.condition_job(lead, inter_dir):
+        for job in jobs[1:]:
+            job.conditioned_audio_path = lead.conditioned_audio_path
+            job.audio_duration = lead.audio_duration
+            job.params["audio_conditioning"] = lead.params["audio_conditioning"]
+
+
+class BatchPipeline:
+    """
+    Two-stage pipeline: one thread runs SadTalker, one runs LivePortrait.
+
+    Jobs flow through bounded queues, so SadTalker can work on job N+1 while
+    LivePortrait finishes job N, and neither stage runs far ahead of the other.
+    """
+
+    def __init__(self, sadTalker_dir, livePortrait_dir, inter_dir, output_dir,
+                 queue_size=QUEUE_SIZE, output_log=OUTPUT_LOG_PATH,
+                 on_complete: Optional[Callable[[Job], None]] = None,
+                 on_progress: Optional[Callable[[Job, object], None]] = None,
+                 sadtalker_worker=None, liveportrait_worker=None, keep_jobs=True):
+        self.sadTalker_dir = sadTalker_dir
+        self.livePortrait_dir = livePortrait_dir
+        self.inter_dir = inter_dir
+        self.output_dir = output_dir
+        self.output_log = output_log
+        self.on_complete = on_complete
+        self.on_progress = on_progress
+        self.sadtalker_worker = sadtalker_worker
+        self.liveportrait_worker = liveportrait_worker
+        # Long-running services drop finished jobs instead of keeping every job in self.jobs
+        self.keep_jobs = keep_jobs
+
+        self.sadtalker_queue = queue.Queue(maxsize=queue_size)
+        self.liveportrait_queue = queue.Queue(maxsize=queue_size)
+        self.jobs: List[Job] = []
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        self._threads = [
+            threading.Thread(target=self._sadtalker_worker, name="sadtalker-stage", daemon=True),
+            threading.Thread(target=self._liveportrait_worker, name="liveportrait-stage", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        logger.info(f"Batch pipeline started (queue size: {self.sadtalker_queue.maxsize})")
+        return self
+
+    def submit(self, job: Job):
+        """Queue a job. Blocks while the SadTalker queue is full."""
+        with self._lock:
+            self.jobs.append(job)
+        job.status = "queued"
+        job.submitted_at = time.perf_counter()
+        self.sadtalker_queue.put(job)
+        return job
+
+    def submit_group(self, jobs: List[Job]):
+        """
+        Queue jobs that share one audio file (fan-out to several images).
+        SadTalker runs once for the group and every job's LivePortrait run uses the shared driving video.
+        Blocks while the SadTalker queue is full.
+        """
+        if len({job.audio_path for job in jobs}) > 1:
+            raise ValueError("All jobs in a group must share the same audio")
+        with self._lock:
+            self.jobs.extend(jobs)
+        for job in jobs:
+            job.status = "queued"
+            job.submitted_at = time.perf_counter()
+        self.sadtalker_queue.put(list(jobs))
+        return jobs
+
+    def close(self):
+        """Wait for all submitted jobs to finish and stop the stage threads."""
+        self.sadtalker_queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        metrics.export_prometheus()
+        metrics.log_summary()
+        logger.info("Batch pipeline stopped")
+
+    def _finish(self, job, status, error=None):
+        job.status = status
+        job.error = error
+        job_journal.journal.record_job(job, status)
+        if job.submitted_at is not None:
+            # End-to-end time including queueing
+            metrics.record("job", time.perf_counter() - job.submitted_at, job_id=job.job_id,
+                           audio_duration=job.audio_duration, status="ok" if status == "done" else "error")
+        if status == "failed":
+            logger.error(f"Job {job.job_id} failed: {error}")
+        else:
+            logger.info(f"Job {job.job_id} complete: {job.output_path}")
+            log_completed_job(job, self.output_log)
+        if not self.keep_jobs:
+            with self._lock:
+                self.jobs.remove(job)
+        if self.on_complete:
+            self.on_complete(job)
+
+    def _progress_callback(self, job):
+        def report(event):
+            previous = job.progress.get(event.stage, -1)
+            job.progress[event.stage] = event.percent
+            # Log every 10% so long renders show they are alive without flooding the log
+            if int(event.percent) // 10 != int(previous) // 10:
+                logger.info(f"Job {job.job_id} {event.stage} {event.label}: {event.percent:.0f}%")
+            if self.on_progress:
+                self.on_progress(job, event)
+        return report
+
+    def _sadtalker_worker(self):
+        while True:
+            job = self.sadtalker_queue.get()
+            if job is _STOP:
+                self.liveportrait_queue.put(_STOP)
+                return
+            group = self._preflight(job if isinstance(job, list) else [job])
+            if not group:
+                continue
+            condition_group_audio(group, self.inter_dir)
+            if segmenter.should_segment(group[0]):
+                # Long audio: segments are rendered through both stages in parallel, then stitched.
+                # A fan-out group renders SadTalker once per segment and LivePortrait per image.
+                self._run_segmented(group)
+                continue
+            lead = group[0]
+            if lead.sadtalker_output and os.path.exists(lead.sadtalker_output):
+                # Resumed from the journal: SadTalker already finished for this job
+                logger.info(f"Job {lead.job_id} resumes at LivePortrait")
+                for job in group:
+                    job.sadtalker_output = lead.sadtalker_output
+                    self.liveportrait_queue.put(job)
+                continue
+            for job in group:
+                job.status = "sadtalker"
+            try:
+                run_sadtalker_stage(lead, self.sadTalker_dir, self.inter_dir, worker=self.sadtalker_worker, on_progress=self._progress_callback(lead))
+            except Exception as e:
+                for job in group:
+                    self._finish(job, "failed", str(e))
+                continue
+            for job in group:
+                if job is not lead:
+                    # Fan-out: every image of the group is driven by the same SadTalker video
+                    job.sadtalker_output = lead.sadtalker_output
+                    job.progress.update(lead.progress)
+                self.liveportrait_queue.put(job)
+
+    def _preflight(self, group):
+        # Jobs with inputs that cannot be rendered fail here, before any GPU time is spent
+        passed = []
+        for job in group:
+            try:
+                preflight.preflight.check_job(job)
+            except preflight.PreflightError as e:
+                self._finish(job, "failed", str(e))
+                continue
+            passed.append(job)
+        return passed
+
+    def _run_segmented(self, group):
+        for job in group:
+            job.status = "segmented"
+        try:
+            results = segmenter.run_segmented_group(group, self.sadTalker_dir, self.livePortrait_dir, self.inter_dir, self.output_dir,
+                                                    sadtalker_worker=self.sadtalker_worker, liveportrait_worker=self.liveportrait_worker,
+                                                    on_progress=[self._progress_callback(job) for job in group])
+        except Exception as e:
+            results = [(None, e)] * len(group)
+        for job, (_, error) in zip(group, results):
+            if error is not None:
+                self._finish(job, "failed", str(error))
+            else:
+                self._finish(job, "done")
+
+    def _liveportrait_worker(self):
+        while True:
+            job = self.liveportrait_queue.get()
+            if job is _STOP:
+                return
+            job.status = "liveportrait"
+            try:
+                run_liveportrait_stage(job, self.livePortrait_dir, self.output_dir, worker=self.liveportrait_worker, on_progress=self._progress_callback(job))
+            except Exception as e:
+                self._finish(job, "failed", str(e))
+                continue
+            self._finish(job, "done")
+
+
+def load_manifest(manifest_path, input_dir, tier=""):
+    """
+    Read a manifest of audio/image pairs (one "audio, image" pair per line).
+
+    File names are resolved against input_dir. MP3 entries are mapped to the
+    WAV produced by helpers.process_audio. Every job renders at the given quality tier.
+
+    Returns:
+    list: A list of Job objects for every valid pair.
+    """
+    input_files = helpers.get_input_filenames(manifest_path)
+    input_files = [
+        (os.path.splitext(audio)[0] + ".wav" if audio.lower().endswith(".mp3") else audio, image)
+        for audio, image in input_files
+    ]
+    validated_pairs = helpers.validate_and_update_filenames(input_files, input_dir, input_dir)
+    return [Job(os.path.join(input_dir, audio), os.path.join(input_dir, image), tier=tier)
+            for audio, image in validated_pairs]
+
+
+def archive_completed_inputs(jobs, inter_dir):
+    """
+    Move the inputs and intermediates of successful jobs to their 'completed' directories.
+    Inputs shared with a failed job are left in place so the job can be retried.
+    """
+    keep = {path for job in jobs if job.status != "done" for path in (job.audio_path, job.image_path)}
+    moved = set()
+    for job in jobs:
+        if job.status != "done":
+            continue
+        for path in (job.audio_path, job.image_path):
+            if path in keep or path in moved or not os.path.exists(path):
+                continue
+            helpers.move_to_completed(path)
+            moved.add(path)
+        archive_job_intermediates(job, inter_dir, moved)
+
+
+def archive_job_intermediates(job, inter_dir, moved=None):
+    """
+    Move a job's driving video, motion template and conditioned audio to {inter_dir}/completed.
+    Fan-out jobs share these files; pass the same moved set to move them once.
+    """
+    moved = set() if moved is None else moved
+    if not job.sadtalker_output:
+        return
+    for path in (job.sadtalker_output, runLivePortrait.motion_template_path(job.sadtalker_output),
+                 job.conditioned_audio_path):
+        if path and path not in moved and os.path.exists(path):
+            helpers.move_to_completed(path, os.path.join(inter_dir, "completed"))
+            moved.add(path)
+
+
+def load_unfinished_jobs():
+    """
+    Rebuild the jobs the journal lists as unfinished (latest attempt per input pair).
+    Long jobs are rebuilt whole and reuse their finished segments (see segmenter).
+    Jobs whose SadTalker stage is intact resume at LivePortrait; jobs whose inputs are gone are skipped.
+
+    Returns:
+    list: A list of Job objects.
+    """
+    jobs = []
+    for row in job_journal.journal.unfinished():
+        if not (os.path.exists(row["audio_path"]) and os.path.exists(row["image_path"])):
+            logger.info(f"Not resuming job {row['job_id']}: its inputs are gone")
+            continue
+        try:
+            job = Job(row["audio_path"], row["image_path"], job_id=row["job_id"], batch_id=row["batch_id"], tier=row["tier"] or "")
+        except ValueError as e:
+            logger.warning(f"Not resuming job {row['job_id']}: {e}")
+            continue
+        job_journal.journal.resume(job)
+        jobs.append(job)
+    return jobs
+
+
+def run_jobs(jobs, output_dir, queue_size=QUEUE_SIZE):
+    """
+    Run jobs through the batch pipeline, then archive the inputs of successful jobs.
+
+    Returns:
+    list: The jobs, with their final status.
+    """
+    inter_dir = os.path.join(os.getcwd(), "intermediate_videos")
+    os.makedirs(inter_dir, exist_ok=True)
+    parent_dir, pipeline_dir, sadTalker_dir, livePortrait_dir = helpers.get_directories()
+
+    # Keep one resident process per engine so models are loaded only once per batch
+    sadtalker_worker = liveportrait_worker = None
+    if worker_client.WORKERS_ENABLED:
+        sadtalker_worker, liveportrait_worker = worker_client.start_workers(sadTalker_dir, livePortrait_dir)
+
+    try:
+        batch = BatchPipeline(sadTalker_dir, livePortrait_dir, inter_dir, output_dir, queue_size=queue_size,
+                              sadtalker_worker=sadtalker_worker, liveportrait_worker=liveportrait_worker).start()
+        for job in jobs:
+            batch.submit(job)
+        batch.close()
+    finally:
+        for worker in (sadtalker_worker, liveportrait_worker):
+            if worker is not None:
+                worker.stop()
+
+    with metrics.span("cleanup"):
+        archive_completed_inputs(jobs, inter_dir)
+    metrics.export_prometheus()
+    job_journal.journal.flush()
+
+    failed = [job for job in jobs if job.status != "done"]
+    logger.info(f"Batch complete: {len(jobs) - len(failed)} succeeded, {len(failed)} failed")
+    return jobs
+
+
+def run_batch(manifest_path, input_dir, output_dir, queue_size=QUEUE_SIZE, tier=""):
+    # process mp3 to wav
+    with metrics.span("process_audio"):
+        helpers.process_audio(input_dir)
+
+    jobs = load_manifest(manifest_path, input_dir, tier)
+    if not jobs:
+        logger.error(f"No valid jobs found in manifest: {manifest_path}")
+        return []
+    logger.info(f"Loaded {len(jobs)} jobs from {manifest_path}")
+
+    # Jobs interrupted after SadTalker in an earlier run pick up at LivePortrait
+    for job in jobs:
+        job_journal.journal.resume(job)
+
+    return run_jobs(jobs, output_dir, queue_size)
+
+
+def main():
+    try:
+        tier = quality_tiers.pop_tier_argument(sys.argv)
+    except ValueError as e:
+        logger.error(e)
+        sys.exit(1)
+    if len(sys.argv) < 2:
+        print("Usage: python pipeline.py <manifest.csv> [input_dir] [output_dir] [--tier <name>]")
+        print("       python pipeline.py --resume [output_dir]   (rerun unfinished jobs from the journal)")
+        print(f"Tiers: {', '.join(sorted(quality_tiers.TIERS))} (default {quality_tiers.DEFAULT_TIER})")
+        sys.exit(1)
+
+    if sys.argv[1] == "--resume":
+        output_dir = os.path.join(os.getcwd(), sys.argv[2] if len(sys.argv) > 2 else "output")
+        os.makedirs(output_dir, exist_ok=True)
+        jobs = load_unfinished_jobs()
+        if not jobs:
+            logger.info("No unfinished jobs to resume")
+            return
+        logger.info(f"Resuming {len(jobs)} unfinished jobs")
+        jobs = run_jobs(jobs, output_dir)
+    else:
+        manifest_path = sys.argv[1]
+        input_dir = os.path.join(os.getcwd(), sys.argv[2] if len(sys.argv) > 2 else "input")
+        output_dir = os.path.join(os.getcwd(), sys.argv[3] if len(sys.argv) > 3 else "output")
+        os.makedirs(output_dir, exist_ok=True)
+        jobs = run_batch(manifest_path, input_dir, output_dir, tier=tier or "")
+    if not jobs or any(job.status != "done" for job in jobs):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,372 @@
+import hashlib
+import json
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import threading
+import time
+import wave
+import numpy as np
+import helpers
+from config_manager import config
+from metrics import metrics
+from logger import logger  # Import the logger
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Optional: image decoding and resizing (OpenCV is used instead if present)
+    Image = None
+try:
+    import cv2
+except ImportError:  # Optional: face detection, and image decoding without Pillow
+    cv2 = None
+
+# CONSTANTS
+PREFLIGHT_ENABLED = config.getboolean("Preflight", "enabled", fallback=True)
+MIN_AUDIO_SECONDS = config.getfloat("Preflight", "min_audio_seconds", fallback=0.5)
+MAX_AUDIO_SECONDS = config.getfloat("Preflight", "max_audio_seconds", fallback=600.0)  # 0 = no limit
+MIN_SAMPLE_RATE = int(config.get("Preflight", "min_sample_rate", fallback="8000"))
+MIN_IMAGE_SIDE = int(config.get("Preflight", "min_image_side", fallback="256"))
+MAX_IMAGE_SIDE = int(config.get("Preflight", "max_image_side", fallback="1280"))  # LivePortrait's source_max_dim
+CROP_SCALE = config.getfloat("Preflight", "crop_scale", fallback=3.0)  # Crop side of an oversized portrait, in face widths
+REQUIRE_FACE = config.getboolean("Preflight", "require_face", fallback=True)
+CACHE_DIR = config.get("Preflight", "cache_dir", fallback=".cache/preflight")
+FFPROBE = config.get("Audio", "ffprobe", fallback="ffprobe")
+FACE_DETECT_SIDE = 640  # Faces are searched on a copy no larger than this
+
+
+class PreflightError(ValueError):
+    """Raised when a job's inputs cannot be rendered. The message lists every reason."""
+
+
+def _settings_key(kind):
+    # Cached results are only reused while the limits they were checked against are unchanged
+    settings = {
+        "audio": (MIN_AUDIO_SECONDS, MAX_AUDIO_SECONDS, MIN_SAMPLE_RATE),
+        "image": (MIN_IMAGE_SIDE, MAX_IMAGE_SIDE, CROP_SCALE, REQUIRE_FACE, Image is not None, cv2 is not None),
+    }[kind]
+    return hashlib.sha256(json.dumps(settings).encode("utf-8")).hexdigest()[:12]
+
+
+def _ffprobe(path):
+    """
+    Returns:
+    dict: Format and first audio stream as reported by ffprobe, or {"error": ...}.
+    """
+    command = [FFPROBE, "-v", "error", "-show_entries", "format=format_name,duration:stream=codec_type,codec_name,sample_rate,channels",
+               "-of", "json", path]
+    try:
+        process = subprocess.run(command, capture_output=True, text=True)
+    except OSError as e:
+        return {"error": str(e)}
+    if process.returncode != 0:
+        return {"error": process.stderr.strip() or f"ffprobe exited with {process.returncode}"}
+    info = json.loads(process.stdout or "{}")
+    streams = [stream for stream in info.get("streams", []) if stream.get("codec_type") == "audio"]
+    return {"format": info.get("format", {}), "stream": streams[0] if streams else None}
+
+
+def probe_audio(path):
+    """
+    Check that an audio file can be rendered: a readable 16-bit PCM WAV with samples,
+    a usable sample rate and a duration within [min_audio_seconds, max_audio_seconds].
+
+    Returns:
+    dict: {"ok", "reasons", "warnings", "duration", "sample_rate", "channels", "format"}
+    """
+    result = {"ok": True, "reasons": [], "warnings": [], "duration": None, "sample_rate": None, "channels": None,
+              "format": None}
+    try:
+        with wave.open(path, "rb") as wav_file:
+            sample_width = wav_file.getsampwidth()
+            result.update(sample_rate=wav_file.getframerate(), channels=wav_file.getnchannels(),
+                          format=f"wav/pcm_s{8 * sample_width}le")
+            frames = wav_file.getnframes()
+        result["duration"] = frames / result["sample_rate"] if result["sample_rate"] else 0.0
+        if sample_width != 2:
+            result["reasons"].append(f"{8 * sample_width}-bit WAV; the engines need 16-bit PCM")
+        if frames == 0:
+            result["reasons"].append("the WAV has no audio samples")
+    except (EOFError, wave.Error) as e:
+        # Not a plain PCM WAV (compressed, float, truncated header...): ask ffprobe what it is
+        info = _ffprobe(path)
+        if "error" in info:
+            result["reasons"].append(f"cannot read the audio ({e or 'truncated WAV'}; ffprobe: {info['error']})")
+        elif info["stream"] is None:
+            result["reasons"].append("the file contains no audio stream")
+        else:
+            stream = info["stream"]
+            result.update(format=f"{info['format'].get('format_name')}/{stream.get('codec_name')}",
+                          sample_rate=int(stream.get("sample_rate") or 0), channels=stream.get("channels"))
+            result["duration"] = float(info["format"].get("duration") or 0.0)
+            result["reasons"].append(f"{result['format']} is not a 16-bit PCM WAV; convert it with ffmpeg first")
+
+    duration = result["duration"]
+    if duration is not None and 0 < duration < MIN_AUDIO_SECONDS:
+        result["reasons"].append(f"audio is {duration:.2f}s, shorter than {MIN_AUDIO_SECONDS:g}s")
+    if duration and MAX_AUDIO_SECONDS and duration > MAX_AUDIO_SECONDS:
+        result["reasons"].append(f"audio is {duration / 60:.1f} min, longer than {MAX_AUDIO_SECONDS / 60:g} min")
+    if result["sample_rate"] and result["sample_rate"] < MIN_SAMPLE_RATE:
+        result["reasons"].append(f"sample rate {result['sample_rate']} Hz is below {MIN_SAMPLE_RATE} Hz")
+    if result["channels"] and result["channels"] > 1:
+        result["warnings"].append(f"{result['channels']} channels; SadTalker renders the downmix")
+    result["ok"] = not result["reasons"]
+    return result
+
+
+def _image_header_size(path):
+    """
+    Read the size of a PNG or JPEG from its header. Used only when no image library is installed.
+
+    Returns:
+    tuple: (width, height), or None if the header is not recognized.
+    """
+    with open(path, "rb") as f:
+        head = f.read(26)
+        if head[:8] == b"\x89PNG\r\n\x1a\n" and head[12:16] == b"IHDR":
+            return struct.unpack(">II", head[16:24])
+        if head[:2] != b"\xff\xd8":
+            return None
+        f.seek(2)
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                return None
+            if marker[1] in (0xD8, 0x01) or 0xD0 <= marker[1] <= 0xD7:
+                continue
+            length_bytes = f.read(2)
+            if len(length_bytes) < 2:
+                return None
+            length = struct.unpack(">H", length_bytes)[0]
+            if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack(">xHH", f.read(5))
+                return width, height
+            f.seek(length - 2, os.SEEK_CUR)
+
+
+def _load_image(path):
+    """
+    Decode an image to an RGB uint8 array (EXIF orientation applied when Pillow is used).
+
+    Returns:
+    numpy.ndarray: Shape (height, width, 3).
+    """
+    if Image is not None:
+        with Image.open(path) as image:
+            return np.asarray(ImageOps.exif_transpose(image).convert("RGB"))
+    pixels = cv2.imread(path, cv2.IMREAD_COLOR)
+    if pixels is None:
+        raise ValueError("OpenCV cannot decode the image")
+    return cv2.cvtColor(pixels, cv2.COLOR_BGR2RGB)
+
+
+def _resize(pixels, width, height):
+    if Image is not None:
+        return np.asarray(Image.fromarray(pixels).resize((width, height), Image.LANCZOS))
+    return cv2.resize(pixels, (width, height), interpolation=cv2.INTER_AREA)
+
+
+def _save_image(pixels, path):
+    tmp_path = path + ".tmp" + os.path.splitext(path)[1]
+    if Image is not None:
+        Image.fromarray(pixels).save(tmp_path, quality=95)
+    else:
+        cv2.imwrite(tmp_path, cv2.cvtColor(pixels, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, 95])
+    os.replace(tmp_path, path)
+
+
+def detect_faces(pixels):
+    """
+    Find frontal faces with OpenCV's Haar cascade on a reduced copy of the image.
+
+    Returns:
+    list: (x, y, width, height) boxes in full-image pixels, largest first; None if no detector is available.
+    """
+    if cv2 is None or not hasattr(cv2, "CascadeClassifier"):  # OpenCV 5 moved the cascades out of the main package
+        return None
+    scale = min(1.0, FACE_DETECT_SIDE / max(pixels.shape[:2]))
+    gray = cv2.cvtColor(pixels, cv2.COLOR_RGB2GRAY)
+    if scale < 1.0:
+        gray = cv2.resize(gray, (int(gray.shape[1] * scale), int(gray.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+    cascade = cv2.CascadeClassifier(os.path.join(cv2.data.haarcascades, "haarcascade_frontalface_default.xml"))
+    boxes = cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(40, 40))
+    boxes = sorted((tuple(int(value / scale) for value in box) for box in boxes), key=lambda box: box[2] * box[3], reverse=True)
+    return boxes
+
+
+def _crop_box(width, height, face):
+    """
+    Square crop of CROP_SCALE face widths around the face, shifted to stay inside the image.
+    """
+    x, y, face_width, face_height = face
+    side = min(width, height, int(max(face_width, face_height) * CROP_SCALE))
+    center_x, center_y = x + face_width // 2, y + face_height // 2
+    left = min(max(0, center_x - side // 2), width - side)
+    top = min(max(0, center_y - side // 2), height - side)
+    return left, top, side, side
+
+
+def probe_image(path, normalized_path):
+    """
+    Check that a portrait can be rendered, and write a normalized copy if it is oversized.
+
+    The image must decode, be at least min_image_side on its short side and, with OpenCV
+    installed and require_face set, show a face. An image larger than max_image_side is
+    cropped around its largest face (crop_scale face widths) and downscaled to fit, which is
+    all LivePortrait would use of it anyway.
+
+    Returns:
+    dict: {"ok", "reasons", "warnings", "width", "height", "faces", "normalized", "normalized_size"}
+    """
+    result = {"ok": True, "reasons": [], "warnings": [], "width": None, "height": None, "faces": None,
+              "normalized": None, "normalized_size": None}
+    if Image is None and cv2 is None:
+        size = _image_header_size(path)
+        if size is None:
+            result["reasons"].append("not a PNG or JPEG image")
+        else:
+            result["width"], result["height"] = size
+            result["warnings"].append("Pillow/OpenCV not installed: image decoding, resizing and face checks skipped")
+            if min(size) < MIN_IMAGE_SIDE:
+                result["reasons"].append(f"image is {size[0]}x{size[1]}, smaller than {MIN_IMAGE_SIDE}px on its short side")
+        result["ok"] = not result["reasons"]
+        return result
+
+    try:
+        pixels = _load_image(path)
+    except Exception as e:
+        result["reasons"].append(f"cannot decode the image: {e}")
+        result["ok"] = False
+        return result
+    height, width = pixels.shape[:2]
+    result.update(width=width, height=height)
+    if min(width, height) < MIN_IMAGE_SIDE:
+        result["reasons"].append(f"image is {width}x{height}, smaller than {MIN_IMAGE_SIDE}px on its short side")
+
+    faces = detect_faces(pixels)
+    if faces is None:
+        result["warnings"].append("no OpenCV face detector available: face check skipped")
+    else:
+        result["faces"] = len(faces)
+        if not faces:
+            (result["reasons"] if REQUIRE_FACE else result["warnings"]).append("no face detected in the image")
+        elif len(faces) > 1:
+            result["warnings"].append(f"{len(faces)} faces detected; LivePortrait animates the largest")
+
+    if not result["reasons"] and max(width, height) > MAX_IMAGE_SIDE:
+        if faces:
+            left, top, crop_width, crop_height = _crop_box(width, height, faces[0])
+            pixels = np.ascontiguousarray(pixels[top:top + crop_height, left:left + crop_width])
+        scale = min(1.0, MAX_IMAGE_SIDE / max(pixels.shape[:2]))
+        new_width, new_height = int(round(pixels.shape[1] * scale)), int(round(pixels.shape[0] * scale))
+        if scale < 1.0:
+            pixels = _resize(pixels, new_width, new_height)
+        _save_image(pixels, normalized_path)
+        result["normalized"] = normalized_path
+        result["normalized_size"] = [new_width, new_height]
+        result["warnings"].append(f"{width}x{height} image {'cropped and ' if faces else ''}downscaled to {new_width}x{new_height}")
+    result["ok"] = not result["reasons"]
+    return result
+
+
+class Preflight:
+    """
+    CPU-only input checks run before SadTalker, so bad inputs fail in milliseconds instead
+    of after minutes of GPU time. Results (and normalized images) are cached by content hash
+    under cache_dir, so a re-submitted input is not probed again.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, enabled=PREFLIGHT_ENABLED):
+        self.cache_dir = cache_dir
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._memo = {}
+
+    def _entry_dir(self, kind, content_hash):
+        return os.path.join(self.cache_dir, kind, content_hash[:2], f"{content_hash}_{_settings_key(kind)}")
+
+    def _check(self, kind, path):
+        start = time.perf_counter()
+        content_hash = helpers.hash_file(path)
+        entry_dir = self._entry_dir(kind, content_hash)
+        result_path = os.path.join(entry_dir, "result.json")
+        with self._lock:
+            result = self._memo.get(result_path)
+        if result is None:
+            try:
+                with open(result_path, "r") as f:
+                    result = json.load(f)
+            except (OSError, ValueError):
+                result = None
+        if result is not None and (not result.get("normalized") or os.path.exists(result["normalized"])):
+            # A separate stage, so cache hits neither count as errors nor skew the probe timings
+            metrics.record(f"preflight.{kind}.cached", time.perf_counter() - start, cached=True)
+        else:
+            os.makedirs(entry_dir, exist_ok=True)
+            with metrics.span(f"preflight.{kind}"):
+                if kind == "audio":
+                    result = probe_audio(path)
+                else:
+                    result = probe_image(path, os.path.join(entry_dir, "normalized" + os.path.splitext(path)[1].lower()))
+            with open(result_path + ".tmp", "w") as f:
+                json.dump(result, f, indent=2)
+            os.replace(result_path + ".tmp", result_path)
+        with self._lock:
+            self._memo[result_path] = result
+        return result
+
+    def check_job(self, job):
+        """
+        Check a job's audio and image. An oversized image is replaced for rendering by its
+        normalized copy (job.prepared_image_path), named like the input so outputs keep their names.
+
+        Raises:
+        PreflightError: If an input cannot be rendered; the message gives every reason.
+        """
+        if not self.enabled:
+            return
+        audio = self._check("audio", job.audio_path)
+        image = self._check("image", job.image_path)
+        for kind, result in (("audio", audio), ("image", image)):
+            for warning in result["warnings"]:
+                logger.warning(f"Preflight {kind} {os.path.basename(getattr(job, kind + '_path'))}: {warning}")
+        reasons = [f"audio: {reason}" for reason in audio["reasons"]] + [f"image: {reason}" for reason in image["reasons"]]
+        job.params["preflight"] = {"audio": {key: audio[key] for key in ("duration", "sample_rate", "channels", "format")},
+                                   "image": {key: image[key] for key in ("width", "height", "faces")}}
+        if reasons:
+            raise PreflightError(f"Inputs rejected for job {job.job_id}: " + "; ".join(reasons))
+
+        if image["normalized"]:
+            # One link per input name next to the cached copy
+            prepared_path = os.path.abspath(os.path.join(os.path.dirname(image["normalized"]), os.path.basename(job.image_path)))
+            if not os.path.exists(prepared_path):
+                try:
+                    os.link(image["normalized"], prepared_path)
+                except OSError:
+                    shutil.copyfile(image["normalized"], prepared_path)
+            job.prepared_image_path = prepared_path
+            job.params["preflight"]["image"]["normalized_size"] = image["normalized_size"]
+
+
+preflight = Preflight()
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python preflight.py <audio or image> [...]")
+        sys.exit(1)
+    failed = False
+    for path in sys.argv[1:]:
+        kind = "image" if path.lower().endswith((".png", ".jpg", ".jpeg")) else "audio"
+        result = preflight._check(kind, path)
+        failed |= not result["ok"]
+        print(f"{path}: {'ok' if result['ok'] else 'REJECTED'}")
+        for line in result["reasons"] + result["warnings"]:
+            print(f"  - {line}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
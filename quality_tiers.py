@@ -0,0 +1,178 @@
+import os
+import subprocess
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+from config_manager import config
+from logger import logger  # Import the logger
+
+# CONSTANTS
+DEFAULT_TIER = config.get("Tiers", "default", fallback="standard")
+FFMPEG = config.get("Audio", "ffmpeg", fallback="ffmpeg")
+SECTION_PREFIX = "Tier."
+# Engine options every tier starts from (the pipeline's original fixed flags)
+BASE_SADTALKER = {"preprocess": "full", "still": True}
+BASE_LIVEPORTRAIT = {"flag_crop_driving_video": True}
+
+
+@dataclass(frozen=True)
+class Tier:
+    """
+    A named render quality: SadTalker options (inference.py arguments), LivePortrait options
+    (ArgumentConfig fields) and how the final video is encoded. Encoding settings left unset
+    keep LivePortrait's output as rendered.
+    """
+    name: str
+    sadtalker: Dict[str, object] = field(default_factory=dict)
+    liveportrait: Dict[str, object] = field(default_factory=dict)
+    output_height: int = 0  # 0 = as rendered; never upscales
+    output_fps: float = 0  # 0 = as rendered
+    video_codec: str = "libx264"
+    crf: Optional[int] = None
+    preset: Optional[str] = None
+
+    @property
+    def reencodes(self):
+        return bool(self.output_height or self.output_fps or self.crf is not None or self.preset)
+
+
+def _parse_value(text):
+    text = text.strip()
+    if text == "":
+        return None
+    if text.lower() in ("true", "false"):
+        return text.lower() == "true"
+    for cast in (int, float):
+        try:
+            return cast(text)
+        except ValueError:
+            pass
+    return text
+
+
+def load_tiers(parser=config):
+    """
+    Read the [Tier.<name>] sections of config.ini. Keys prefixed sadtalker_ / liveportrait_
+    set engine options on top of the base flags; the other keys set the output encoding.
+
+    Returns:
+    dict: {name: Tier}. Without any tier sections, a single default tier with the base flags.
+    """
+    tiers = {}
+    for section in parser.sections():
+        if not section.startswith(SECTION_PREFIX):
+            continue
+        name = section[len(SECTION_PREFIX):]
+        sadtalker, liveportrait, encoding = dict(BASE_SADTALKER), dict(BASE_LIVEPORTRAIT), {}
+        for key, text in parser.items(section):
+            value = _parse_value(text)
+            if key.startswith("sadtalker_"):
+                sadtalker[key[len("sadtalker_"):]] = value
+            elif key.startswith("liveportrait_"):
+                liveportrait[key[len("liveportrait_"):]] = value
+            elif key in ("output_height", "output_fps", "video_codec", "crf", "preset"):
+                encoding[key] = value
+            else:
+                logger.warning(f"Unknown key in [{section}]: {key}")
+        encoding = {key: value for key, value in encoding.items() if value is not None}
+        tiers[name] = Tier(name, sadtalker, liveportrait, **encoding)
+    if not tiers:
+        tiers[DEFAULT_TIER] = Tier(DEFAULT_TIER, dict(BASE_SADTALKER), dict(BASE_LIVEPORTRAIT))
+    return tiers
+
+
+TIERS = load_tiers()
+
+
+def get_tier(name=None):
+    """
+    Returns:
+    Tier: The named tier, or the default tier for None/"".
+
+    Raises:
+    ValueError: For an unknown tier name.
+    """
+    name = name or DEFAULT_TIER
+    if name not in TIERS:
+        raise ValueError(f"Unknown quality tier '{name}' (available: {', '.join(sorted(TIERS))})")
+    return TIERS[name]
+
+
+def pop_tier_argument(argv):
+    """
+    Remove "--tier <name>" from a command line (in place) and return the name, or None.
+    """
+    if "--tier" not in argv:
+        return None
+    index = argv.index("--tier")
+    if index + 1 >= len(argv):
+        raise ValueError(f"--tier needs a name (available: {', '.join(sorted(TIERS))})")
+    name = argv[index + 1]
+    del argv[index:index + 2]
+    get_tier(name)
+    return name
+
+
+def sadtalker_cli_args(options):
+    """
+    SadTalker inference.py arguments for a set of options (True = flag, None/False = omitted).
+    """
+    args = []
+    for key, value in options.items():
+        if value is True:
+            args.append(f"--{key}")
+        elif value is not None and value is not False:
+            args += [f"--{key}", str(value)]
+    return args
+
+
+def liveportrait_cli_args(options):
+    """
+    LivePortrait inference.py arguments for a set of ArgumentConfig fields (booleans as --flag_x / --no_flag_x).
+    """
+    args = []
+    for key, value in options.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            args.append(f"--{key}" if value else f"--no_{key}")
+        else:
+            args += [f"--{key}", str(value)]
+    return args
+
+
+def encode_output(video_path, tier):
+    """
+    Re-encode a finished video in place to the tier's resolution, frame rate and encoder
+    settings. Does nothing for a tier that keeps the rendered output.
+
+    Returns:
+    str: An error message, or None on success.
+    """
+    if not tier.reencodes:
+        return None
+    filters = []
+    if tier.output_height:
+        # Downscale only, keeping the aspect ratio and an even width
+        filters.append(f"scale=-2:'min({int(tier.output_height)},ih)'")
+    if tier.output_fps:
+        filters.append(f"fps={tier.output_fps:g}")
+    command = [FFMPEG, "-hide_banner", "-loglevel", "error", "-nostdin", "-y", "-i", video_path]
+    if filters:
+        command += ["-vf", ",".join(filters)]
+    command += ["-c:v", tier.video_codec]
+    if tier.preset:
+        command += ["-preset", tier.preset]
+    if tier.crf is not None:
+        command += ["-crf", str(tier.crf)]
+    tmp_path = os.path.splitext(video_path)[0] + ".encode.mp4"
+    command += ["-pix_fmt", "yuv420p", "-c:a", "copy", "-movflags", "+faststart", tmp_path]
+    try:
+        process = subprocess.run(command, capture_output=True, text=True)
+    except OSError as e:
+        return str(e)
+    if process.returncode != 0:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return process.stderr.strip()
+    os.replace(tmp_path, video_path)
+    return None
@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import helpers
+from config_manager import config
+from logger import logger  # Import the logger
+
+# CONSTANTS
+CACHE_ENABLED = config.getboolean("Cache", "enabled", fallback=True)
+CACHE_DIR = config.get("Cache", "dir", fallback=".cache/results")
+MAX_SIZE_BYTES = int(config.getfloat("Cache", "max_size_gb", fallback=20.0) * 1024 ** 3)
+
+
+class ResultCache:
+    """
+    On-disk, content-addressed cache of rendered videos.
+
+    Entries are keyed by a hash of the input file contents plus the engine
+    parameters, and stored as <cache_dir>/<key[:2]>/<key><ext>. An entry's
+    mtime is bumped on every hit, and the least recently used entries are
+    evicted once the cache grows past max_bytes.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_SIZE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._total_bytes = None
+        self._lock = threading.Lock()
+
+    def make_key(self, stage, files, params):
+        """
+        Build a cache key.
+
+        Args:
+        stage (str): Pipeline stage, e.g. "sadtalker" or "liveportrait".
+        files (dict): Named input files; their contents are hashed. None values are allowed.
+        params (dict): Engine parameters that affect the output.
+
+        Returns:
+        str: A SHA-256 hex digest.
+        """
+        payload = {
+            "stage": stage,
+            "files": {name: helpers.hash_file(path) if path else None for name, path in sorted(files.items())},
+            "params": params,
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key, ext):
+        return os.path.join(self.cache_dir, key[:2], key + ext)
+
+    def _find_entry(self, key):
+        shard_dir = os.path.join(self.cache_dir, key[:2])
+        try:
+            for name in os.listdir(shard_dir):
+                if name.startswith(key) and not name.endswith(".tmp"):
+                    return os.path.join(shard_dir, name)
+        except FileNotFoundError:
+            pass
+        return None
+
+    @staticmethod
+    def _link_or_copy(src_path, dest_path):
+        try:
+            os.link(src_path, dest_path)
+        except OSError:
+            shutil.copy2(src_path, dest_path)
+
+    def get(self, key, dest_path):
+        """
+        Copy a cached result to dest_path.
+
+        Returns:
+        str: dest_path on a cache hit, otherwise None.
+        """
+        with self._lock:
+            entry = self._find_entry(key)
+            if entry is None:
+                return None
+            # Mark as recently used for LRU eviction
+            os.utime(entry)
+
+        os.makedirs(os.path.dirname(dest_path) or ".", exist_ok=True)
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        self._link_or_copy(entry, dest_path)
+        logger.info(f"Cache hit {key[:12]}: {dest_path}")
+        return dest_path
+
+    def put(self, key, src_path):
+        """
+        Store a copy of src_path under key and evict old entries if the cache is over its size cap.
+        """
+        entry = self._entry_path(key, os.path.splitext(src_path)[1])
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp_path = f"{entry}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            self._link_or_copy(src_path, tmp_path)
+            with self._lock:
+                existed = os.path.exists(entry)
+                os.replace(tmp_path, entry)
+                if not existed and self._total_bytes is not None:
+                    self._total_bytes += os.path.getsize(entry)
+        except OSError as e:
+            logger.warning(f"Could not cache {src_path}: {e}")
+            return None
+        logger.info(f"Cached {src_path} as {key[:12]}")
+        self.evict()
+        return entry
+
+    def _entries(self):
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in max_bytes.
+        The cache tree is only walked when the running total says it is over the cap.
+        """
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = sum(size for _, size, _ in self._entries())
+            if self._total_bytes <= self.max_bytes:
+                return
+
+            entries = sorted(self._entries())
+            self._total_bytes = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if self._total_bytes <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                self._total_bytes -= size
+                logger.info(f"Evicted cache entry: {path}")
+
+
+cache = ResultCache()
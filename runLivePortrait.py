@@ -1,77 +1,191 @@
 import subprocess
 import glob
 import os
+import shlex
 from datetime import datetime
+import audio_ingest
 import helpers
+import conda_env
+import quality_tiers
+import device_scheduler
+import result_cache
 import shutil
+from metrics import metrics
 from config_manager import config
+from worker_client import WorkerError
 from logger import logger  # Import the logger
 
 # Configuration Constants
 LIVEPORTRAIT_SCRIPT = config.get("LivePortrait", "script")
 OUTPUT_DIR = config.get("LivePortrait", "output_dir")
+# Drive later runs from the <driving>.pkl motion template LivePortrait saves next to a driving video
+USE_MOTION_TEMPLATES = config.getboolean("LivePortrait", "use_motion_templates", fallback=True)
 
-def run_liveportrait(root_dir, input_image_path, input_video_path, output_dir):
-    logger.info("Starting LivePortrait processing")
 
-    # Construct the output directory path
-    LivePortrait_output_dir = os.path.join(root_dir, OUTPUT_DIR)
+def motion_template_path(driving_video_path):
+    """
+    Returns the path LivePortrait dumps a driving video's motion template to.
+    """
+    return os.path.splitext(driving_video_path)[0] + ".pkl"
 
-    # Get the command for setting CUDA environment
-    cuda_env_command = helpers.get_cuda_env_path()
 
-    # Get the conda source command dynamically
-    conda_source_command = helpers.get_conda_source_command()
+def run_liveportrait(root_dir, input_image_path, input_video_path, output_dir, worker=None, job_id=None, on_progress=None, audio_path=None, tier=None):
+    logger.info("Starting LivePortrait processing")
 
-    # Prepare the full commands to be executed in the shell
-    full_commands = [
-        conda_source_command,
-        cuda_env_command[0],
-        cuda_env_command[1],
-        f"cd {root_dir}",
-        "conda activate liveportrait",
-        "nvcc --version"
-    ]
+    # ArgumentConfig fields of the job's quality tier
+    options = dict(quality_tiers.get_tier(tier).liveportrait)
+
+    # Construct the output directory path
+    LivePortrait_output_dir = os.path.join(root_dir, OUTPUT_DIR)
 
+    # With a job id, LivePortrait renders into its own directory and the output
+    # path is known up front, so nothing has to be searched for
+    if job_id:
+        LivePortrait_output_dir = os.path.join(LivePortrait_output_dir, job_id)
+
+    # Reuse a cached render of the same portrait and driving video if possible
+    cache_key = None
+    if result_cache.CACHE_ENABLED:
+        try:
+            cache_key = result_cache.cache.make_key(
+                "liveportrait",
+                {"source": input_image_path, "driving": input_video_path},
+                {"script": LIVEPORTRAIT_SCRIPT, **options},
+            )
+        except OSError as e:
+            logger.warning(f"Skipping LivePortrait cache lookup: {e}")
+        else:
+            s_filename = os.path.splitext(os.path.basename(input_image_path))[0]
+            d_filename = job_id or os.path.splitext(os.path.basename(input_video_path))[0]
+            cached_path = result_cache.cache.get(cache_key, os.path.join(output_dir, f"{s_filename}--{d_filename}.mp4"))
+            if cached_path:
+                logger.info(f"LivePortrait result served from cache: {cached_path}")
+                return True, cached_path
+
+    def render(driving_path):
+        # Send the job to a resident worker if one is available
+        if worker is not None:
+            return run_liveportrait_on_worker(worker, input_image_path, driving_path, output_dir, LivePortrait_output_dir, options, job_id, on_progress)
+        return run_liveportrait_cli(root_dir, input_image_path, driving_path, output_dir, LivePortrait_output_dir, options, job_id, on_progress)
+
+    # The first run of a driving video crops it and extracts its keypoints; LivePortrait saves the
+    # result as a motion template, so later runs (other portraits, retries) skip decoding and detection
+    template_path = motion_template_path(input_video_path)
+    if USE_MOTION_TEMPLATES and os.path.exists(template_path):
+        logger.info(f"Driving LivePortrait from motion template: {template_path}")
+        success, output_path = render(template_path)
+        if success and output_path:
+            # Template renders have no audio track; restore the job's audio
+            with metrics.span("liveportrait.mux_audio"):
+                error = audio_ingest.mux_audio(output_path, audio_path or input_video_path)
+            if error:
+                logger.error(f"Adding audio to {output_path} failed: {error}")
+                success, output_path = False, None
+        else:
+            logger.warning(f"Motion template render failed, retrying with the driving video: {input_video_path}")
+            success, output_path = render(input_video_path)
+    else:
+        success, output_path = render(input_video_path)
+
+    if success and output_path and cache_key:
+        with metrics.span("liveportrait.cache_put"):
+            result_cache.cache.put(cache_key, output_path)
+    return success, output_path
+
+def run_liveportrait_cli(root_dir, input_image_path, input_video_path, output_dir, LivePortrait_output_dir, options, job_id=None, on_progress=None):
     # Construct the LivePortrait inference command
     inference_command = [
-        "python",
         LIVEPORTRAIT_SCRIPT,
         "-s", input_image_path,
         "-d", input_video_path,
         "-o", LivePortrait_output_dir,
-        "--flag_crop_driving_video"
-    ]
-
-    # Join inference_command into a single string
-    inference_command_str = " ".join(inference_command)
-    logger.info(inference_command_str)
-
-    # Append the inference command to the list of commands
-    full_commands.append(inference_command_str)
+    ] + quality_tiers.liveportrait_cli_args(options)  # --flag_crop_driving_video... of the tier
 
     try:
-        # Execute the commands in a shell
-        helpers.run_commands(full_commands)
+        # Activated liveportrait env (captured once and cached on disk)
+        with metrics.span("liveportrait.conda_env"):
+            env = conda_env.get_env("liveportrait")
+        inference_command.insert(0, conda_env.get_python(env))
+        logger.info(shlex.join(inference_command))
+
+        # Execute the inference script directly in the LivePortrait directory, pinned to a free GPU slot
+        with device_scheduler.scheduler.slot("liveportrait") as device, metrics.span("liveportrait.exec", device=device):
+            if device is not None:
+                logger.info(f"LivePortrait running on CUDA device {device}")
+            helpers.run_command(inference_command, cwd=root_dir, env=device_scheduler.pin_env(env, device),
+                                stage="liveportrait", on_progress=on_progress)
 
         # Get the latest file in the output directory
         s_filename = os.path.splitext(os.path.basename(input_image_path))[0]
         d_filename = os.path.splitext(os.path.basename(input_video_path))[0]
         logger.info(f"s_filename: {s_filename}, d_filename: {d_filename}")
 
-        output_video_path = get_output_video_path(LivePortrait_output_dir, s_filename, d_filename)
+        if job_id:
+            output_video_path = os.path.join(LivePortrait_output_dir, f"{s_filename}--{d_filename}.mp4")
+            if not os.path.exists(output_video_path):
+                logger.error(f"LivePortrait output not found: {output_video_path}")
+                return False, None
+            with metrics.span("liveportrait.collect"):
+                output_path = collect_job_output(output_video_path, output_dir, job_id, input_image_path)
+        else:
+            output_video_path = get_output_video_path(LivePortrait_output_dir, s_filename, d_filename)
 
-        # Move the output file to the desired directory
-        shutil.move(output_video_path, output_dir)
-        output_path = os.path.join(output_dir, os.path.basename(output_video_path))
+            # Move the output file to the desired directory
+            shutil.move(output_video_path, output_dir)
+            output_path = os.path.join(output_dir, os.path.basename(output_video_path))
 
         logger.info(f"LivePortrait processing complete. Output saved to: {output_path}")
         return True, output_path
 
-    except subprocess.CalledProcessError as e:
+    except (subprocess.CalledProcessError, RuntimeError, OSError) as e:
         logger.error(f"Error running LivePortrait: {e}")
         return False, None
 
+def run_liveportrait_on_worker(worker, input_image_path, input_video_path, output_dir, LivePortrait_output_dir, options, job_id=None, on_progress=None):
+    try:
+        with metrics.span("liveportrait.worker"):
+            result = worker.render(
+                source=input_image_path,
+                driving=input_video_path,
+                output_dir=LivePortrait_output_dir,
+                **options,
+                on_progress=on_progress,
+            )
+    except WorkerError as e:
+        logger.error(f"Error running LivePortrait on worker: {e}")
+        return False, None
+
+    # The worker reports its output path, so there is no need to search the output directory
+    with metrics.span("liveportrait.collect"):
+        output_path = collect_job_output(result["output"], output_dir, job_id, input_image_path)
+
+    logger.info(f"LivePortrait processing complete. Output saved to: {output_path}")
+    return True, output_path
+
+def collect_job_output(output_video_path, output_dir, job_id=None, input_image_path=None):
+    """
+    Move a LivePortrait result to output_dir. For per-job renders, the result is named
+    {image}--{job_id}.mp4 (fan-out jobs share a driving video named after another job),
+    the _concat.mp4 companion is filed under animations/concat and the job's render
+    directory is removed.
+    """
+    output_name = os.path.basename(output_video_path)
+    if job_id and input_image_path:
+        output_name = f"{os.path.splitext(os.path.basename(input_image_path))[0]}--{job_id}.mp4"
+    output_path = os.path.join(output_dir, output_name)
+    shutil.move(output_video_path, output_path)
+
+    if job_id:
+        render_dir = os.path.dirname(output_video_path)
+        concat_path = os.path.splitext(output_video_path)[0] + "_concat.mp4"
+        if os.path.exists(concat_path):
+            concat_dir = os.path.join(os.path.dirname(render_dir), "concat")
+            os.makedirs(concat_dir, exist_ok=True)
+            shutil.move(concat_path, os.path.join(concat_dir, os.path.basename(concat_path)))
+        shutil.rmtree(render_dir, ignore_errors=True)
+
+    return output_path
+
 # Returns the path of the output video file (latest file in output directory)
 def get_output_video_path(output_dir, s_filename, d_filename):
     try:
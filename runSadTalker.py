@@ -1,9 +1,18 @@
 import subprocess
 import glob
 import os
+import shlex
+import shutil
 from datetime import datetime
 import helpers
+import conda_env
+import quality_tiers
+import device_scheduler
+import result_cache
+import sadtalker_prep
+from metrics import metrics
 from config_manager import config
+from worker_client import WorkerError
 from logger import logger  # Import the logger
 
 # Constants
@@ -18,37 +27,60 @@ OUTPUT_PATH = os.path.expanduser(config.get("SadTalker", "output_path"))
 full_template_image_path = os.path.join(os.getcwd(), TEMPLATE_IMAGE_PATH)
 
 
-def run_sadtalker(sadTalker_dir, input_audio_path, image_path=full_template_image_path, output_path=OUTPUT_PATH, expression_scale=EXPRESSION_SCALE, ref_blink=None, ref_head=None):
+def run_sadtalker(sadTalker_dir, input_audio_path, image_path=full_template_image_path, output_path=OUTPUT_PATH, expression_scale=EXPRESSION_SCALE, ref_blink=None, ref_head=None, worker=None, job_id=None, on_progress=None, tier=None):
     logger.info("Starting SadTalker processing")
 
-    # Get command for setting CUDA environment
-    cuda_env_command = helpers.get_cuda_env_path()
-
-    # Get the conda source command dynamically
-    conda_source_command = helpers.get_conda_source_command()
-
-    # Prepare the full commands to be executed in the shell
-    full_commands = [
-        conda_source_command,
-        cuda_env_command[0], 
-        cuda_env_command[1], 
-        f"cd {sadTalker_dir}",
-        "pwd",
-        "conda activate sadtalker", 
-        "nvcc --version"
-    ]
-
+    # Engine options of the job's quality tier; expression_scale applies unless the tier sets its own
+    options = {"expression_scale": expression_scale, **quality_tiers.get_tier(tier).sadtalker}
+
+    # With a job id the result goes to a deterministic path, {output_path}/{job_id}.mp4,
+    # and SadTalker renders into its own {output_path}/{job_id}/ directory
+    render_dir = os.path.join(output_path, job_id) if job_id else output_path
+    final_path = os.path.join(output_path, f"{job_id}.mp4") if job_id else None
+
+    # The output only depends on the input contents and engine parameters, so reuse a cached render if possible
+    cache_key = None
+    if result_cache.CACHE_ENABLED:
+        try:
+            cache_key = result_cache.cache.make_key(
+                "sadtalker",
+                {"audio": input_audio_path, "image": image_path, "ref_blink": ref_blink, "ref_head": ref_head},
+                {"script": SADTALKER_SCRIPT, **options},
+            )
+        except OSError as e:
+            logger.warning(f"Skipping SadTalker cache lookup: {e}")
+        else:
+            cached_path = result_cache.cache.get(cache_key, final_path or os.path.join(output_path, datetime.now().strftime("%Y_%m_%d_%H.%M.%S") + ".mp4"))
+            if cached_path:
+                logger.info(f"SadTalker result served from cache: {cached_path}")
+                return True, cached_path
+
+    # Send the job to a resident worker if one is available
+    if worker is not None:
+        success, output_video_path = run_sadtalker_on_worker(worker, input_audio_path, image_path, render_dir, options, ref_blink, ref_head, on_progress)
+    else:
+        success, output_video_path = run_sadtalker_cli(sadTalker_dir, input_audio_path, image_path, render_dir, options, ref_blink, ref_head, on_progress)
+
+    if success and final_path:
+        with metrics.span("sadtalker.collect"):
+            os.replace(output_video_path, final_path)
+            shutil.rmtree(render_dir, ignore_errors=True)
+        output_video_path = final_path
+        logger.info(f"SadTalker output moved to: {final_path}")
+
+    if success and cache_key:
+        with metrics.span("sadtalker.cache_put"):
+            result_cache.cache.put(cache_key, output_video_path)
+    return success, output_video_path
+
+def run_sadtalker_cli(sadTalker_dir, input_audio_path, image_path, output_path, options, ref_blink=None, ref_head=None, on_progress=None):
     # Construct the SadTalker inference command
     inference_command = [
-        "python",
         SADTALKER_SCRIPT,
         "--driven_audio", input_audio_path,
         "--source_image", image_path,
         "--result_dir", output_path,
-        "--still",
-        "--preprocess", "full",  # Using 'full' for better quality
-        "--expression_scale", str(expression_scale)
-    ]
+    ] + quality_tiers.sadtalker_cli_args(options)  # --preprocess, --still, --expression_scale... of the tier
 
     # Add optional parameters if provided
     if ref_blink is not None:
@@ -56,17 +88,20 @@ def run_sadtalker(sadTalker_dir, input_audio_path, image_path=full_template_imag
     if ref_head is not None:
         inference_command.extend(["--ref_pose", ref_head])
 
-    # Join inference_command into a single string for logging
-    inference_command_str = " ".join(inference_command)
-    logger.info(inference_command_str)
-
-    # Append the SadTalker command to the list of commands
-    full_commands.append(inference_command_str)
-
     try:
-        # Execute the commands in a shell
-        helpers.run_commands(full_commands)
-        
+        # Activated sadtalker env (captured once and cached on disk)
+        with metrics.span("sadtalker.conda_env"):
+            env = conda_env.get_env("sadtalker", CUDA_VERSION)
+        inference_command.insert(0, conda_env.get_python(env))
+        logger.info(shlex.join(inference_command))
+
+        # Execute the inference script directly in the SadTalker directory, pinned to a free GPU slot
+        with device_scheduler.scheduler.slot("sadtalker") as device, metrics.span("sadtalker.exec", device=device):
+            if device is not None:
+                logger.info(f"SadTalker running on CUDA device {device}")
+            helpers.run_command(inference_command, cwd=sadTalker_dir, env=device_scheduler.pin_env(env, device),
+                                stage="sadtalker", on_progress=on_progress)
+
         # Look for mp4 files directly in the output path
         output_files = glob.glob(os.path.join(output_path, "*.mp4"))
 
@@ -86,6 +121,47 @@ def run_sadtalker(sadTalker_dir, input_audio_path, image_path=full_template_imag
         logger.error(f"Unexpected error in run_sadtalker: {e}")
         return False, None
 
+def get_worker_conditioning(worker, image_path, ref_blink=None, ref_head=None, preprocess="full", size=256):
+    """
+    Look up (or prepare once) the precomputed crop info and 3DMM coefficients for the
+    template image and reference videos. Falls back to raw media if preparation fails.
+    """
+    conditioning = {}
+    try:
+        conditioning["source_conditioning"] = sadtalker_prep.get_conditioning(worker, image_path, "source", preprocess, size)
+        if ref_blink is not None:
+            conditioning["ref_eyeblink_coeff"] = sadtalker_prep.get_conditioning(worker, ref_blink, "reference", preprocess, size)["coeff"]
+        if ref_head is not None:
+            conditioning["ref_pose_coeff"] = sadtalker_prep.get_conditioning(worker, ref_head, "reference", preprocess, size)["coeff"]
+    except (WorkerError, OSError) as e:
+        logger.warning(f"Using raw SadTalker inputs, conditioning unavailable: {e}")
+        return {}
+    return conditioning
+
+def run_sadtalker_on_worker(worker, input_audio_path, image_path, output_path, options, ref_blink=None, ref_head=None, on_progress=None):
+    with metrics.span("sadtalker.conditioning"):
+        conditioning = get_worker_conditioning(worker, image_path, ref_blink, ref_head, options.get("preprocess", "full"),
+                                               int(options.get("size") or 256))
+    try:
+        with metrics.span("sadtalker.worker"):
+            result = worker.render(
+                driven_audio=input_audio_path,
+                source_image=image_path,
+                result_dir=output_path,
+                ref_eyeblink=ref_blink,
+                ref_pose=ref_head,
+                **options,
+                **conditioning,
+                on_progress=on_progress,
+            )
+    except WorkerError as e:
+        logger.error(f"Error running SadTalker on worker: {e}")
+        return False, None
+
+    output_video_path = result["output"]
+    logger.info(f"SadTalker processing complete. Output saved to: {output_video_path}")
+    return True, output_video_path
+
 def main():
     print(os.getcwd())
     subprocess.run("echo 'Hello, World!'", shell=True)
@@ -0,0 +1,105 @@
+import glob
+import json
+import os
+import shutil
+import sys
+import helpers
+from config_manager import config
+from logger import logger  # Import the logger
+
+# CONSTANTS
+CONDITIONING_DIR = config.get("SadTalker", "conditioning_dir", fallback=".cache/sadtalker_conditioning")
+DEFAULT_SOURCE_DIR = "SadTalker_default_source"
+META_FILE = "meta.json"
+
+
+def _entry_dir(digest, kind, preprocess, size):
+    return os.path.join(CONDITIONING_DIR, f"{digest}_{kind}_{preprocess}_{size}")
+
+
+def _load_meta(entry_dir):
+    try:
+        with open(os.path.join(entry_dir, META_FILE), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _remove_stale_entries(media_path, kind, digest):
+    """
+    Drop artifacts prepared from an older version of the same file.
+    """
+    media_path = os.path.abspath(media_path)
+    for entry_dir in glob.glob(os.path.join(CONDITIONING_DIR, f"*_{kind}_*")):
+        meta = _load_meta(entry_dir)
+        if meta and meta.get("media") == media_path and meta.get("hash") != digest:
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            logger.info(f"Removed stale SadTalker conditioning: {entry_dir}")
+
+
+def get_conditioning(worker, media_path, kind, preprocess="full", size=256):
+    """
+    Returns precomputed SadTalker conditioning for a template image or reference video,
+    preparing it on the SadTalker worker the first time the file's content is seen.
+
+    Args:
+    worker (EngineWorker): Resident SadTalker worker.
+    media_path (str): Template image (kind "source") or reference video (kind "reference").
+    preprocess (str): SadTalker preprocess mode the artifacts are extracted for.
+    size (int): SadTalker face model size.
+
+    Returns:
+    dict: Artifact paths ("coeff", plus "crop_pic" and "crop_info" for sources).
+    """
+    digest = helpers.hash_file(media_path)
+    entry_dir = _entry_dir(digest, kind, preprocess, size)
+    meta = _load_meta(entry_dir)
+    if meta and all(os.path.exists(path) for path in meta["artifacts"].values()):
+        return meta["artifacts"]
+
+    _remove_stale_entries(media_path, kind, digest)
+    logger.info(f"Preparing SadTalker conditioning for {media_path} ({kind})")
+    artifacts = worker.request("prepare", media=os.path.abspath(media_path), kind=kind, preprocess=preprocess,
+                               size=size, out_dir=os.path.abspath(entry_dir))
+    artifacts.pop("elapsed", None)
+
+    meta = {"media": os.path.abspath(media_path), "hash": digest, "kind": kind, "preprocess": preprocess,
+            "size": size, "artifacts": artifacts}
+    tmp_path = os.path.join(entry_dir, META_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_path, os.path.join(entry_dir, META_FILE))
+    return artifacts
+
+
+def prepare_defaults(worker, source_dir=DEFAULT_SOURCE_DIR, preprocess="full", size=256):
+    """
+    Prepare conditioning for every bundled template image and reference video.
+    """
+    prepared = 0
+    for file in sorted(os.listdir(source_dir)):
+        path = os.path.join(source_dir, file)
+        if file.lower().endswith((".png", ".jpg", ".jpeg")):
+            get_conditioning(worker, path, "source", preprocess, size)
+        elif file.lower().endswith(".mp4"):
+            get_conditioning(worker, path, "reference", preprocess, size)
+        else:
+            continue
+        prepared += 1
+    logger.info(f"Prepared SadTalker conditioning for {prepared} files in {source_dir}")
+
+
+def main():
+    from worker_client import EngineWorker
+
+    source_dir = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_SOURCE_DIR
+    parent_dir, pipeline_dir, sadTalker_dir, livePortrait_dir = helpers.get_directories()
+    worker = EngineWorker("sadtalker", sadTalker_dir).start()
+    try:
+        prepare_defaults(worker, source_dir)
+    finally:
+        worker.stop()
+
+
+if __name__ == "__main__":
+    main()
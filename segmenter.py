@@ -0,0 +1,385 @@
+import os
+import queue
+import shutil
+import subprocess
+import threading
+import wave
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import job_journal
+import output_index
+import pipeline
+from config_manager import config
+from metrics import metrics
+from logger import logger  # Import the logger
+
+# CONSTANTS
+SEGMENT_ENABLED = config.getboolean("Segment", "enabled", fallback=True)
+MAX_SEGMENT_SECONDS = config.getfloat("Segment", "max_segment_seconds", fallback=30.0)
+MIN_SEGMENT_SECONDS = config.getfloat("Segment", "min_segment_seconds", fallback=8.0)
+MIN_SILENCE_MS = config.getfloat("Segment", "min_silence_ms", fallback=250.0)
+SILENCE_THRESHOLD_DB = config.getfloat("Segment", "silence_threshold_db", fallback=-40.0)  # Relative to full scale
+SEGMENT_PARALLEL = int(config.get("Segment", "parallel", fallback="2"))  # Segments rendered at the same time
+STREAM_ENABLED = config.getboolean("Stream", "enabled", fallback=False)
+STREAM_CHUNK_SECONDS = config.getfloat("Stream", "chunk_seconds", fallback=8.0)
+STREAM_MIN_CHUNK_SECONDS = config.getfloat("Stream", "min_chunk_seconds", fallback=3.0)
+STREAM_QUEUE_DEPTH = int(config.get("Stream", "queue_depth", fallback="2"))  # SadTalker chunks waiting for LivePortrait
+FFMPEG = config.get("Audio", "ffmpeg", fallback="ffmpeg")
+VIDEO_FPS = 25  # SadTalker renders at 25 fps; cuts are aligned to frame boundaries
+FRAME_MS = 10  # Energy analysis window
+
+
+def read_wav(wav_path):
+    """
+    Returns:
+    tuple: (samples as an int16 array of shape (frames, channels), sample rate, sample width)
+    """
+    with wave.open(wav_path, "rb") as wav_file:
+        channels = wav_file.getnchannels()
+        sample_rate = wav_file.getframerate()
+        sample_width = wav_file.getsampwidth()
+        data = wav_file.readframes(wav_file.getnframes())
+    if sample_width != 2:
+        raise ValueError(f"Expected 16-bit PCM, got {8 * sample_width}-bit: {wav_path}")
+    return np.frombuffer(data, dtype=np.int16).reshape(-1, channels), sample_rate, sample_width
+
+
+def frame_energy_db(samples, sample_rate, frame_ms=FRAME_MS):
+    """
+    RMS level of each analysis frame in dBFS, computed over the whole track at once.
+    """
+    frame_length = max(1, int(sample_rate * frame_ms / 1000))
+    frame_count = len(samples) // frame_length
+    mono = samples[:frame_count * frame_length].astype(np.float32).mean(axis=1) / 32768.0
+    rms = np.sqrt(np.mean(mono.reshape(frame_count, frame_length) ** 2, axis=1))
+    return 20 * np.log10(np.maximum(rms, 1e-10)), frame_length
+
+
+def find_split_points(samples, sample_rate, max_seconds=MAX_SEGMENT_SECONDS, min_seconds=MIN_SEGMENT_SECONDS,
+                      min_silence_ms=MIN_SILENCE_MS, threshold_db=SILENCE_THRESHOLD_DB):
+    """
+    Choose cut points (in samples) so no segment is longer than max_seconds.
+
+    Cuts are placed in the middle of silent stretches of at least min_silence_ms, as late
+    as possible within each segment, and aligned to video frame boundaries. If a segment
+    has no usable silence, it is cut hard at max_seconds.
+    """
+    energy_db, frame_length = frame_energy_db(samples, sample_rate)
+    silent = np.concatenate(([False], energy_db < threshold_db, [False]))
+    edges = np.flatnonzero(np.diff(silent.astype(np.int8)))
+    starts, ends = edges[0::2], edges[1::2]
+    min_frames = max(1, int(min_silence_ms / FRAME_MS))
+    long_runs = (ends - starts) >= min_frames
+    samples_per_video_frame = sample_rate // VIDEO_FPS
+    candidates = ((starts[long_runs] + ends[long_runs]) // 2) * frame_length
+    candidates = (candidates // samples_per_video_frame) * samples_per_video_frame
+
+    total = len(samples)
+    max_length = int(max_seconds * sample_rate) // samples_per_video_frame * samples_per_video_frame
+    min_length = int(min_seconds * sample_rate)
+    cuts = []
+    start = 0
+    while total - start > max_length:
+        window = candidates[(candidates >= start + min_length) & (candidates <= start + max_length)]
+        cut = int(window[-1]) if len(window) else start + max_length
+        cuts.append(cut)
+        start = cut
+    return cuts
+
+
+def split_wav(wav_path, segment_dir, max_seconds=MAX_SEGMENT_SECONDS, min_seconds=MIN_SEGMENT_SECONDS):
+    """
+    Cut a WAV into segments at silences.
+
+    Returns:
+    list: Paths of the segment WAVs, in order (just [wav_path] if it is short enough).
+    """
+    samples, sample_rate, sample_width = read_wav(wav_path)
+    cuts = find_split_points(samples, sample_rate, max_seconds, min_seconds)
+    if not cuts:
+        return [wav_path]
+
+    os.makedirs(segment_dir, exist_ok=True)
+    base_name = os.path.splitext(os.path.basename(wav_path))[0]
+    bounds = [0] + cuts + [len(samples)]
+    segment_paths = []
+    for index, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        segment_path = os.path.join(segment_dir, f"{base_name}_s{index:02d}.wav")
+        with wave.open(segment_path, "wb") as wav_file:
+            wav_file.setnchannels(samples.shape[1])
+            wav_file.setsampwidth(sample_width)
+            wav_file.setframerate(sample_rate)
+            wav_file.writeframes(samples[start:end].tobytes())
+        segment_paths.append(segment_path)
+    logger.info(f"Split {os.path.basename(wav_path)} into {len(segment_paths)} segments at "
+                f"{', '.join(f'{cut / sample_rate:.2f}s' for cut in cuts)}")
+    return segment_paths
+
+
+def concat_videos(video_paths, audio_path, output_path):
+    """
+    Join segment videos with stream copy (no re-encode) and mux the unsplit audio.
+    """
+    list_path = output_path + ".txt"
+    with open(list_path, "w") as f:
+        for path in video_paths:
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+    tmp_path = output_path + ".part.mp4"
+    command = [FFMPEG, "-hide_banner", "-loglevel", "error", "-nostdin", "-y",
+               "-f", "concat", "-safe", "0", "-i", list_path, "-i", audio_path,
+               "-map", "0:v:0", "-map", "1:a:0", "-c:v", "copy", "-c:a", "aac", "-shortest",
+               "-movflags", "+faststart", tmp_path]
+    try:
+        process = subprocess.run(command, capture_output=True, text=True)
+    finally:
+        os.remove(list_path)
+    if process.returncode != 0:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise pipeline.StageError(f"Concatenating segments failed: {process.stderr.strip()}")
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def should_segment(job, max_seconds=MAX_SEGMENT_SECONDS):
+    return SEGMENT_ENABLED and job.audio_duration is not None and job.audio_duration > max_seconds
+
+
+def should_stream(job, chunk_seconds=STREAM_CHUNK_SECONDS):
+    return STREAM_ENABLED and job.audio_duration is not None and job.audio_duration > chunk_seconds
+
+
+def _split_job(job, inter_dir, max_seconds, min_seconds):
+    # Segments finished by an earlier failed attempt of the same inputs are reused (see _resume_segments)
+    previous_job_id = job_journal.journal.previous_segmented_attempt(job)
+    job_journal.journal.record_job(job, "segmented", hash_inputs=True)
+    segment_dir = os.path.join(inter_dir, f"{job.job_id}_segments")
+    os.makedirs(segment_dir, exist_ok=True)
+    with metrics.bind(job.job_id, job.audio_duration), metrics.span("segment.split"):
+        segment_paths = split_wav(job.render_audio_path, segment_dir, max_seconds, min_seconds)
+    segment_jobs = [pipeline.Job(path, job.render_image_path, job_id=f"{job.job_id}_s{index:02d}", tier=job.tier,
+                                 parent_job_id=job.job_id)
+                    for index, path in enumerate(segment_paths)]
+    return segment_dir, segment_jobs, previous_job_id
+
+
+def _resume_segments(job, segment_jobs, previous_job_id):
+    """
+    Returns:
+    dict: {segment job id: last reused stage} for the segments an earlier attempt already rendered.
+    """
+    if not previous_job_id:
+        return {}
+    resumed = {}
+    for segment_job in segment_jobs:
+        stage = job_journal.journal.resume_segment(segment_job, previous_job_id)
+        if stage:
+            resumed[segment_job.job_id] = stage
+    if resumed:
+        logger.info(f"Job {job.job_id} reuses {len(resumed)} of {len(segment_jobs)} segments of {previous_job_id}")
+    return resumed
+
+
+def _progress_reporter(job, segment_jobs, on_progress):
+    progress = {}
+
+    def report(segment_job):
+        def update(event):
+            # Job progress per stage is the mean over segments
+            progress[(segment_job.job_id, event.stage)] = event.percent
+            values = [value for (_, stage), value in progress.items() if stage == event.stage]
+            job.progress[event.stage] = sum(values) / len(segment_jobs)
+            if on_progress:
+                on_progress(event._replace(percent=job.progress[event.stage]))
+        return update
+    return report
+
+
+def _stitch(job, segment_jobs, segment_dir, output_dir, previous_job_id=None):
+    segment_videos = [segment_job.output_path for segment_job in segment_jobs]
+    image_name = os.path.splitext(os.path.basename(job.image_path))[0]
+    output_path = os.path.join(output_dir, f"{image_name}--{job.job_id}.mp4")
+    job.params["segments"] = len(segment_videos)
+    for stage in ("sadtalker", "liveportrait"):
+        job.timings[stage] = sum(segment_job.timings.get(stage, 0.0) for segment_job in segment_jobs)
+    with metrics.bind(job.job_id, job.audio_duration), metrics.span("segment.concat"):
+        concat_videos(segment_videos, job.render_audio_path, output_path)
+    pipeline.encode_job_output(job, output_path)
+
+    batch = {"batch_id": job.batch_id} if job.batch_id else {}
+    output_index.index.record(job.job_id, "liveportrait", output_path, audio=job.render_audio_path, image=job.image_path,
+                              segments=len(segment_videos), **batch)
+    shutil.rmtree(segment_dir, ignore_errors=True)
+    if previous_job_id and previous_job_id != job.job_id:
+        # Segments reused from the earlier attempt lived in its directory
+        shutil.rmtree(os.path.join(os.path.dirname(segment_dir), f"{previous_job_id}_segments"), ignore_errors=True)
+    job.output_path = output_path
+    job_journal.journal.record_stage(job, "liveportrait", "done", output_path)
+    job_journal.journal.record_job(job, "done")
+    return output_path
+
+
+def _follow_split(job, lead, lead_segment_jobs, inter_dir):
+    # A fan-out job renders the lead's segment audio with its own image, into its own segment directory
+    previous_job_id = job_journal.journal.previous_segmented_attempt(job)
+    job_journal.journal.record_job(job, "segmented", hash_inputs=True)
+    segment_dir = os.path.join(inter_dir, f"{job.job_id}_segments")
+    os.makedirs(segment_dir, exist_ok=True)
+    segment_jobs = [pipeline.Job(lead_segment.audio_path, job.render_image_path,
+                                 job_id=job.job_id + lead_segment.job_id[len(lead.job_id):], tier=job.tier,
+                                 parent_job_id=job.job_id, audio_duration=lead_segment.audio_duration)
+                    for lead_segment in lead_segment_jobs]
+    return segment_dir, segment_jobs, previous_job_id
+
+
+def run_segmented_group(jobs, sadTalker_dir, livePortrait_dir, inter_dir, output_dir, parallel=SEGMENT_PARALLEL,
+                        sadtalker_worker=None, liveportrait_worker=None, on_progress=None):
+    """
+    Render jobs that share one long audio file (a fan-out group) as segments.
+
+    The audio is split once and SadTalker renders every segment once, for the lead job
+    (jobs[0]). Each job's LivePortrait pass animates its own image with those segment
+    driving videos, and every job is stitched into its own video. A job that fails does
+    not fail the rest of the group, unless SadTalker fails.
+
+    Args:
+    jobs (list): Jobs with the same audio; the first one is the lead.
+    on_progress (list, optional): Per-job progress callbacks, in the order of jobs.
+
+    Returns:
+    list: (output path, None) or (None, exception) for every job, in input order.
+    """
+    lead = jobs[0]
+    lead_dir, lead_segments, lead_previous = _split_job(lead, inter_dir, MAX_SEGMENT_SECONDS, MIN_SEGMENT_SECONDS)
+    plans = [(lead, lead_dir, lead_segments, lead_previous)]
+    plans += [(job, *_follow_split(job, lead, lead_segments, inter_dir)) for job in jobs[1:]]
+    resumed = {job.job_id: _resume_segments(job, segment_jobs, previous_job_id)
+               for job, _, segment_jobs, previous_job_id in plans}
+    reports = {job.job_id: _progress_reporter(job, segment_jobs, callback)
+               for (job, _, segment_jobs, _), callback in zip(plans, on_progress or [None] * len(jobs))}
+    errors = {}
+
+    def render(index):
+        lead_segment = lead_segments[index]
+        pending = [(job, segment_dir, segment_jobs[index]) for job, segment_dir, segment_jobs, _ in plans
+                   if job.job_id not in errors and resumed[job.job_id].get(segment_jobs[index].job_id) != "liveportrait"]
+        if pending and lead_segment.sadtalker_output is None:
+            pipeline.run_sadtalker_stage(lead_segment, sadTalker_dir, lead_dir, worker=sadtalker_worker,
+                                         on_progress=reports[lead.job_id](lead_segment))
+        for job, segment_dir, segment_job in pending:
+            segment_job.sadtalker_output = lead_segment.sadtalker_output
+            try:
+                pipeline.run_liveportrait_stage(segment_job, livePortrait_dir, segment_dir, worker=liveportrait_worker,
+                                                on_progress=reports[job.job_id](segment_job), encode=False)
+            except Exception as e:
+                errors.setdefault(job.job_id, e)
+
+    logger.info(f"Rendering {len(lead_segments)} segments of job {lead.job_id} for {len(jobs)} image(s) ({parallel} at a time)")
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, parallel), thread_name_prefix="segment") as executor:
+            list(executor.map(render, range(len(lead_segments))))
+    except Exception as e:
+        # SadTalker failed: no job of the group has all of its driving videos
+        for job in jobs:
+            errors.setdefault(job.job_id, e)
+
+    # The lead goes last: its segment directory holds the audio and driving videos the other jobs render from
+    for job, segment_dir, segment_jobs, previous_job_id in plans[1:] + plans[:1]:
+        if job is not lead and "sadtalker" in lead.progress:
+            job.progress["sadtalker"] = lead.progress["sadtalker"]
+        if job.job_id not in errors:
+            try:
+                _stitch(job, segment_jobs, segment_dir, output_dir, previous_job_id)
+                logger.info(f"Segmented job {job.job_id} complete: {job.output_path}")
+                continue
+            except Exception as e:
+                errors[job.job_id] = e
+        job_journal.journal.record_job(job, "failed")
+    return [(None, errors[job.job_id]) if job.job_id in errors else (job.output_path, None) for job in jobs]
+
+
+def run_segmented_job(job, sadTalker_dir, livePortrait_dir, inter_dir, output_dir, parallel=SEGMENT_PARALLEL,
+                      sadtalker_worker=None, liveportrait_worker=None, on_progress=None):
+    """
+    Render a long job as independent segments and stitch the result.
+
+    The audio is split at silences, every segment goes through SadTalker and LivePortrait
+    (up to `parallel` segments at a time), and the segment videos are concatenated with
+    the unsplit audio into {output_dir}/{image}--{job_id}.mp4. Segment files are kept
+    in {inter_dir}/{job_id}_segments if the job fails, and a later attempt with the same
+    inputs only renders the segments that did not finish.
+
+    Returns:
+    str: The final video path (also set as job.output_path).
+    """
+    [(output_path, error)] = run_segmented_group([job], sadTalker_dir, livePortrait_dir, inter_dir, output_dir, parallel,
+                                                 sadtalker_worker, liveportrait_worker, [on_progress])
+    if error is not None:
+        raise error
+    return output_path
+
+
+def run_streamed_job(job, sadTalker_dir, livePortrait_dir, inter_dir, output_dir, chunk_seconds=STREAM_CHUNK_SECONDS,
+                     sadtalker_worker=None, liveportrait_worker=None, on_progress=None):
+    """
+    Overlap SadTalker and LivePortrait for a single clip.
+
+    The audio is cut at silences into chunks of at most chunk_seconds. SadTalker renders the
+    chunks in order and hands each finished chunk to LivePortrait through a bounded queue, so
+    LivePortrait starts after the first chunk instead of after the whole clip. The chunk videos
+    are stitched like segments. Finished chunks are kept in {inter_dir}/{job_id}_segments if
+    the job fails, and reused by a later attempt with the same inputs.
+
+    Returns:
+    str: The final video path (also set as job.output_path).
+    """
+    segment_dir, segment_jobs, previous_job_id = _split_job(job, inter_dir, chunk_seconds, STREAM_MIN_CHUNK_SECONDS)
+    resumed = _resume_segments(job, segment_jobs, previous_job_id)
+    report = _progress_reporter(job, segment_jobs, on_progress)
+    handoff = queue.Queue(maxsize=max(1, STREAM_QUEUE_DEPTH))
+    cancelled = threading.Event()
+
+    def produce():
+        try:
+            for segment_job in segment_jobs:
+                if cancelled.is_set():
+                    return
+                if segment_job.job_id not in resumed:
+                    pipeline.run_sadtalker_stage(segment_job, sadTalker_dir, segment_dir, worker=sadtalker_worker,
+                                                 on_progress=report(segment_job))
+                handoff.put(segment_job)
+        except Exception as e:
+            handoff.put(e)
+            return
+        handoff.put(None)
+
+    logger.info(f"Streaming job {job.job_id} through both stages in {len(segment_jobs)} chunks")
+    producer = threading.Thread(target=produce, name=f"stream-{job.job_id}", daemon=True)
+    producer.start()
+    try:
+        while True:
+            segment_job = handoff.get()
+            if segment_job is None:
+                break
+            if isinstance(segment_job, Exception):
+                raise segment_job
+            if resumed.get(segment_job.job_id) != "liveportrait":
+                pipeline.run_liveportrait_stage(segment_job, livePortrait_dir, segment_dir, worker=liveportrait_worker,
+                                                on_progress=report(segment_job), encode=False)
+        job.params["streamed"] = True
+        output_path = _stitch(job, segment_jobs, segment_dir, output_dir, previous_job_id)
+    except Exception:
+        job_journal.journal.record_job(job, "failed")
+        raise
+    finally:
+        # On a LivePortrait failure, let SadTalker finish its current chunk and stop
+        cancelled.set()
+        while producer.is_alive():
+            try:
+                handoff.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    logger.info(f"Streamed job {job.job_id} complete: {output_path}")
+    return output_path
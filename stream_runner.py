@@ -0,0 +1,126 @@
+import os
+import re
+import subprocess
+from collections import deque
+from typing import Callable, Iterator, NamedTuple, Optional
+from logger import logger  # Import the logger
+
+# CONSTANTS
+READ_SIZE = 64 * 1024
+MAX_LINE_LENGTH = 64 * 1024  # Longer lines are cut, so one runaway line cannot grow memory
+TAIL_LINES = 200  # Output lines kept for error reporting
+
+# tqdm: "Face Renderer:: 45%|████▌     | 17/38 [00:07<00:09,  2.30it/s]"
+# rich: "🚀Animating... ━━━━━━━━━━━━━━━━━━━━━ 45% 0:00:05"
+PROGRESS_PATTERN = re.compile(
+    r"(?P<label>[^\r\n%]*?)\s*(?P<percent>\d{1,3})%(?:\s*\|[^|]*\|\s*(?P<current>\d+)/(?P<total>\d+))?")
+_LABEL_STRIP = " :|-━─╸╺"
+
+
+class ProgressEvent(NamedTuple):
+    stage: Optional[str]
+    label: str
+    percent: float
+    current: Optional[int] = None
+    total: Optional[int] = None
+
+
+def parse_progress(line, stage=None):
+    """
+    Parse a tqdm or rich progress line into a ProgressEvent, or return None.
+    """
+    match = PROGRESS_PATTERN.search(line)
+    if not match:
+        return None
+    current = int(match.group("current")) if match.group("current") else None
+    total = int(match.group("total")) if match.group("total") else None
+    if current is not None and total:
+        percent = 100.0 * current / total
+    else:
+        percent = float(match.group("percent"))
+    if percent > 100:
+        return None
+    return ProgressEvent(stage, match.group("label").strip(_LABEL_STRIP), percent, current, total)
+
+
+def iter_lines(stream_fd) -> Iterator[str]:
+    """
+    Read a file descriptor incrementally and yield lines split on both '\\n' and '\\r',
+    so progress bars that redraw in place produce one line per update.
+    """
+    pending = b""
+    while True:
+        chunk = os.read(stream_fd, READ_SIZE)
+        if not chunk:
+            break
+        pending += chunk
+        parts = re.split(rb"[\r\n]", pending)
+        pending = parts.pop()[-MAX_LINE_LENGTH:]
+        for part in parts:
+            if part:
+                yield part[:MAX_LINE_LENGTH].decode("utf-8", errors="replace")
+    if pending:
+        yield pending.decode("utf-8", errors="replace")
+
+
+class LineDispatcher:
+    """
+    Routes output lines: progress updates to a callback, everything else to the log.
+    Keeps the last TAIL_LINES lines for error reports and drops repeated progress values.
+    """
+
+    def __init__(self, stage=None, on_progress: Optional[Callable[[ProgressEvent], None]] = None):
+        self.stage = stage
+        self.on_progress = on_progress
+        self.tail = deque(maxlen=TAIL_LINES)
+        self._last_progress = None
+
+    def feed(self, line):
+        """
+        Returns the ProgressEvent for a new progress value, the line itself for
+        regular output, or None for a repeated progress value.
+        """
+        event = parse_progress(line, self.stage)
+        if event is None:
+            self.tail.append(line)
+            # Regular engine output, including warnings and tracebacks, belongs in app.log
+            logger.info(f"[{self.stage}] {line}" if self.stage else line)
+            return line
+
+        key = (event.label, int(event.percent))
+        if key == self._last_progress:
+            return None
+        self._last_progress = key
+        if self.on_progress:
+            try:
+                self.on_progress(event)
+            except Exception as e:
+                logger.warning(f"Progress callback failed: {e}")
+        return event
+
+
+def run_streaming(args, cwd=None, env=None, stage=None, on_progress=None):
+    """
+    Run a command with bounded-memory output handling.
+
+    Args:
+        on_progress (callable): Called with a ProgressEvent for each new progress value.
+    Returns:
+        list: The last output lines (non-progress).
+    Raises:
+        subprocess.CalledProcessError: If the command exits with a non-zero status.
+    """
+    dispatcher = LineDispatcher(stage, on_progress)
+    process = subprocess.Popen(args, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    try:
+        for line in iter_lines(process.stdout.fileno()):
+            dispatcher.feed(line)
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+
+    if returncode != 0:
+        output = "\n".join(dispatcher.tail)
+        logger.error(f"Error: command exited with {returncode}:\n{output}")
+        raise subprocess.CalledProcessError(returncode, args, output)
+    return list(dispatcher.tail)
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The pipeline modules are flat files in the repository root, which also holds config.ini
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+os.chdir(ROOT_DIR)
@@ -0,0 +1,55 @@
+import threading
+import pytest
+from device_scheduler import Device, DeviceScheduler, parse_devices
+
+
+def test_parse_devices():
+    assert parse_devices("0:24, 1") == [Device("0", 24.0), Device("1", None)]
+    assert parse_devices("") == []
+
+
+def test_disabled_scheduler_yields_no_device():
+    scheduler = DeviceScheduler([])
+    with scheduler.slot("sadtalker") as device:
+        assert device is None
+
+
+def test_engines_share_a_card_while_budgets_fit():
+    scheduler = DeviceScheduler([Device("0", 24.0)], {"sadtalker": 16.0, "liveportrait": 6.0})
+    with scheduler.slot("sadtalker") as first, scheduler.slot("liveportrait") as second:
+        assert first == second == "0"
+        assert scheduler.usage()["0"] == {"jobs": 2, "used_gb": 22.0, "memory_gb": 24.0}
+        # A second SadTalker job does not fit next to them
+        with pytest.raises(TimeoutError):
+            scheduler.acquire("sadtalker", timeout=0.1)
+    assert scheduler.usage()["0"]["jobs"] == 0
+
+
+def test_least_loaded_device_is_chosen():
+    scheduler = DeviceScheduler([Device("0", 24.0), Device("1", 24.0)], {"sadtalker": 8.0})
+    with scheduler.slot("sadtalker") as first, scheduler.slot("sadtalker") as second:
+        assert {first, second} == {"0", "1"}
+
+
+def test_unsized_device_runs_one_job_at_a_time():
+    scheduler = DeviceScheduler([Device("0")], {"sadtalker": 8.0, "liveportrait": 4.0})
+    acquired = threading.Event()
+
+    def second_job():
+        with scheduler.slot("liveportrait"):
+            acquired.set()
+
+    with scheduler.slot("sadtalker"):
+        thread = threading.Thread(target=second_job)
+        thread.start()
+        assert not acquired.wait(0.2)
+    assert acquired.wait(2)
+    thread.join()
+
+
+def test_slot_is_released_when_the_block_raises():
+    scheduler = DeviceScheduler([Device("0")])
+    with pytest.raises(RuntimeError):
+        with scheduler.slot("sadtalker"):
+            raise RuntimeError("render failed")
+    assert scheduler.acquire("sadtalker", timeout=0) == "0"
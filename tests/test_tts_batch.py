@@ -0,0 +1,63 @@
+import os
+import sys
+import threading
+from http.server import ThreadingHTTPServer
+import pytest
+import result_cache
+import TTS_API
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks", "stubs"))
+from tts_server import StubTTSHandler  # noqa: E402
+
+
+@pytest.fixture
+def tts_server(tmp_path, monkeypatch):
+    monkeypatch.setattr(StubTTSHandler, "delay", 0.2)
+    monkeypatch.setattr(StubTTSHandler, "fail_every", 0)
+    monkeypatch.setattr(StubTTSHandler, "requests_seen", 0)
+    monkeypatch.setattr(StubTTSHandler, "log_message", lambda *args: None)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubTTSHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    monkeypatch.setattr(TTS_API, "API_BASE_URL", f"http://127.0.0.1:{server.server_address[1]}")
+    monkeypatch.setattr(TTS_API, "BACKOFF_FACTOR", 0)
+    monkeypatch.setattr(TTS_API, "TTS_CACHE_ENABLED", True)
+    monkeypatch.setattr(TTS_API, "tts_cache", result_cache.ResultCache(str(tmp_path / "cache"), 1024 ** 3))
+    monkeypatch.setattr(TTS_API, "_session", None)
+    yield StubTTSHandler
+    server.shutdown()
+    server.server_close()
+
+
+def test_duplicate_lines_share_one_request(tts_server, tmp_path):
+    items = [("Hello", "stub-voice", None), ("Bye", "stub-voice", None),
+             ("Hello", "stub-voice", None), ("Hello", "stub-voice", None)]
+    results = TTS_API.text_to_speech_batch(items, str(tmp_path / "out"), max_parallel=4)
+
+    assert [error for _, error in results] == [None] * 4
+    assert results[0][0] == results[2][0] == results[3][0]
+    assert tts_server.requests_seen == 2
+
+
+def test_cached_lines_are_not_requested_again(tts_server, tmp_path):
+    items = [TTS_API.TTSItem("Hello", "stub-voice", output_path=str(tmp_path / "first.mp3"))]
+    TTS_API.text_to_speech_batch(items, str(tmp_path / "out"))
+    assert tts_server.requests_seen == 1
+
+    items = [TTS_API.TTSItem("Hello", "stub-voice", output_path=str(tmp_path / "second.mp3"))]
+    results = TTS_API.text_to_speech_batch(items, str(tmp_path / "out"))
+    assert results == [(str(tmp_path / "second.mp3"), None)]
+    assert tts_server.requests_seen == 1
+    with open(tmp_path / "first.mp3", "rb") as first, open(tmp_path / "second.mp3", "rb") as second:
+        assert first.read() == second.read()
+
+
+def test_rate_limited_requests_are_retried(tts_server, tmp_path):
+    # Every second request is answered with 429, so the second line needs a retry
+    tts_server.fail_every = 2
+    items = [("One", "stub-voice", None), ("Two", "stub-voice", None)]
+    results = TTS_API.text_to_speech_batch(items, str(tmp_path / "out"), max_parallel=1)
+
+    assert [error for _, error in results] == [None, None]
+    assert all(os.path.getsize(path) == tts_server.audio_size for path, _ in results)
+    assert tts_server.requests_seen == 3
@@ -0,0 +1,40 @@
+import os
+import pytest
+from worker_client import EngineWorker, WorkerError
+
+
+@pytest.fixture
+def worker(tmp_path):
+    worker = EngineWorker("sadtalker", str(tmp_path), stub=True, stub_delay=0.2).start()
+    yield worker
+    worker.stop()
+
+
+def test_handshake_starts_a_live_worker(worker):
+    assert worker.is_alive()
+    assert worker.request("ping") == {"engine": "sadtalker"}
+
+
+def test_render_returns_output_and_reports_progress(worker, tmp_path):
+    events = []
+    result = worker.render(on_progress=events.append, result_dir=str(tmp_path / "result"))
+
+    assert os.path.exists(result["output"])
+    assert events, "no progress events were delivered"
+    assert [event.percent for event in events] == sorted(event.percent for event in events)
+    assert events[-1].percent == 100
+
+
+def test_failed_request_raises_and_worker_keeps_serving(worker, tmp_path):
+    # The stub engine needs a result_dir; without one the request fails inside the worker
+    with pytest.raises(WorkerError, match="KeyError"):
+        worker.render()
+
+    assert worker.is_alive()
+    result = worker.render(result_dir=str(tmp_path / "result"))
+    assert os.path.exists(result["output"])
+
+
+def test_unknown_op_is_rejected(worker):
+    with pytest.raises(WorkerError, match="Unknown op"):
+        worker.request("train")
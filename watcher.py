@@ -0,0 +1,329 @@
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import signal
+import struct
+import sys
+import threading
+import time
+import audio_ingest
+import helpers
+import pipeline
+import runLivePortrait
+import worker_client
+from config_manager import config
+from logger import logger  # Import the logger
+
+# CONSTANTS
+WATCH_INPUT_DIR = config.get("Watch", "input_dir", fallback="input")
+WATCH_OUTPUT_DIR = config.get("Watch", "output_dir", fallback="output")
+USE_INOTIFY = config.getboolean("Watch", "inotify", fallback=True)
+POLL_INTERVAL = config.getfloat("Watch", "poll_interval", fallback=2.0)  # Seconds between scans without inotify
+SETTLE_TIME = config.getfloat("Watch", "settle_time", fallback=2.0)  # Seconds a file must stay unchanged
+DEFAULT_IMAGE = config.get("Watch", "default_image", fallback="")
+PAIR_TIMEOUT = config.getfloat("Watch", "pair_timeout", fallback=30.0)  # Seconds before audio falls back to DEFAULT_IMAGE
+
+AUDIO_EXTENSIONS = (".wav", ".mp3")
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+SIDECAR_EXTENSION = ".json"
+TEMP_SUFFIXES = (".part", ".tmp", ".crdownload", ".partial", ".swp")
+
+# inotify constants (linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+_EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, name length
+
+
+class InotifyWatch:
+    """
+    Minimal inotify binding (Linux, via ctypes) for a single directory.
+    Only used as a wake-up signal: the directory is rescanned after each batch of events.
+    """
+
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, f"inotify_add_watch failed for {path}")
+
+    def drain(self):
+        """Consume pending events. Returns the number of events read."""
+        count = 0
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return count
+            offset = 0
+            while offset < len(data):
+                _, _, _, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size + length
+                count += 1
+
+    def close(self):
+        os.close(self.fd)
+
+
+class InputWatcher:
+    """
+    Watches an input directory and submits complete audio/image pairs to a BatchPipeline.
+
+    A file is only used once its size and mtime have not changed for settle_time seconds,
+    and names ending in a temporary suffix (.part, .tmp, ...) are ignored, so half-written
+    files are never picked up. Pairs are found by:
+      1. a sidecar {name}.json: {"audio": "x.wav", "image": "y.png"} (image may be absolute),
+      2. the same file stem: x.wav + x.png,
+      3. DEFAULT_IMAGE, for audio that has waited pair_timeout seconds without an image.
+    """
+
+    def __init__(self, input_dir, batch, inter_dir, settle_time=SETTLE_TIME, poll_interval=POLL_INTERVAL,
+                 use_inotify=USE_INOTIFY, default_image=DEFAULT_IMAGE, pair_timeout=PAIR_TIMEOUT):
+        self.input_dir = input_dir
+        self.batch = batch
+        self.inter_dir = inter_dir
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.default_image = os.path.abspath(default_image) if default_image else None
+        self.pair_timeout = pair_timeout
+
+        self._files = {}  # name -> ((size, mtime_ns), time of last change)
+        self._claimed = set()  # names owned by queued or running jobs
+        self._job_files = {}  # job_id -> names to archive when the job finishes
+        self._image_refs = {}  # image name -> number of unfinished jobs using it
+        self._bad_sidecars = set()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._wake_read, self._wake_write = os.pipe()
+
+    def stop(self):
+        """Stop watching. Safe to call from a signal handler."""
+        self._stopping.set()
+        try:
+            os.write(self._wake_write, b"\0")
+        except OSError:
+            pass
+
+    def run(self):
+        watch = None
+        if self.use_inotify:
+            try:
+                watch = InotifyWatch(self.input_dir)
+                logger.info(f"Watching {self.input_dir} (inotify)")
+            except (OSError, AttributeError) as e:
+                logger.warning(f"inotify unavailable ({e}), polling every {self.poll_interval}s")
+        if watch is None:
+            logger.info(f"Watching {self.input_dir} (polling every {self.poll_interval}s)")
+
+        try:
+            while not self._stopping.is_set():
+                next_check = self.scan()
+                if watch is None:
+                    timeout = min(self.poll_interval, next_check) if next_check is not None else self.poll_interval
+                    fds = [self._wake_read]
+                else:
+                    # Sleep until something changes, or until a pending file may have settled
+                    timeout = next_check
+                    fds = [watch.fd, self._wake_read]
+                ready, _, _ = select.select(fds, [], [], timeout)
+                if watch is not None and watch.fd in ready:
+                    watch.drain()
+        finally:
+            if watch is not None:
+                watch.close()
+            os.close(self._wake_read)
+            os.close(self._wake_write)
+
+    def scan(self):
+        """
+        Rescan the input directory and submit every complete, settled pair.
+
+        Returns:
+        float: Seconds until a waiting file may become usable, or None if nothing is waiting.
+        """
+        now = time.monotonic()
+        current = {}
+        for entry in os.scandir(self.input_dir):
+            name = entry.name
+            if name.startswith(".") or name.endswith(TEMP_SUFFIXES) or not entry.is_file():
+                continue
+            if not name.lower().endswith(AUDIO_EXTENSIONS + IMAGE_EXTENSIONS + (SIDECAR_EXTENSION,)):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            previous = self._files.get(name)
+            current[name] = previous if previous and previous[0] == signature else (signature, now)
+        self._files = current
+
+        settled = {name: since for name, (_, since) in current.items() if now - since >= self.settle_time}
+        with self._lock:
+            ready = {name: since for name, since in settled.items() if name not in self._claimed}
+        for audio, image, extra in self._find_pairs(ready, settled, now):
+            self._submit(audio, image, extra)
+
+        # Unsettled files, and unpaired audio that can fall back to the default image, need another look
+        deadlines = []
+        with self._lock:
+            for name, (_, since) in self._files.items():
+                if name in self._claimed:
+                    continue
+                if now - since < self.settle_time:
+                    deadlines.append(since + self.settle_time)
+                elif self.default_image and name.lower().endswith(AUDIO_EXTENSIONS) and now - since < self.pair_timeout:
+                    deadlines.append(since + self.pair_timeout)
+        return max(0.05, min(deadlines) - now) if deadlines else None
+
+    def _find_pairs(self, ready, settled, now):
+        pairs = []
+        used = set()
+
+        for name in sorted(ready):
+            if not name.lower().endswith(SIDECAR_EXTENSION):
+                continue
+            try:
+                with open(os.path.join(self.input_dir, name), "r") as f:
+                    spec = json.load(f)
+                audio, image = spec["audio"], spec.get("image") or self.default_image
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                if name not in self._bad_sidecars:
+                    logger.warning(f"Ignoring invalid sidecar {name}: {e}")
+                    self._bad_sidecars.add(name)
+                continue
+            # Several sidecars may share one image, so it only has to be settled, not unclaimed
+            if audio in ready and audio not in used and image and (os.path.isabs(image) or image in settled):
+                pairs.append((audio, image, [name]))
+                used.update((audio, name))
+
+        images = {os.path.splitext(name)[0]: name for name in ready if name.lower().endswith(IMAGE_EXTENSIONS)}
+        for name in sorted(ready):
+            if name in used or not name.lower().endswith(AUDIO_EXTENSIONS):
+                continue
+            stem = os.path.splitext(name)[0]
+            if stem + SIDECAR_EXTENSION in self._files:
+                continue  # Paired by its sidecar
+            if name.lower().endswith(".wav") and stem + ".mp3" in self._files:
+                continue  # Being converted from the mp3
+            if stem in images:
+                pairs.append((name, images[stem], []))
+            elif self.default_image and now - ready[name] >= self.pair_timeout:
+                pairs.append((name, self.default_image, []))
+            else:
+                continue
+            used.add(name)
+        return pairs
+
+    def _submit(self, audio, image, extra):
+        audio_path = os.path.join(self.input_dir, audio)
+        image_path = image if os.path.isabs(image) else os.path.join(self.input_dir, image)
+        names = [audio] + extra
+
+        with self._lock:
+            self._claimed.update(names)
+            if not os.path.isabs(image):
+                self._claimed.add(image)
+                self._image_refs[image] = self._image_refs.get(image, 0) + 1
+
+        if audio.lower().endswith(".mp3"):
+            wav_path = os.path.splitext(audio_path)[0] + ".wav"
+            wav = os.path.basename(wav_path)
+            with self._lock:
+                self._claimed.add(wav)
+            src_path, wav_path, elapsed, error = audio_ingest.convert_to_wav(audio_path, wav_path)
+            if error:
+                logger.error(f"Failed to convert {audio}: {error}")
+                self._archive(names + [wav], image, "failed")
+                return
+            logger.info(f"Converted {audio} to {wav} in {elapsed:.2f}s")
+            helpers.move_to_completed(audio_path, os.path.join(self.input_dir, "audio_mp3"))
+            with self._lock:
+                self._claimed.discard(audio)
+            names = [wav] + extra
+            audio_path = wav_path
+
+        job = pipeline.Job(audio_path, image_path)
+        with self._lock:
+            self._job_files[job.job_id] = (names, image)
+        logger.info(f"Submitting job {job.job_id}: {os.path.basename(audio_path)} + {os.path.basename(image_path)}")
+        self.batch.submit(job)
+
+    def job_finished(self, job):
+        """BatchPipeline on_complete callback: archive the job's inputs and release them."""
+        with self._lock:
+            names, image = self._job_files.pop(job.job_id, ([], None))
+        if job.status == "done" and job.sadtalker_output:
+            for path in (job.sadtalker_output, runLivePortrait.motion_template_path(job.sadtalker_output),
+                         job.conditioned_audio_path):
+                if path and os.path.exists(path):
+                    helpers.move_to_completed(path, os.path.join(self.inter_dir, "completed"))
+        self._archive(names, image, "completed" if job.status == "done" else "failed")
+
+    def _archive(self, names, image, folder):
+        """
+        Move a job's files to input/completed or input/failed. The image is moved with
+        the last unfinished job that uses it.
+        """
+        with self._lock:
+            if image and image in self._image_refs:
+                self._image_refs[image] -= 1
+                if self._image_refs[image] == 0:
+                    del self._image_refs[image]
+                    names = names + [image]
+        target_dir = os.path.join(self.input_dir, folder)
+        for name in names:
+            path = os.path.join(self.input_dir, name)
+            if os.path.exists(path):
+                helpers.move_to_completed(path, target_dir)
+        with self._lock:
+            self._claimed.difference_update(names)
+
+
+def main():
+    input_dir = os.path.join(os.getcwd(), sys.argv[1] if len(sys.argv) > 1 else WATCH_INPUT_DIR)
+    output_dir = os.path.join(os.getcwd(), sys.argv[2] if len(sys.argv) > 2 else WATCH_OUTPUT_DIR)
+    inter_dir = os.path.join(os.getcwd(), "intermediate_videos")
+    for directory in [input_dir, output_dir, inter_dir]:
+        os.makedirs(directory, exist_ok=True)
+    parent_dir, pipeline_dir, sadTalker_dir, livePortrait_dir = helpers.get_directories()
+
+    # Keep one resident process per engine so models are loaded only once
+    sadtalker_worker = liveportrait_worker = None
+    if worker_client.WORKERS_ENABLED:
+        sadtalker_worker, liveportrait_worker = worker_client.start_workers(sadTalker_dir, livePortrait_dir)
+
+    batch = pipeline.BatchPipeline(sadTalker_dir, livePortrait_dir, inter_dir, output_dir, keep_jobs=False,
+                                   sadtalker_worker=sadtalker_worker, liveportrait_worker=liveportrait_worker)
+    watcher = InputWatcher(input_dir, batch, inter_dir)
+    batch.on_complete = watcher.job_finished
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: watcher.stop())
+
+    batch.start()
+    try:
+        watcher.run()
+    finally:
+        logger.info("Stopping watcher, waiting for queued jobs to finish")
+        batch.close()
+        for worker in (sadtalker_worker, liveportrait_worker):
+            if worker is not None:
+                worker.stop()
+
+
+if __name__ == "__main__":
+    main()
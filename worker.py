@@ -0,0 +1,378 @@
+"""
+Resident inference worker for SadTalker and LivePortrait.
+
+The worker is started once inside the engine's conda environment, loads the
+models a single time, then serves render requests until it is told to stop.
+
+Protocol (newline-delimited JSON over stdin/stdout):
+    worker -> {"ready": true, "engine": "sadtalker", "pid": 1234}
+    client -> {"id": 1, "op": "render", "args": {...}}
+    worker -> {"id": 1, "ok": true, "result": {"output": "/path/to/video.mp4"}}
+    worker -> {"id": 1, "ok": false, "error": "message"}
+Supported ops: "ping", "shutdown", and the engine's OPS ("render", and
+"prepare" for SadTalker conditioning artifacts).
+
+Engine output, including progress bars, goes to stderr. Each response is
+preceded by an END_MARKER line on stderr.
+
+This module only uses the standard library at import time, because it runs
+inside the engine environments rather than the pipeline's own environment.
+The engine packages are imported lazily by the engine classes.
+"""
+import argparse
+import copy
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import sys
+import time
+import traceback
+from collections import OrderedDict
+from time import strftime
+
+# Written to stderr after each request, so the client knows all of the request's
+# progress output has been read before it handles the response
+END_MARKER = "__WORKER_REQUEST_END__"
+# Source portraits whose LivePortrait crop is kept in memory
+SOURCE_CROP_CACHE_SIZE = 8
+
+
+def log(message):
+    print(f"[worker {os.getpid()}] {message}", file=sys.stderr, flush=True)
+
+
+class StubEngine:
+    """
+    GPU-free stand-in that mimics the output naming of the real engines.
+    Used to exercise the worker protocol and the pipeline without models.
+    """
+
+    def __init__(self, imitate, delay=0.0):
+        self.imitate = imitate
+        self.delay = delay
+        self.OPS = ("render", "prepare") if imitate == "sadtalker" else ("render",)
+
+    def prepare(self, args):
+        out_dir = args["out_dir"]
+        os.makedirs(out_dir, exist_ok=True)
+        result = {"coeff": os.path.join(out_dir, "coeff.mat")}
+        if args["kind"] == "source":
+            result["crop_pic"] = os.path.join(out_dir, "crop.png")
+            result["crop_info"] = os.path.join(out_dir, "crop_info.pkl")
+        for path in result.values():
+            with open(path, "wb") as f:
+                f.write(b"stub conditioning\n")
+        return result
+
+    def render(self, args):
+        # Emit tqdm-style progress on stderr like the real engines
+        delay = float(args.get("stub_delay", self.delay))
+        steps = 10
+        for step in range(1, steps + 1):
+            time.sleep(delay / steps)
+            sys.stderr.write(f"\r{self.imitate}:: {step * 100 // steps}%|{'#' * step}{' ' * (steps - step)}| {step}/{steps}")
+            sys.stderr.flush()
+        sys.stderr.write("\n")
+        if self.imitate == "sadtalker":
+            result_dir = args["result_dir"]
+            os.makedirs(result_dir, exist_ok=True)
+            output = os.path.join(result_dir, strftime("%Y_%m_%d_%H.%M.%S") + ".mp4")
+        else:
+            output_dir = args["output_dir"]
+            os.makedirs(output_dir, exist_ok=True)
+            s_filename = os.path.splitext(os.path.basename(args["source"]))[0]
+            d_filename = os.path.splitext(os.path.basename(args["driving"]))[0]
+            output = os.path.join(output_dir, f"{s_filename}--{d_filename}.mp4")
+            if not args["driving"].endswith(".pkl"):
+                # LivePortrait saves the driving motion template next to the driving video
+                with open(os.path.splitext(args["driving"])[0] + ".pkl", "wb") as f:
+                    f.write(b"stub motion template\n")
+        with open(output, "wb") as f:
+            f.write(b"stub video\n")
+        return {"output": output}
+
+
+class SadTalkerEngine:
+    """
+    Mirrors SadTalker's inference.py, but keeps the models resident between jobs.
+    Models are loaded per (preprocess, size) combination, because SadTalker
+    picks different checkpoints for 'full' and cropped preprocessing.
+
+    The "prepare" op extracts crop info and 3DMM coefficients for a template
+    image or reference video once; render requests can then pass those
+    artifacts instead of re-running preprocessing on the raw media.
+    """
+
+    OPS = ("render", "prepare")
+
+    def __init__(self, root_dir, device="cuda", checkpoint_dir="./checkpoints"):
+        import torch
+        from src.utils.preprocess import CropAndExtract
+        from src.test_audio2coeff import Audio2Coeff
+        from src.facerender.animate import AnimateFromCoeff
+        from src.generate_batch import get_data
+        from src.generate_facerender_batch import get_facerender_data
+        from src.utils.init_path import init_path
+
+        self.root_dir = root_dir
+        self.device = device if torch.cuda.is_available() else "cpu"
+        self.checkpoint_dir = checkpoint_dir
+        self._CropAndExtract = CropAndExtract
+        self._Audio2Coeff = Audio2Coeff
+        self._AnimateFromCoeff = AnimateFromCoeff
+        self._get_data = get_data
+        self._get_facerender_data = get_facerender_data
+        self._init_path = init_path
+        self._models = {}
+
+        # Warm up the default configuration used by the pipeline
+        self.models("full", 256)
+
+    def models(self, preprocess, size, old_version=False):
+        key = (preprocess, size, old_version)
+        if key not in self._models:
+            log(f"Loading SadTalker models for preprocess={preprocess}, size={size}")
+            sadtalker_paths = self._init_path(self.checkpoint_dir, os.path.join(self.root_dir, "src/config"), size, old_version, preprocess)
+            self._models[key] = (
+                self._CropAndExtract(sadtalker_paths, self.device),
+                self._Audio2Coeff(sadtalker_paths, self.device),
+                self._AnimateFromCoeff(sadtalker_paths, self.device),
+            )
+        return self._models[key]
+
+    def _ref_coeff(self, preprocess_model, ref_video, save_dir, preprocess):
+        ref_videoname = os.path.splitext(os.path.split(ref_video)[-1])[0]
+        ref_frame_dir = os.path.join(save_dir, ref_videoname)
+        os.makedirs(ref_frame_dir, exist_ok=True)
+        ref_coeff_path, _, _ = preprocess_model.generate(ref_video, ref_frame_dir, preprocess, source_image_flag=False)
+        return ref_coeff_path
+
+    def prepare(self, args):
+        """
+        Extract conditioning artifacts for a template image (kind "source") or a reference video (kind "reference").
+        """
+        preprocess = args.get("preprocess", "crop")
+        size = int(args.get("size", 256))
+        out_dir = args["out_dir"]
+        os.makedirs(out_dir, exist_ok=True)
+        preprocess_model = self.models(preprocess, size)[0]
+
+        if args["kind"] == "source":
+            coeff_path, crop_pic_path, crop_info = preprocess_model.generate(
+                args["media"], out_dir, preprocess, source_image_flag=True, pic_size=size)
+            if coeff_path is None:
+                raise RuntimeError("Can't get the coeffs of the input")
+            crop_info_path = os.path.join(out_dir, "crop_info.pkl")
+            with open(crop_info_path, "wb") as f:
+                pickle.dump(crop_info, f)
+            return {"coeff": coeff_path, "crop_pic": crop_pic_path, "crop_info": crop_info_path}
+
+        coeff_path, _, _ = preprocess_model.generate(args["media"], out_dir, preprocess, source_image_flag=False)
+        return {"coeff": coeff_path}
+
+    def render(self, args):
+        preprocess = args.get("preprocess", "crop")
+        size = int(args.get("size", 256))
+        still = bool(args.get("still", False))
+        ref_eyeblink = args.get("ref_eyeblink")
+        ref_pose = args.get("ref_pose")
+
+        save_dir = os.path.join(args["result_dir"], strftime("%Y_%m_%d_%H.%M.%S"))
+        os.makedirs(save_dir, exist_ok=True)
+
+        preprocess_model, audio_to_coeff, animate_from_coeff = self.models(preprocess, size)
+
+        source_conditioning = args.get("source_conditioning")
+        if source_conditioning:
+            # Precomputed by the "prepare" op
+            first_coeff_path = source_conditioning["coeff"]
+            crop_pic_path = source_conditioning["crop_pic"]
+            with open(source_conditioning["crop_info"], "rb") as f:
+                crop_info = pickle.load(f)
+        else:
+            # crop image and extract 3dmm from image
+            first_frame_dir = os.path.join(save_dir, "first_frame_dir")
+            os.makedirs(first_frame_dir, exist_ok=True)
+            first_coeff_path, crop_pic_path, crop_info = preprocess_model.generate(
+                args["source_image"], first_frame_dir, preprocess, source_image_flag=True, pic_size=size)
+            if first_coeff_path is None:
+                raise RuntimeError("Can't get the coeffs of the input")
+
+        ref_eyeblink_coeff_path = args.get("ref_eyeblink_coeff")
+        if ref_eyeblink_coeff_path is None and ref_eyeblink is not None:
+            ref_eyeblink_coeff_path = self._ref_coeff(preprocess_model, ref_eyeblink, save_dir, preprocess)
+
+        ref_pose_coeff_path = args.get("ref_pose_coeff")
+        if ref_pose_coeff_path is None and ref_pose is not None:
+            if ref_pose == ref_eyeblink:
+                ref_pose_coeff_path = ref_eyeblink_coeff_path
+            else:
+                ref_pose_coeff_path = self._ref_coeff(preprocess_model, ref_pose, save_dir, preprocess)
+
+        # audio2coeff
+        batch = self._get_data(first_coeff_path, args["driven_audio"], self.device, ref_eyeblink_coeff_path, still=still)
+        coeff_path = audio_to_coeff.generate(batch, save_dir, int(args.get("pose_style", 0)), ref_pose_coeff_path)
+
+        # coeff2video
+        data = self._get_facerender_data(
+            coeff_path, crop_pic_path, first_coeff_path, args["driven_audio"],
+            int(args.get("batch_size", 2)), None, None, None,
+            expression_scale=float(args.get("expression_scale", 1.0)), still_mode=still,
+            preprocess=preprocess, size=size)
+        result = animate_from_coeff.generate(
+            data, save_dir, args["source_image"], crop_info,
+            enhancer=args.get("enhancer"), background_enhancer=args.get("background_enhancer"),
+            preprocess=preprocess, img_size=size)
+
+        output = save_dir + ".mp4"
+        shutil.move(result, output)
+        if not args.get("verbose"):
+            shutil.rmtree(save_dir)
+        return {"output": output}
+
+
+class LivePortraitEngine:
+    """
+    Mirrors LivePortrait's inference.py, but keeps one LivePortraitPipeline resident.
+    """
+
+    OPS = ("render",)
+
+    def __init__(self, root_dir, flag_crop_driving_video=True):
+        from src.config.argument_config import ArgumentConfig
+        from src.config.inference_config import InferenceConfig
+        from src.config.crop_config import CropConfig
+        from src.live_portrait_pipeline import LivePortraitPipeline
+
+        self.root_dir = root_dir
+        self._ArgumentConfig = ArgumentConfig
+        base_args = ArgumentConfig(flag_crop_driving_video=flag_crop_driving_video)
+        inference_cfg = self._partial_fields(InferenceConfig, base_args.__dict__)
+        crop_cfg = self._partial_fields(CropConfig, base_args.__dict__)
+        log("Loading LivePortrait pipeline")
+        self.pipeline = LivePortraitPipeline(inference_cfg=inference_cfg, crop_cfg=crop_cfg)
+        self._default_inference_cfg = copy.deepcopy(inference_cfg.__dict__)
+        self._memoize_source_crop()
+
+    def _memoize_source_crop(self, size=SOURCE_CROP_CACHE_SIZE):
+        """
+        Keep the face detection/landmark crop of recent source portraits, so rendering
+        many audios onto one avatar only crops the portrait once.
+        """
+        cropper = getattr(self.pipeline, "cropper", None)
+        crop_source_image = getattr(cropper, "crop_source_image", None)
+        if crop_source_image is None:
+            log("LivePortrait cropper has no crop_source_image; source crops are not cached")
+            return
+        crops = OrderedDict()
+
+        def cached_crop_source_image(img_rgb, *args, **kwargs):
+            key = (hashlib.sha1(img_rgb.tobytes()).hexdigest(), img_rgb.shape, repr(args), repr(sorted(kwargs.items())))
+            if key not in crops:
+                crops[key] = crop_source_image(img_rgb, *args, **kwargs)
+                if len(crops) > size:
+                    crops.popitem(last=False)
+            else:
+                log("Reusing cached source portrait crop")
+            crops.move_to_end(key)
+            # The pipeline may modify the crop info in place
+            return copy.deepcopy(crops[key])
+
+        cropper.crop_source_image = cached_crop_source_image
+
+    @staticmethod
+    def _partial_fields(target_class, kwargs):
+        return target_class(**{k: v for k, v in kwargs.items() if hasattr(target_class, k)})
+
+    def render(self, args):
+        # Per-request inference flags are applied to the resident config, starting from
+        # the defaults so one request's quality tier does not carry over to the next
+        inference_cfg = self.pipeline.live_portrait_wrapper.inference_cfg
+        inference_cfg.__dict__.update(copy.deepcopy(self._default_inference_cfg))
+        for key, value in args.items():
+            if hasattr(inference_cfg, key):
+                setattr(inference_cfg, key, value)
+
+        argument_fields = {k: v for k, v in args.items() if hasattr(self._ArgumentConfig, k)}
+        wfp, wfp_concat = self.pipeline.execute(self._ArgumentConfig(**argument_fields))
+        return {"output": wfp, "concat": wfp_concat}
+
+
+def create_engine(engine, root_dir, stub=False, stub_delay=0.0):
+    if stub:
+        return StubEngine(engine, delay=stub_delay)
+    if engine == "sadtalker":
+        return SadTalkerEngine(root_dir)
+    if engine == "liveportrait":
+        return LivePortraitEngine(root_dir)
+    raise ValueError(f"Unknown engine: {engine}")
+
+
+def serve(engine, name, protocol_in, protocol_out):
+    def send(message):
+        sys.stdout.flush()
+        sys.stderr.write(f"\n{END_MARKER} {message.get('id')}\n")
+        sys.stderr.flush()
+        protocol_out.write(json.dumps(message) + "\n")
+        protocol_out.flush()
+
+    send({"ready": True, "engine": name, "pid": os.getpid()})
+    for line in protocol_in:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            send({"id": None, "ok": False, "error": f"Invalid request: {e}"})
+            continue
+
+        request_id = request.get("id")
+        op = request.get("op")
+        if op == "shutdown":
+            send({"id": request_id, "ok": True, "result": {}})
+            break
+        if op == "ping":
+            send({"id": request_id, "ok": True, "result": {"engine": name}})
+            continue
+        if op not in engine.OPS:
+            send({"id": request_id, "ok": False, "error": f"Unknown op: {op}"})
+            continue
+
+        start = time.time()
+        try:
+            result = getattr(engine, op)(request.get("args", {}))
+        except Exception as e:
+            log(traceback.format_exc())
+            send({"id": request_id, "ok": False, "error": f"{type(e).__name__}: {e}"})
+            continue
+        result["elapsed"] = time.time() - start
+        send({"id": request_id, "ok": True, "result": result})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resident SadTalker/LivePortrait inference worker")
+    parser.add_argument("--engine", required=True, choices=["sadtalker", "liveportrait"])
+    parser.add_argument("--root", default=os.getcwd(), help="Engine repository directory")
+    parser.add_argument("--stub", action="store_true", help="Use the GPU-free stub engine")
+    parser.add_argument("--stub-delay", type=float, default=0.0, help="Synthetic render time for the stub engine")
+    args = parser.parse_args()
+
+    # Keep a private handle on stdout for the protocol, and send everything the
+    # engines print (progress bars, debug output) to stderr instead.
+    protocol_out = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    root_dir = os.path.abspath(args.root)
+    if not args.stub:
+        os.chdir(root_dir)
+        sys.path.insert(0, root_dir)
+
+    engine = create_engine(args.engine, root_dir, stub=args.stub, stub_delay=args.stub_delay)
+    serve(engine, args.engine, sys.stdin, protocol_out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import conda_env
+import device_scheduler
+import stream_runner
+from config_manager import config
+from logger import logger  # Import the logger
+
+# CONSTANTS
+WORKERS_ENABLED = config.getboolean("Workers", "enabled", fallback=False)
+WORKERS_STUB = config.getboolean("Workers", "stub", fallback=False)
+STUB_DELAY = config.getfloat("Workers", "stub_delay", fallback=0.0)
+DEVICE_TIMEOUT = config.getfloat("Workers", "device_timeout", fallback=300.0)  # Seconds a worker waits for a device slot
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker.py")
+CONDA_ENVS = {"sadtalker": "sadtalker", "liveportrait": "liveportrait"}
+END_MARKER = "__WORKER_REQUEST_END__"  # Must match worker.END_MARKER
+
+
+class WorkerError(RuntimeError):
+    """Raised when a worker fails a request or dies."""
+
+
+class EngineWorker:
+    """
+    Client for one resident worker process (see worker.py).
+    Requests are serialized: a worker renders one job at a time.
+    """
+
+    def __init__(self, engine, root_dir, stub=WORKERS_STUB, stub_delay=STUB_DELAY):
+        self.engine = engine
+        self.root_dir = root_dir
+        self.stub = stub
+        self.stub_delay = stub_delay
+        self.process = None
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._on_progress = None
+        self._stderr_drained = threading.Event()
+        self.device = None
+
+    def _command(self):
+        worker_args = ["--engine", self.engine, "--root", self.root_dir]
+        if self.stub:
+            # The stub needs no conda env or GPU, so run it with this interpreter
+            return [sys.executable, WORKER_SCRIPT] + worker_args + ["--stub", "--stub-delay", str(self.stub_delay)]
+
+        env = conda_env.get_env(CONDA_ENVS[self.engine])
+        return [conda_env.get_python(env), WORKER_SCRIPT] + worker_args
+
+    def _env(self):
+        env = None if self.stub else conda_env.get_env(CONDA_ENVS[self.engine])
+        if self.device is not None:
+            env = device_scheduler.pin_env(env if env is not None else dict(os.environ), self.device)
+        return env
+
+    def _reserve_device(self, timeout=DEVICE_TIMEOUT):
+        # A resident worker keeps its model loaded, so it holds its device slot until stopped.
+        # A worker restarted after a crash keeps the slot it already holds.
+        if not device_scheduler.scheduler.enabled or self.device is not None:
+            return
+        try:
+            self.device = device_scheduler.scheduler.acquire(self.engine, timeout=timeout)
+        except TimeoutError:
+            self.device = None
+            raise WorkerError(f"No free device slot for the {self.engine} worker within {timeout:g}s "
+                              f"(resident workers hold their slot while running; see [Devices])")
+        logger.info(f"{self.engine} worker pinned to CUDA device {self.device}")
+
+    def _release_device(self):
+        device_scheduler.scheduler.release(self.engine, self.device)
+        self.device = None
+
+    def start(self):
+        logger.info(f"Starting {self.engine} worker{' (stub)' if self.stub else ''}")
+        self._reserve_device()
+        try:
+            self.process = subprocess.Popen(
+                self._command(), cwd=self.root_dir if not self.stub else None, env=self._env(),
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, bufsize=1)
+        except Exception:
+            self._release_device()
+            raise
+
+        # The engines print their progress bars to stderr; parse them in the background
+        self._stderr_drained.clear()
+        threading.Thread(target=self._read_stderr, args=(self.process,), name=f"{self.engine}-worker-stderr", daemon=True).start()
+
+        # Wait until the worker has loaded its models
+        ready = self._read_message()
+        if not ready.get("ready"):
+            self.process.kill()
+            self._release_device()
+            raise WorkerError(f"Unexpected handshake from {self.engine} worker: {ready}")
+        # The handshake is followed by an END_MARKER on stderr as well. Consume it here, so the
+        # first request does not take it for its own and stop waiting for its progress output.
+        self._stderr_drained.wait(timeout=2)
+        self._stderr_drained.clear()
+        logger.info(f"{self.engine} worker ready (pid {ready.get('pid')})")
+        return self
+
+    def _read_stderr(self, process):
+        dispatcher = stream_runner.LineDispatcher(self.engine, self._dispatch_progress)
+        for line in stream_runner.iter_lines(process.stderr.fileno()):
+            if line.startswith(END_MARKER):
+                self._stderr_drained.set()
+                continue
+            dispatcher.feed(line)
+
+    def _dispatch_progress(self, event):
+        on_progress = self._on_progress
+        if on_progress:
+            on_progress(event)
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def _read_message(self):
+        line = self.process.stdout.readline()
+        if not line:
+            code = self.process.wait()
+            raise WorkerError(f"{self.engine} worker exited with code {code}")
+        return json.loads(line)
+
+    def request(self, op, on_progress=None, **args):
+        """
+        Send a request and wait for its response.
+
+        Args:
+        on_progress (callable): Called with stream_runner.ProgressEvent objects while the request runs.
+
+        Returns:
+        dict: The "result" payload of the response.
+        """
+        with self._lock:
+            self._on_progress = on_progress
+            self._stderr_drained.clear()
+            if not self.is_alive():
+                # Restart a worker that died on a previous job
+                self.start()
+            self._next_id += 1
+            request_id = self._next_id
+            try:
+                self.process.stdin.write(json.dumps({"id": request_id, "op": op, "args": args}) + "\n")
+                self.process.stdin.flush()
+            except BrokenPipeError:
+                raise WorkerError(f"{self.engine} worker is not accepting requests")
+            try:
+                response = self._read_message()
+                # Let the stderr reader deliver the last progress updates of this request
+                self._stderr_drained.wait(timeout=2)
+            finally:
+                self._on_progress = None
+
+        if response.get("id") != request_id:
+            raise WorkerError(f"Out-of-order response from {self.engine} worker: {response}")
+        if not response.get("ok"):
+            raise WorkerError(response.get("error", "unknown error"))
+        return response.get("result", {})
+
+    def render(self, on_progress=None, **args):
+        return self.request("render", on_progress=on_progress, **args)
+
+    def stop(self, timeout=30):
+        if not self.is_alive():
+            self._release_device()
+            return
+        try:
+            self.request("shutdown")
+            self.process.wait(timeout=timeout)
+        except (WorkerError, subprocess.TimeoutExpired, OSError):
+            self.process.kill()
+        self._release_device()
+        logger.info(f"Stopped {self.engine} worker")
+
+
+def start_workers(sadTalker_dir, livePortrait_dir):
+    """
+    Start one resident worker per engine.
+
+    Returns:
+    tuple: (sadtalker_worker, liveportrait_worker)
+    """
+    sadtalker_worker = EngineWorker("sadtalker", sadTalker_dir).start()
+    try:
+        liveportrait_worker = EngineWorker("liveportrait", livePortrait_dir).start()
+    except Exception:
+        sadtalker_worker.stop()
+        raise
+    return sadtalker_worker, liveportrait_worker